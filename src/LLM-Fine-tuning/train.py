@@ -3,13 +3,17 @@ import pandas as pd
 import torch
 import re
 import numpy as np
-from transformers import AutoTokenizer, AutoModelForCausalLM, DataCollatorForSeq2Seq, TrainingArguments, Trainer, GenerationConfig
+from transformers import AutoTokenizer, AutoModelForCausalLM, DataCollatorForSeq2Seq, TrainingArguments, Trainer, GenerationConfig, StoppingCriteriaList
 from peft import LoraConfig, TaskType, get_peft_model
 import os
+from stopping_criteria import ActivityLineStoppingCriteria, count_generated_tokens
 import glob
 import pandas as pd
 from datasets import Dataset
 
+# 生成出第一条完整活动行后立即停止解码（设为False可对比提前停止前的平均解码token数）
+EARLY_STOP_ON_ACTIVITY_LINE = True
+
 
 def process_func(example):
     global tokenizer
@@ -62,7 +66,7 @@ def process_func(example):
         "labels": labels
     }
 
-def generate_prediction(model, tokenizer, instruction, input_text):
+def generate_prediction(model, tokenizer, instruction, input_text, token_counts=None):
     # 构建提示
     system_prompt = (
         "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n"
@@ -94,13 +98,23 @@ def generate_prediction(model, tokenizer, instruction, input_text):
         eos_token_id=tokenizer.eos_token_id
     )
     
+    prompt_length = inputs.input_ids.shape[1]
+    stopping_criteria = StoppingCriteriaList()
+    if EARLY_STOP_ON_ACTIVITY_LINE:
+        stopping_criteria.append(ActivityLineStoppingCriteria(tokenizer, prompt_length))
+    
     with torch.no_grad():
         outputs = model.generate(
             **inputs,
-            generation_config=generation_config
+            generation_config=generation_config,
+            stopping_criteria=stopping_criteria
         )
     
-    response = tokenizer.decode(outputs[0][inputs.input_ids.shape[1]:], skip_special_tokens=True).strip()
+    # 记录本次实际解码的token数，用于统计提前停止的效果
+    if token_counts is not None:
+        token_counts.append(count_generated_tokens(outputs[0], prompt_length, tokenizer.pad_token_id))
+    
+    response = tokenizer.decode(outputs[0][prompt_length:], skip_special_tokens=True).strip()
     return response
 
 def parse_activity(activity_text):
@@ -327,6 +341,7 @@ if __name__ == "__main__":
     # 训练完成后，在验证集上进行预测评估
     print("开始在验证集上进行预测评估...")
     predictions = []
+    token_counts = []
     references = final_val_df['output'].tolist()
     
     # 修复进度显示逻辑
@@ -334,7 +349,7 @@ if __name__ == "__main__":
     for i, row in final_val_df.iterrows():
         instruction = row['instruction']
         input_text = row['input']
-        prediction = generate_prediction(model, tokenizer, instruction, input_text)
+        prediction = generate_prediction(model, tokenizer, instruction, input_text, token_counts)
         predictions.append(prediction)
         
         # 每10个样本显示一次进度，确保不会超过总样本数
@@ -345,6 +360,9 @@ if __name__ == "__main__":
     if total_samples % 10 != 0:
         print(f"已完成 {total_samples}/{total_samples} 条预测")
     
+    avg_tokens = sum(token_counts) / len(token_counts) if token_counts else 0
+    print(f"平均解码token数: {avg_tokens:.1f} (提前停止: {'开启' if EARLY_STOP_ON_ACTIVITY_LINE else '关闭'})")
+    
     # 计算准确率
     accuracy = compute_accuracy(predictions, references)
     print(f"验证集预测准确率: {accuracy:.4f}")
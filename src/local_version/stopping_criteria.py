@@ -0,0 +1,60 @@
+"""
+活动预测生成的提前停止条件
+模型输出一行完整的 "YYYY-MM-DD HH:MM:SS - 操作: 目标" 并换行后立即停止解码，
+避免继续生成随后会被 clean_output 丢弃的内容。
+
+推理服务（realtime_prediction_2.0/linux）和 LLM-Fine-tuning、local_version 的训练脚本各在自己目录下带一份相同的
+副本，各目录可以单独部署；修改时三份需保持一致。
+"""
+
+import re
+import torch
+from transformers import StoppingCriteria
+
+# 语法上合法的活动行：时间戳 + " - " + 非空的操作描述
+ACTIVITY_LINE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} - \S.*$')
+
+class ActivityLineStoppingCriteria(StoppingCriteria):
+    """在第一条合法活动行之后的换行处停止生成（支持批量，按行独立判断）"""
+    
+    def __init__(self, tokenizer, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.finished = None
+        # 上一次调用时的序列长度；辅助生成一步可能追加多个token，需要检查自上次以来的全部新token
+        self.checked_length = None
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        batch_size = input_ids.shape[0]
+        if self.finished is None or self.finished.shape[0] != batch_size:
+            self.finished = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+            self.checked_length = None
+        new_start = self.checked_length
+        if new_start is None or new_start > input_ids.shape[1]:
+            new_start = self.prompt_length
+        self.checked_length = input_ids.shape[1]
+        
+        for row in range(batch_size):
+            if self.finished[row]:
+                continue
+            
+            # 只有新生成的token包含换行时才需要检查，避免每步都解码整段输出
+            new_tokens = self.tokenizer.decode(input_ids[row, new_start:], skip_special_tokens=False)
+            if "\n" not in new_tokens:
+                continue
+            
+            text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+            # 最后一个换行符之后的内容尚未成行，不参与判断
+            complete_lines = [line.strip() for line in text.split("\n")[:-1]]
+            if any(ACTIVITY_LINE_PATTERN.match(line) for line in complete_lines):
+                self.finished[row] = True
+        
+        return self.finished.clone()
+
+def count_generated_tokens(output_ids: torch.LongTensor, prompt_length: int, pad_token_id: int) -> int:
+    """统计一条输出中生成的有效token数（不含提示、结束符和末尾的填充）"""
+    generated = output_ids[prompt_length:]
+    non_pad = (generated != pad_token_id).nonzero()
+    if non_pad.numel() == 0:
+        return 0
+    return int(non_pad[-1]) + 1
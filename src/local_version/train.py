@@ -3,9 +3,10 @@ import pandas as pd
 import torch
 import re
 import numpy as np
-from transformers import AutoTokenizer, AutoModelForCausalLM, DataCollatorForSeq2Seq, TrainingArguments, Trainer, GenerationConfig
+from transformers import AutoTokenizer, AutoModelForCausalLM, DataCollatorForSeq2Seq, TrainingArguments, Trainer, GenerationConfig, StoppingCriteriaList
 from peft import LoraConfig, TaskType, get_peft_model
 import os
+from stopping_criteria import ActivityLineStoppingCriteria, count_generated_tokens
 import glob
 import json
 import argparse
@@ -17,6 +18,7 @@ class Qwen3FineTuner:
         self.config = config
         self.tokenizer = None
         self.model = None
+        self.generated_token_counts = []
         self.setup_logging()
 
     def setup_logging(self):
@@ -173,9 +175,14 @@ class Qwen3FineTuner:
             pad_token_id=self.tokenizer.pad_token_id,
             eos_token_id=self.tokenizer.eos_token_id
         )
+        prompt_length = inputs.input_ids.shape[1]
+        stopping_criteria = StoppingCriteriaList()
+        if self.config.get('early_stop_on_activity_line', True):
+            stopping_criteria.append(ActivityLineStoppingCriteria(self.tokenizer, prompt_length))
         with torch.no_grad():
-            outputs = self.model.generate(**inputs, generation_config=generation_config)
-        raw = self.tokenizer.decode(outputs[0][inputs.input_ids.shape[1]:], skip_special_tokens=False).strip()
+            outputs = self.model.generate(**inputs, generation_config=generation_config, stopping_criteria=stopping_criteria)
+        self.generated_token_counts.append(count_generated_tokens(outputs[0], prompt_length, self.tokenizer.pad_token_id))
+        raw = self.tokenizer.decode(outputs[0][prompt_length:], skip_special_tokens=False).strip()
         return clean_output(raw)
 
     def evaluate_model(self, val_df):
@@ -183,6 +190,7 @@ class Qwen3FineTuner:
         predictions = []
         references = val_df['output'].tolist()
         exact_matches, partial_matches, empty_predictions = 0, 0, 0
+        self.generated_token_counts = []
 
         def split_event(event):
             match = re.match(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - ([^:]+): (.+)$', event.strip())
@@ -216,6 +224,9 @@ class Qwen3FineTuner:
         self.logger.info(f"完全匹配准确率: {acc:.4f} ({exact_matches}/{total})")
         self.logger.info(f"部分匹配准确率: {partial_acc:.4f} ({partial_matches}/{total})")
         self.logger.info(f"不合规预测占比: {empty_ratio:.4f} ({empty_predictions}/{total})")
+        avg_tokens = sum(self.generated_token_counts) / len(self.generated_token_counts) if self.generated_token_counts else 0
+        early_stop = self.config.get('early_stop_on_activity_line', True)
+        self.logger.info(f"平均解码token数: {avg_tokens:.1f} (提前停止: {'开启' if early_stop else '关闭'})")
 
         results_df = pd.DataFrame({
             'instruction': val_df['instruction'],
@@ -314,6 +325,7 @@ def create_default_config():
         "do_sample": True,
         "temperature": 0.7,
         "top_p": 0.9,
+        "early_stop_on_activity_line": True,
         
         # 系统提示词
         "system_prompt": "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\nYou are a helpful assistant.\n<|eot_id|>",
@@ -4,16 +4,46 @@ Linux云服务器上的模型API服务
 """
 
 import os
+import re
+import gc
+import copy
+import math
+import time
+import functools
+import asyncio
 import torch
 import json
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, GenerationConfig,
+    DynamicCache, LogitsProcessor, LogitsProcessorList, StoppingCriteriaList
+)
+from transformers.generation.streamers import BaseStreamer
 from peft import PeftModel
+from stopping_criteria import ActivityLineStoppingCriteria, ACTIVITY_LINE_PATTERN, count_generated_tokens
+from metrics import MetricsRegistry
+from prompt_compiler import PromptCompiler
+from grammar import ActivityGrammar, ActivityGrammarProcessor, build_activity_gbnf, load_app_vocabulary
 import logging
-from datetime import datetime
-from typing import List, Dict, Any
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from typing import List, Dict, Any, Tuple, Callable, Awaitable, Optional, Union
+
+try:
+    from llama_cpp import Llama, LlamaStoppingCriteriaList, LlamaGrammar
+except ImportError:
+    Llama = None
+    LlamaStoppingCriteriaList = None
+    LlamaGrammar = None
+
+try:
+    from torchao.quantization import quantize_, Int8WeightOnlyConfig, IntxWeightOnlyConfig, PerGroup
+except ImportError:
+    quantize_ = None
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -22,195 +52,2146 @@ logger = logging.getLogger(__name__)
 # 模型路径配置
 BASE_MODEL_PATH = "/home/vipuser/llm/LLM-Research/Meta-Llama-3___1-8B-Instruct"
 FINE_TUNED_MODEL_PATH = "/home/vipuser/llm/output/exp16_lr0.0003_bs2_r32_a128_ep4_d0.05/checkpoint-356"
+# merge_adapter.py 导出的合并模型目录；设置后直接加载，不再包装LoRA
+MERGED_MODEL_PATH = os.environ.get("MEMO_MERGED_MODEL_PATH", "")
+
+# 推理后端: transformers（GPU） 或 llamacpp（CPU + GGUF量化模型）
+BACKEND = os.environ.get("MEMO_BACKEND", "transformers")
+GGUF_MODEL_PATH = os.environ.get("MEMO_GGUF_MODEL_PATH", "/home/vipuser/llm/gguf/exp16-Q4_K_M.gguf")
+CPU_THREADS = int(os.environ.get("MEMO_CPU_THREADS", str(os.cpu_count() or 4)))
+GGUF_CONTEXT_SIZE = int(os.environ.get("MEMO_GGUF_CONTEXT_SIZE", "1024"))
+# transformers 后端的CPU权重量化: none（bf16，按 device_map=auto 放置）、int8 或 int4（torchao 仅权重量化，在CPU上推理）
+QUANTIZATION = os.environ.get("MEMO_QUANTIZATION", "none")
+QUANTIZATION_MODES = ("none", "int8", "int4")
+# int4 分组量化的组大小（torchao 支持 32/64/128/256）
+QUANTIZATION_GROUP_SIZE = int(os.environ.get("MEMO_QUANTIZATION_GROUP_SIZE", "128"))
+# 按用户加载的LoRA适配器：目录下每个子目录（目录名即 user_id）是一个适配器
+ADAPTER_DIR = os.environ.get("MEMO_ADAPTER_DIR", "/home/vipuser/llm/output/users")
+# 常驻的用户适配器权重总预算（MB），超出时淘汰最久未使用的适配器
+ADAPTER_MEMORY_MB = float(os.environ.get("MEMO_ADAPTER_MEMORY_MB", "2048"))
+# PeftModel.from_pretrained 加载的默认适配器名（FINE_TUNED_MODEL_PATH）
+DEFAULT_ADAPTER = "default"
+# mock 后端（不加载模型）的合成延迟，用于压测批处理、缓存和排队行为
+MOCK_PREFILL_MS = float(os.environ.get("MEMO_MOCK_PREFILL_MS", "50"))
+MOCK_TOKEN_LATENCY_MS = float(os.environ.get("MEMO_MOCK_TOKEN_LATENCY_MS", "20"))
+MOCK_GENERATED_TOKENS = int(os.environ.get("MEMO_MOCK_GENERATED_TOKENS", "24"))
+
+# 批处理调度配置（可通过环境变量调整）
+MAX_BATCH_SIZE = int(os.environ.get("MEMO_MAX_BATCH_SIZE", "8"))
+MAX_BATCH_WAIT_MS = float(os.environ.get("MEMO_MAX_BATCH_WAIT_MS", "10"))
+# 推理队列上限，超出时直接返回503，避免请求无限堆积
+MAX_QUEUE_SIZE = int(os.environ.get("MEMO_MAX_QUEUE_SIZE", "64"))
+# 新请求的预估排队时间超过该值（毫秒）时直接返回503并给出 Retry-After，为 0 时只按队列长度限制
+MAX_ESTIMATED_WAIT_MS = float(os.environ.get("MEMO_MAX_ESTIMATED_WAIT_MS", "10000"))
+# 空闲HTTP连接的保持时间（秒）；Windows端复用经SSH隧道的长连接，需长于预测间隔（默认30秒冷却）
+KEEP_ALIVE_SECONDS = int(os.environ.get("MEMO_KEEP_ALIVE_SECONDS", "75"))
+# /predict_batch 单次请求的最大条数；离线评估按长度排序后每 MAX_BATCH_SIZE 条生成一次
+MAX_BULK_ITEMS = int(os.environ.get("MEMO_MAX_BULK_ITEMS", "2048"))
+# 预测结果缓存配置：容量为0时关闭缓存；时间分桶为0时直接去掉时间戳
+CACHE_MAX_SIZE = int(os.environ.get("MEMO_CACHE_SIZE", "256"))
+CACHE_TTL_SECONDS = float(os.environ.get("MEMO_CACHE_TTL_SECONDS", "60"))
+CACHE_TIME_BUCKET_SECONDS = int(os.environ.get("MEMO_CACHE_TIME_BUCKET_SECONDS", "0"))
+# 单次请求最多返回的候选预测数
+MAX_TOP_K = int(os.environ.get("MEMO_MAX_TOP_K", "5"))
+# 生成出第一条完整活动行后立即停止解码
+ENABLE_EARLY_STOP = os.environ.get("MEMO_EARLY_STOP", "1") == "1"
+# 辅助生成（投机解码）使用的草稿模型：微调后的 Qwen3-0.6B
+ENABLE_SPECULATIVE = os.environ.get("MEMO_SPECULATIVE", "0") == "1"
+DRAFT_MODEL_PATH = os.environ.get("MEMO_DRAFT_MODEL_PATH", "/home/vipuser/llm/models/qwen/Qwen3-0___6B")
+DRAFT_ADAPTER_PATH = os.environ.get("MEMO_DRAFT_ADAPTER_PATH", "/home/vipuser/llm/output/qwen3-finetune")
+# 是否在启动时预计算系统提示前缀的KV缓存
+ENABLE_PREFIX_CACHE = os.environ.get("MEMO_PREFIX_CACHE", "1") == "1"
+# 按段缓存token ID拼接提示（模板只编码一次，活动行按行LRU缓存），代替每个请求整段分词
+ENABLE_PROMPT_COMPILER = os.environ.get("MEMO_PROMPT_COMPILER", "1") == "1"
+TOKEN_CACHE_SIZE = int(os.environ.get("MEMO_TOKEN_CACHE_SIZE", "4096"))
+# 受限解码：生成时只允许符合活动行格式的token（请求可用 constrained 字段单独开关）
+ENABLE_CONSTRAINED_DECODING = os.environ.get("MEMO_CONSTRAINED_DECODING", "0") == "1"
+# 已知应用列表（JSON数组或每行一个应用名），设置后应用名只能从中选择
+GRAMMAR_APP_VOCAB = os.environ.get("MEMO_GRAMMAR_APPS", "")
+# 每个解码步按分数从高到低检查的候选token数
+GRAMMAR_TOP_CANDIDATES = int(os.environ.get("MEMO_GRAMMAR_TOP_CANDIDATES", "32"))
+# 后台加载失败时的最大尝试次数（0 为不限）和重试退避（秒，每次翻倍，不超过上限）
+LOAD_MAX_ATTEMPTS = int(os.environ.get("MEMO_LOAD_MAX_ATTEMPTS", "0"))
+LOAD_RETRY_BACKOFF_SECONDS = float(os.environ.get("MEMO_LOAD_RETRY_BACKOFF_SECONDS", "10"))
+LOAD_RETRY_MAX_BACKOFF_SECONDS = float(os.environ.get("MEMO_LOAD_RETRY_MAX_BACKOFF_SECONDS", "300"))
+# 加载期间输出进度日志的间隔（秒）
+LOAD_PROGRESS_INTERVAL_SECONDS = float(os.environ.get("MEMO_LOAD_PROGRESS_INTERVAL_SECONDS", "10"))
+# 加载完成后用代表性长度的提示预热，再标记为就绪
+ENABLE_WARMUP = os.environ.get("MEMO_WARMUP", "1") == "1"
+# 预热用的活动序列行数（Windows端默认窗口为5条，队列上限为10条）
+WARMUP_SEQUENCE_LENGTHS = [int(n) for n in os.environ.get("MEMO_WARMUP_LENGTHS", "1,5,10").split(",") if n.strip()]
+WARMUP_INSTRUCTION = "根据用户之前的活动序列，预测下一个可能的活动。"
+
+# 所有请求共用的固定系统提示
+SYSTEM_PROMPT = (
+    "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n"
+    "Cutting Knowledge Date: December 2023\n"
+    "Today Date: 26 Jul 2024\n\n"
+    "你是一个智能助手，请根据用户最近的活动序列，预测下一个最有可能的用户活动。请确保输出格式与输入格式一致，应为\"时间 - 操作\"的形式。\n"
+    "<|eot_id|>"
+)
+USER_HEADER = "<|start_header_id|>user<|end_header_id|>\n\n"
+ASSISTANT_HEADER = "<|start_header_id|>assistant<|end_header_id|>\n\n"
 
 app = FastAPI(title="LLM Activity Prediction API", version="1.0.0")
 
-# 全局变量存储模型和分词器
+# 全局变量存储推理后端、模型和分词器
+backend = None
 model = None
 tokenizer = None
+# 模型加载方式（lora / merged）及耗时
+model_format = None
+model_load_seconds = 0.0
+batcher = None
+prediction_cache = None
+# 系统提示前缀的KV缓存: {"input_ids", "past_key_values", "length"}
+prefix_cache = None
+# 提示分段编码器（MEMO_PROMPT_COMPILER），与分词器一同创建
+prompt_compiler = None
+# 活动行格式（受限解码），启动时按 MEMO_GRAMMAR_APPS 创建
+activity_grammar = ActivityGrammar(load_app_vocabulary(GRAMMAR_APP_VOCAB))
+# 用户LoRA适配器池
+adapter_pool = None
+# 辅助生成的草稿模型和分词器
+draft_model = None
+draft_tokenizer = None
+# 各生成模式累计的解码token数和耗时
+decode_stats = {
+    "standard": {"tokens": 0, "seconds": 0.0},
+    "speculative": {"tokens": 0, "seconds": 0.0}
+}
+
+# 后台加载状态，status 为 loading / warming_up / ready / retrying / failed
+load_state = {
+    "status": "loading",
+    "stage": None,
+    "attempts": 0,
+    "last_error": None,
+    "load_seconds": 0.0,
+    "warmup_seconds": 0.0,
+    "next_retry_at": None
+}
+loader_task = None
+
+# Prometheus 指标（/metrics）
+metrics = MetricsRegistry()
+REQUEST_LATENCY = metrics.histogram(
+    "memo_request_latency_seconds", "预测请求各阶段耗时（tokenize / prefill / decode / total）", ["stage"]
+)
+REQUESTS_TOTAL = metrics.counter("memo_requests_total", "预测请求数（按结果和缓存状态）", ["status", "cache"])
+PROMPT_TOKENS = metrics.counter("memo_prompt_tokens_total", "已处理的提示token数")
+GENERATED_TOKENS = metrics.counter("memo_generated_tokens_total", "已生成的token数")
+TOKENS_PER_SECOND = metrics.gauge("memo_decode_tokens_per_second", "最近一个批次的解码速度", ["mode"])
+BATCH_SIZE = metrics.histogram("memo_batch_size", "每个批次的请求数", buckets=(1, 2, 4, 8, 16, 32, 64))
+QUEUE_WAIT = metrics.histogram("memo_queue_wait_seconds", "请求在批处理队列中的等待时间")
+REQUESTS_SHED = metrics.counter("memo_requests_shed_total", "过载时在入队前拒绝的请求数（按原因）", ["reason"])
+REQUESTS_EXPIRED = metrics.counter("memo_requests_expired_total", "排队期间超过截止时间而丢弃的请求数")
+STREAM_TIME_TO_ACTION = metrics.histogram("memo_stream_time_to_action_seconds", "流式预测从收到请求到解码出应用/动作的耗时")
+
+# 流式生成的文本回调：(增量文本, 这些token的对数概率)
+TextCallback = Callable[[str, List[float]], None]
+
+# 流式预测中识别活动行的应用/动作部分，应用名或网站解码完成即可匹配，不必等整行结束
+STREAM_ACTION_PATTERNS = [
+    ("启动应用", re.compile(r'启动应用:\s*(?P<app>\S+?\.exe)')),
+    ("访问网站", re.compile(r'访问网站 (?P<target>\S+) 的页面')),
+    ("切换到窗口", re.compile(r'切换到窗口:\s*(?P<target>.+?)\s*\(应用:\s*(?P<app>\S+?\.exe)')),
+    ("访问网页", re.compile(r'访问网页:\s*(?P<target>\S+)\s*\(应用:\s*(?P<app>\S+?\.exe)'))
+]
 
 class PredictionRequest(BaseModel):
     instruction: str
     input: str
+    top_k: int = 1
+    speculative: bool = False
+    user_id: Optional[str] = None
+    # 是否使用受限解码，默认取服务端的 MEMO_CONSTRAINED_DECODING
+    constrained: Optional[bool] = None
+    # 客户端还愿意等待的时间（毫秒），也可用请求头 X-Deadline-Ms 传入；超过后服务端不再为该请求生成
+    deadline_ms: Optional[float] = None
 
 class PredictionResponse(BaseModel):
     prediction: str
     confidence: float
     timestamp: str
+    candidates: List[Dict[str, Any]] = []
+    metadata: Dict[str, Any] = {}
+
+class BulkPredictionItem(BaseModel):
+    instruction: str
+    input: str
+
+class BulkPredictionRequest(BaseModel):
+    items: List[BulkPredictionItem]
+    top_k: int = 1
+    user_id: Optional[str] = None
+    constrained: Optional[bool] = None
+    # 每次批量生成的条数，默认 MAX_BATCH_SIZE
+    bucket_size: Optional[int] = None
+
+class BulkPredictionResponse(BaseModel):
+    predictions: List[PredictionResponse]
+    metadata: Dict[str, Any] = {}
+
+def quantize_weights(target_model, mode: str, group_size: int = QUANTIZATION_GROUP_SIZE):
+    """用 torchao 将线性层权重就地量化为 int8（逐通道）或 int4（分组），激活仍为 bf16
+    
+    int4 使用 IntxWeightOnlyConfig：Int4WeightOnlyConfig 的打包格式依赖CUDA内核，不能在CPU上运行。
+    """
+    if mode == "int8":
+        quantize_(target_model, Int8WeightOnlyConfig())
+    elif mode == "int4":
+        quantize_(target_model, IntxWeightOnlyConfig(weight_dtype=torch.int4, granularity=PerGroup(group_size)))
+    return target_model
 
 def load_model():
-    """加载微调后的模型"""
-    global model, tokenizer
+    """加载微调后的模型（LoRA检查点或合并后的模型）
+    
+    QUANTIZATION 为 int8/int4 时在CPU上加载，把LoRA合并进基础权重后再量化
+    （量化后的线性层不能再叠加LoRA旁路），此时不启用按用户的适配器池。
+    设置 MERGED_MODEL_PATH 时直接加载合并后的权重，同样不启用适配器池：请求中的 user_id 被忽略，
+    也不参与缓存键。
+    """
+    global model, tokenizer, model_format, model_load_seconds, adapter_pool, prompt_compiler
     
     try:
-        logger.info("开始加载基础模型...")
-        # 加载基础模型
-        base_model = AutoModelForCausalLM.from_pretrained(
-            BASE_MODEL_PATH,
-            device_map="auto",
+        start = time.perf_counter()
+        use_merged = bool(MERGED_MODEL_PATH)
+        weights_path = MERGED_MODEL_PATH if use_merged else BASE_MODEL_PATH
+        quantized = QUANTIZATION != "none"
+        if quantized:
+            if QUANTIZATION not in QUANTIZATION_MODES:
+                raise ValueError(f"未知的量化模式: {QUANTIZATION}，可选: {list(QUANTIZATION_MODES)}")
+            if quantize_ is None:
+                raise RuntimeError("未安装 torchao，无法使用量化模式，请先 pip install torchao")
+            torch.set_num_threads(CPU_THREADS)
+        
+        load_state["stage"] = "合并模型权重" if use_merged else "基础模型权重"
+        logger.info(f"开始加载{'合并后的' if use_merged else '基础'}模型: {weights_path}")
+        loaded_model = AutoModelForCausalLM.from_pretrained(
+            weights_path,
+            device_map="cpu" if quantized else "auto",
             torch_dtype=torch.bfloat16,
             trust_remote_code=True
         )
         
+        load_state["stage"] = "分词器"
         logger.info("开始加载分词器...")
         # 加载分词器
         tokenizer = AutoTokenizer.from_pretrained(
-            BASE_MODEL_PATH,
+            weights_path,
             use_fast=False,
             trust_remote_code=True
         )
         tokenizer.pad_token = tokenizer.eos_token
+        # 批量生成时需要左填充，保证每条提示的末尾对齐
+        tokenizer.padding_side = "left"
+        
+        if ENABLE_PROMPT_COMPILER:
+            prompt_compiler = build_prompt_compiler()
+        
+        if use_merged:
+            model = loaded_model
+            logger.warning("⚠️ 使用合并后的模型，不启用按用户的LoRA适配器，请求中的 user_id 将被忽略")
+        elif quantized:
+            load_state["stage"] = "LoRA适配器"
+            logger.info("开始加载微调模型并合并LoRA权重...")
+            model = PeftModel.from_pretrained(loaded_model, FINE_TUNED_MODEL_PATH).merge_and_unload()
+        else:
+            load_state["stage"] = "LoRA适配器"
+            logger.info("开始加载微调模型...")
+            # 加载微调后的模型
+            model = PeftModel.from_pretrained(loaded_model, FINE_TUNED_MODEL_PATH, adapter_name=DEFAULT_ADAPTER)
+            # 按用户的适配器与默认适配器共用同一份基础模型权重
+            adapter_pool = AdapterPool(ADAPTER_DIR, ADAPTER_MEMORY_MB)
         
-        logger.info("开始加载微调模型...")
-        # 加载微调后的模型
-        model = PeftModel.from_pretrained(base_model, FINE_TUNED_MODEL_PATH)
+        if quantized:
+            load_state["stage"] = "权重量化"
+            logger.info(f"开始{QUANTIZATION}权重量化 (CPU线程数: {CPU_THREADS})...")
+            quantize_weights(model, QUANTIZATION)
         model.eval()
         
+        # 量化前已把LoRA合并进基础权重，此时与预合并权重一样不再带适配器
+        model_format = "merged" if use_merged or quantized else "lora"
+        if quantized:
+            model_format = f"{model_format}+{QUANTIZATION}"
+        model_load_seconds = time.perf_counter() - start
+        logger.info(f"模型权重加载耗时 {model_load_seconds:.1f}s (格式: {model_format})")
+        
+        if ENABLE_PREFIX_CACHE:
+            load_state["stage"] = "前缀KV缓存"
+            build_prefix_cache()
+        
+        if ENABLE_SPECULATIVE:
+            load_state["stage"] = "草稿模型"
+            load_draft_model()
+        
         logger.info("模型加载完成!")
         return True
         
     except Exception as e:
+        model = None
+        tokenizer = None
+        load_state["last_error"] = str(e)
         logger.error(f"模型加载失败: {e}")
         return False
 
-def generate_prediction(instruction: str, input_text: str) -> Dict[str, Any]:
-    """生成预测结果"""
-    global model, tokenizer
+def load_draft_model():
+    """加载辅助生成使用的草稿模型（LoRA合并进基础权重以减少每步开销）"""
+    global draft_model, draft_tokenizer
+    
+    try:
+        logger.info(f"开始加载草稿模型: {DRAFT_MODEL_PATH}")
+        draft_tokenizer = AutoTokenizer.from_pretrained(DRAFT_MODEL_PATH, trust_remote_code=True)
+        draft = AutoModelForCausalLM.from_pretrained(
+            DRAFT_MODEL_PATH,
+            device_map="auto",
+            torch_dtype=torch.bfloat16,
+            trust_remote_code=True
+        )
+        if DRAFT_ADAPTER_PATH and os.path.exists(DRAFT_ADAPTER_PATH):
+            draft = PeftModel.from_pretrained(draft, DRAFT_ADAPTER_PATH).merge_and_unload()
+        else:
+            logger.warning(f"未找到草稿模型LoRA: {DRAFT_ADAPTER_PATH}，使用未微调的草稿模型")
+        draft.eval()
+        draft_model = draft
+        logger.info("草稿模型加载完成，已启用辅助生成")
+    except Exception as e:
+        draft_model = None
+        draft_tokenizer = None
+        logger.error(f"草稿模型加载失败，辅助生成不可用: {e}")
+
+def build_user_prompt(instruction: str, input_text: str) -> str:
+    """构建系统提示之后的用户和助手部分"""
+    user_prompt = USER_HEADER + f"{instruction}\n{input_text}" + "<|eot_id|>"
+    
+    return user_prompt + ASSISTANT_HEADER
+
+def build_prompt(instruction: str, input_text: str) -> str:
+    """构建Llama-3对话格式的完整提示"""
+    return SYSTEM_PROMPT + build_user_prompt(instruction, input_text)
+
+def _compute_prefix_cache(adapter_name: Optional[str] = None) -> Dict[str, Any]:
+    """计算系统提示的KV缓存；LoRA会改变K/V投影，因此每个适配器各有一份"""
+    # 与完整提示的编码方式保持一致（包含分词器自动添加的特殊token）
+    prefix_ids = tokenizer(SYSTEM_PROMPT, return_tensors="pt").input_ids.to(model.device)
+    forward_kwargs = {"adapter_names": [adapter_name]} if adapter_name is not None else {}
+    with torch.no_grad():
+        outputs = model(input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True, **forward_kwargs)
+    return {
+        "input_ids": prefix_ids,
+        "past_key_values": outputs.past_key_values,
+        "length": prefix_ids.shape[1]
+    }
+
+def build_warmup_input(num_lines: int) -> str:
+    """构造与Windows端格式一致的活动序列，用于预热"""
+    lines = [
+        f"2025-06-29 15:{minute:02d}:00 - 切换到窗口: 示例文档 {minute} - Visual Studio Code (应用: Code.exe)"
+        for minute in range(max(1, num_lines))
+    ]
+    return "用户活动序列:\n" + "\n".join(lines)
+
+def build_prompt_compiler() -> Optional[PromptCompiler]:
+    """创建提示分段编码器，校验其结果与整段编码一致，并记录两种方式的分词耗时"""
+    try:
+        compiler = PromptCompiler(tokenizer, SYSTEM_PROMPT, USER_HEADER, "<|eot_id|>" + ASSISTANT_HEADER,
+                                  max_lines=TOKEN_CACHE_SIZE)
+        samples = [(WARMUP_INSTRUCTION, build_warmup_input(n)) for n in WARMUP_SEQUENCE_LENGTHS or [10]]
+        if not compiler.verify(samples, build_prompt):
+            logger.warning("提示分段编码与整段编码结果不一致（分词器不兼容），将整段分词")
+            return None
+        timings = compiler.measure(samples, build_prompt)
+        logger.info(
+            f"提示分段编码已启用: 分词耗时 {timings['full_tokenize_ms']:.2f}ms -> "
+            f"{timings['compiled_tokenize_ms']:.2f}ms/条（缓存命中时）"
+        )
+        return compiler
+    except Exception as e:
+        logger.warning(f"创建提示分段编码器失败，将整段分词: {e}")
+        return None
+
+def _encode_compiled(requests: List[Tuple[str, str]], include_system: bool) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+    """用提示分段编码器拼接各行的token ID并左填充，返回 (input_ids, attention_mask)；有任一行无法拼接时返回 None"""
+    if prompt_compiler is None:
+        return None
+    rows = [prompt_compiler.compile(instruction, input_text, include_system) for instruction, input_text in requests]
+    if any(row is None for row in rows):
+        return None
+    width = max(len(row) for row in rows)
+    input_ids = torch.full((len(rows), width), tokenizer.pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+    for index, row in enumerate(rows):
+        input_ids[index, width - len(row):] = torch.tensor(row, dtype=torch.long)
+        attention_mask[index, width - len(row):] = 1
+    return input_ids.to(model.device), attention_mask.to(model.device)
+
+def build_prefix_cache():
+    """预计算固定系统提示的KV缓存，之后每个请求只需预填充用户部分"""
+    global prefix_cache
+    
+    try:
+        start = time.perf_counter()
+        prefix_cache = _compute_prefix_cache()
+        prefix_ids = prefix_cache["input_ids"]
+        logger.info(f"系统提示前缀KV缓存已就绪: {prefix_ids.shape[1]} tokens, 耗时 {(time.perf_counter() - start) * 1000:.1f}ms")
+    except Exception as e:
+        prefix_cache = None
+        logger.warning(f"构建前缀KV缓存失败，将使用完整预填充: {e}")
+
+class AdapterPool:
+    """常驻在同一个基础模型上的用户LoRA适配器池（LRU）
+    
+    请求通过 user_id 选择 ADAPTER_DIR/<user_id> 下的适配器，首次使用时加载，
+    常驻适配器的权重总量超过预算时淘汰最久未使用的（默认适配器不参与淘汰）。
+    批次内每行可以使用不同的适配器（PEFT 的 adapter_names 混合批推理）。
+    只在推理线程中调用，因此不需要加锁。
+    """
+    
+    USER_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+    
+    def __init__(self, adapter_dir: str = ADAPTER_DIR, memory_budget_mb: float = ADAPTER_MEMORY_MB):
+        self.adapter_dir = adapter_dir
+        self.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        self.resident = OrderedDict()  # 适配器名 -> {"user_id", "bytes", "prefix_cache"}
+        self.loads = 0
+        self.evictions = 0
+        self.hits = 0
+    
+    def adapter_path(self, user_id: str) -> Optional[str]:
+        """user_id 对应的适配器目录，不存在或 user_id 不合法时返回 None"""
+        if not self.USER_ID_PATTERN.match(user_id):
+            return None
+        path = os.path.join(self.adapter_dir, user_id)
+        return path if os.path.exists(os.path.join(path, "adapter_config.json")) else None
+    
+    def resident_bytes(self) -> int:
+        return sum(entry["bytes"] for entry in self.resident.values())
+    
+    def acquire(self, user_ids: List[Optional[str]]) -> List[str]:
+        """确保批次用到的适配器都已加载，返回每条请求实际使用的适配器名
+        
+        没有对应适配器的 user_id 回退到默认适配器。
+        """
+        adapter_names = []
+        for user_id in user_ids:
+            name = self._ensure_loaded(user_id) if user_id else None
+            adapter_names.append(name or DEFAULT_ADAPTER)
+        self._evict(keep=set(adapter_names))
+        return adapter_names
+    
+    def prefix_cache_for(self, adapter_name: str) -> Optional[Dict[str, Any]]:
+        if adapter_name == DEFAULT_ADAPTER:
+            return prefix_cache
+        entry = self.resident.get(adapter_name)
+        return entry["prefix_cache"] if entry is not None else None
+    
+    def _ensure_loaded(self, user_id: str) -> Optional[str]:
+        name = f"user_{user_id}"
+        if name in self.resident:
+            self.hits += 1
+            self.resident.move_to_end(name)
+            return name
+        
+        path = self.adapter_path(user_id)
+        if path is None:
+            logger.warning(f"未找到用户 {user_id} 的适配器，使用默认适配器")
+            return None
+        
+        start = time.perf_counter()
+        model.load_adapter(path, adapter_name=name)
+        size = sum(
+            param.numel() * param.element_size()
+            for param_name, param in model.named_parameters() if f".{name}." in param_name
+        )
+        entry = {"user_id": user_id, "bytes": size, "prefix_cache": None}
+        self.resident[name] = entry
+        if prefix_cache is not None:
+            entry["prefix_cache"] = _compute_prefix_cache(name)
+        self.loads += 1
+        logger.info(f"已加载用户适配器: {user_id} ({size / 1024 / 1024:.1f}MB, 耗时 {(time.perf_counter() - start) * 1000:.0f}ms)")
+        return name
+    
+    def _evict(self, keep: set):
+        """超出预算时按LRU顺序淘汰，当前批次要用的适配器不淘汰"""
+        evicted = False
+        for name in list(self.resident):
+            if self.resident_bytes() <= self.memory_budget_bytes:
+                break
+            if name in keep:
+                continue
+            entry = self.resident.pop(name)
+            model.delete_adapter(name)
+            self.evictions += 1
+            evicted = True
+            logger.info(f"淘汰用户适配器: {entry['user_id']} ({entry['bytes'] / 1024 / 1024:.1f}MB)")
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "adapter_dir": self.adapter_dir,
+            "resident": [entry["user_id"] for entry in self.resident.values()],
+            "resident_mb": round(self.resident_bytes() / 1024 / 1024, 1),
+            "memory_budget_mb": round(self.memory_budget_bytes / 1024 / 1024, 1),
+            "hits": self.hits,
+            "loads": self.loads,
+            "evictions": self.evictions
+        }
+
+class PrefillTimer(LogitsProcessor):
+    """记录首个生成步（即预填充完成）的时间点，不修改logits"""
+    
+    def __init__(self):
+        self.first_step_time = None
+    
+    def __call__(self, input_ids, scores):
+        if self.first_step_time is None:
+            self.first_step_time = time.perf_counter()
+        return scores
+
+# 预测行开头的时间戳；置信度只统计其后的动作部分（时间的秒数等几乎总是不确定，与是否预加载无关）
+TIMESTAMP_PREFIX_PATTERN = re.compile(r'^\s*\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\s*-')
+
+def action_confidence(pieces: List[str], log_probs: List[List[float]]) -> float:
+    """预测行动作部分按长度归一化的序列概率：exp(时间戳之后各token对数概率的平均值)
+    
+    即逐token概率的几何平均，较长的应用名或窗口标题不会因为token多而天然得分更低。
+    pieces 与 log_probs 一一对应（逐token，或流式时逐段文本及该段各token的对数概率）；
+    对数概率取自模型原始logits，未经温度、top_p 和受限解码处理。没有时间戳时统计整行。
+    """
+    start = 0
+    text = ""
+    for index, piece in enumerate(pieces):
+        text += piece
+        if TIMESTAMP_PREFIX_PATTERN.match(text):
+            start = index + 1
+            break
+        if len(text) > 32:
+            break
+    selected = [log_prob for group in log_probs[start:] for log_prob in group]
+    return math.exp(sum(selected) / len(selected)) if selected else 0.0
+
+class StepScoreRecorder(LogitsProcessor):
+    """记录当前生成步模型原始的对数概率分布，不修改logits
+    
+    温度和top_p在自定义处理器之后才应用，且本处理器排在语法约束之前，
+    因此记录的是未经温度、top_p和语法屏蔽的分布，与 action_confidence
+    使用的 output_logits 口径一致。
+    """
     
+    def __init__(self):
+        self.log_probs = None
+    
+    def __call__(self, input_ids, scores):
+        self.log_probs = torch.log_softmax(scores.float(), dim=-1)
+        return scores
+
+class CallbackStreamer(BaseStreamer):
+    """把单条生成的token增量解码为文本，连同每个token的对数概率交给 on_text
+    
+    generate 每一步先调用 logits 处理器再调用 put，因此 put 时 recorder 中
+    保存的正是本步token所在的分布，与 compute_transition_scores 的口径一致。
+    """
+    
+    def __init__(self, tokenizer, on_text: TextCallback):
+        self.tokenizer = tokenizer
+        self.on_text = on_text
+        self.recorder = StepScoreRecorder()
+        self.token_ids = []
+        self.pending_log_probs = []
+        self.emitted_length = 0
+        self.prompt_received = False
+    
+    def put(self, value):
+        # 第一次调用传入的是提示部分
+        if not self.prompt_received:
+            self.prompt_received = True
+            return
+        token_id = int(value.reshape(-1)[0])
+        self.token_ids.append(token_id)
+        if self.recorder.log_probs is not None:
+            self.pending_log_probs.append(float(self.recorder.log_probs[0, token_id]))
+        self._emit(final=False)
+    
+    def end(self):
+        self._emit(final=True)
+    
+    def _emit(self, final: bool):
+        text = self.tokenizer.decode(self.token_ids, skip_special_tokens=True)
+        # 多字节字符（中文、emoji）未解码完整时先不输出
+        if not final and text.endswith("\ufffd"):
+            return
+        delta = text[self.emitted_length:]
+        if delta or self.pending_log_probs:
+            self.on_text(delta, self.pending_log_probs)
+        self.emitted_length = len(text)
+        self.pending_log_probs = []
+
+def _cache_layers(cache) -> Optional[List[Tuple[torch.Tensor, torch.Tensor]]]:
+    """取出 DynamicCache 每层的 (key, value)，兼容不同版本的 transformers；无法取出时返回 None"""
+    if hasattr(cache, "layers"):
+        # transformers>=4.54：每层一个 DynamicLayer
+        layers = [(layer.keys, layer.values) for layer in cache.layers]
+    elif hasattr(cache, "key_cache"):
+        layers = list(zip(cache.key_cache, cache.value_cache))
+    else:
+        return None
+    if any(key is None or value is None for key, value in layers):
+        return None
+    return layers
+
+def _stack_prefix_caches(caches: List[Dict[str, Any]]) -> Optional[DynamicCache]:
+    """按行拼接不同适配器的前缀KV缓存（每个缓存的批大小为1）；当前版本不支持时返回 None，由调用方完整预填充"""
+    try:
+        per_cache = [_cache_layers(cache["past_key_values"]) for cache in caches]
+        if any(layers is None for layers in per_cache):
+            return None
+        stacked = DynamicCache()
+        for layer_idx in range(len(per_cache[0])):
+            stacked.update(
+                torch.cat([layers[layer_idx][0] for layers in per_cache]),
+                torch.cat([layers[layer_idx][1] for layers in per_cache]),
+                layer_idx
+            )
+        return stacked
+    except Exception as e:
+        logger.warning(f"拼接前缀KV缓存失败，改为完整预填充: {e}")
+        return None
+
+def _prepare_inputs(requests: List[Tuple[str, str]],
+                    adapter_names: Optional[List[str]] = None) -> Tuple[Dict[str, Any], int]:
+    """编码一批请求，返回 generate 的输入参数和复用的前缀token数
+    
+    adapter_names 给出每行使用的用户适配器，各行复用各自适配器的前缀KV缓存。
+    """
+    batch_size = len(requests)
+    row_caches = [prefix_cache] * batch_size
+    if adapter_names is not None:
+        row_caches = [adapter_pool.prefix_cache_for(name) for name in adapter_names]
+    
+    past_key_values = None
+    if all(cache is not None for cache in row_caches):
+        if all(cache is row_caches[0] for cache in row_caches):
+            past_key_values = copy.deepcopy(row_caches[0]["past_key_values"])
+            if batch_size > 1:
+                past_key_values.batch_repeat_interleave(batch_size)
+        else:
+            past_key_values = _stack_prefix_caches(row_caches)
+    
+    if past_key_values is not None:
+        # 只编码用户部分；左填充位于前缀和用户部分之间，由attention_mask屏蔽
+        compiled = _encode_compiled(requests, include_system=False)
+        if compiled is not None:
+            input_ids, attention_mask = compiled
+        else:
+            suffixes = [build_user_prompt(instruction, input_text) for instruction, input_text in requests]
+            encoded = tokenizer(suffixes, return_tensors="pt", padding=True, add_special_tokens=False).to(model.device)
+            input_ids, attention_mask = encoded.input_ids, encoded.attention_mask
+        
+        prefix_ids = prefix_cache["input_ids"].expand(batch_size, -1)
+        return {
+            "input_ids": torch.cat([prefix_ids, input_ids], dim=1),
+            "attention_mask": torch.cat([torch.ones_like(prefix_ids), attention_mask], dim=1),
+            "past_key_values": past_key_values
+        }, prefix_cache["length"]
+    
+    compiled = _encode_compiled(requests, include_system=True)
+    if compiled is not None:
+        return {"input_ids": compiled[0], "attention_mask": compiled[1]}, 0
+    
+    # 左填充后批量编码完整提示
+    prompts = [build_prompt(instruction, input_text) for instruction, input_text in requests]
+    encoded = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+    return {"input_ids": encoded.input_ids, "attention_mask": encoded.attention_mask}, 0
+
+def _build_generation_config() -> GenerationConfig:
+    """预测使用的生成参数"""
+    return GenerationConfig(
+        max_new_tokens=100,
+        do_sample=True,
+        temperature=0.7,
+        top_p=0.9,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        return_dict_in_generate=True,
+        # 原始logits（温度、top_p 之前）用于计算置信度；经 top_p 截断重新归一化后几乎每个采样token的概率都接近1
+        output_logits=True
+    )
+
+def _build_stopping_criteria(prompt_length: int) -> StoppingCriteriaList:
+    """预测使用的停止条件"""
+    stopping_criteria = StoppingCriteriaList()
+    if ENABLE_EARLY_STOP:
+        stopping_criteria.append(ActivityLineStoppingCriteria(tokenizer, prompt_length))
+    return stopping_criteria
+
+def _decode_rows(outputs, prompt_length: int, attention_mask: torch.Tensor) -> List[Dict[str, Any]]:
+    """解码 generate 的输出，并根据原始logits计算每行动作部分的对数概率（见 action_confidence）"""
+    transition_scores = model.compute_transition_scores(
+        outputs.sequences, outputs.logits, normalize_logits=True
+    )
+    rows = []
+    for row, sequence in enumerate(outputs.sequences):
+        # 只统计实际生成的token，忽略结束后的填充
+        count = count_generated_tokens(sequence, prompt_length, tokenizer.pad_token_id)
+        generated = sequence[prompt_length:prompt_length + count].tolist()
+        # 时间戳只占开头的十几个token，不必逐个解码整行
+        pieces = [tokenizer.decode([token_id]) for token_id in generated[:32]]
+        token_log_probs = [[log_prob] for log_prob in transition_scores[row, :count].float().tolist()]
+        confidence = action_confidence(pieces + [""] * (count - len(pieces)), token_log_probs)
+        log_prob = math.log(confidence) if confidence > 0 else float("-inf")
+        rows.append({
+            "text": tokenizer.decode(sequence[prompt_length:], skip_special_tokens=True).strip(),
+            "log_prob": log_prob,
+            "generated_tokens": count,
+            "prompt_tokens": int(attention_mask[row].sum())
+        })
+    return rows
+
+def _generate_standard(requests: List[Tuple[str, str]], on_text: Optional[TextCallback] = None,
+                       adapter_names: Optional[List[str]] = None,
+                       constrained: bool = False) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """所有行在一次批量 generate 中完成（复用系统提示前缀KV缓存）
+    
+    传入 on_text 时（只支持单条）边生成边回调增量文本；
+    传入 adapter_names 时每行使用各自的用户适配器；
+    constrained 为 True 时屏蔽不符合活动行格式的token。
+    """
+    start = time.perf_counter()
+    inputs, reused_tokens = _prepare_inputs(requests, adapter_names)
+    if adapter_names is not None:
+        inputs["adapter_names"] = adapter_names
+    prompt_length = inputs["input_ids"].shape[1]
+    tokenized = time.perf_counter()
+    
+    prefill_timer = PrefillTimer()
+    logits_processor = LogitsProcessorList([prefill_timer])
+    streamer = None
+    if on_text is not None:
+        # 排在受限解码之前，记录的是未经语法屏蔽的原始分布（温度和top_p在自定义处理器之后才应用）
+        streamer = CallbackStreamer(tokenizer, on_text)
+        logits_processor.append(streamer.recorder)
+    grammar_processor = None
+    if constrained:
+        stop_token_ids = {tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")}
+        grammar_processor = ActivityGrammarProcessor(
+            tokenizer, activity_grammar, prompt_length, stop_token_ids, top_candidates=GRAMMAR_TOP_CANDIDATES
+        )
+        logits_processor.append(grammar_processor)
+    with torch.no_grad():
+        outputs = model.generate(
+            **inputs,
+            generation_config=_build_generation_config(),
+            logits_processor=logits_processor,
+            stopping_criteria=_build_stopping_criteria(prompt_length),
+            streamer=streamer
+        )
+    
+    # 预填充不含分词耗时，分词单独计为 tokenize_ms
+    prefill_ms = ((prefill_timer.first_step_time or time.perf_counter()) - tokenized) * 1000
+    batch_metadata = {
+        "prefix_tokens_reused": reused_tokens,
+        "tokenize_ms": round((tokenized - start) * 1000, 2),
+        "prefill_ms": round(prefill_ms, 2),
+        "prefill_seconds": (tokenized - start) + prefill_ms / 1000,
+        "elapsed_seconds": time.perf_counter() - start
+    }
+    if grammar_processor is not None:
+        batch_metadata["constrained"] = True
+        batch_metadata["grammar_fallbacks"] = grammar_processor.fallbacks
+    return _decode_rows(outputs, prompt_length, inputs["attention_mask"]), batch_metadata
+
+def _generate_speculative(requests: List[Tuple[str, str]]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """辅助生成：草稿模型提出候选token，目标模型一次前向校验
+    
+    草稿模型与目标模型分词器不同，使用 transformers 的通用辅助解码
+    （generate 同时传入 tokenizer 和 assistant_tokenizer）。辅助生成只支持单条，
+    因此逐行执行，且不使用前缀KV缓存。
+    """
+    start = time.perf_counter()
+    counters = {"target": 0, "draft": 0}
+    hooks = [
+        _unwrap_model(model).register_forward_hook(lambda *args: counters.__setitem__("target", counters["target"] + 1)),
+        _unwrap_model(draft_model).register_forward_hook(lambda *args: counters.__setitem__("draft", counters["draft"] + 1))
+    ]
+    
+    rows = []
+    tokenize_seconds = 0.0
+    prefill_seconds = 0.0
+    try:
+        for instruction, input_text in requests:
+            tokenize_start = time.perf_counter()
+            inputs = tokenizer(build_prompt(instruction, input_text), return_tensors="pt").to(model.device)
+            prompt_length = inputs.input_ids.shape[1]
+            row_start = time.perf_counter()
+            tokenize_seconds += row_start - tokenize_start
+            
+            prefill_timer = PrefillTimer()
+            with torch.no_grad():
+                outputs = model.generate(
+                    **inputs,
+                    generation_config=_build_generation_config(),
+                    logits_processor=LogitsProcessorList([prefill_timer]),
+                    stopping_criteria=_build_stopping_criteria(prompt_length),
+                    assistant_model=draft_model,
+                    tokenizer=tokenizer,
+                    assistant_tokenizer=draft_tokenizer
+                )
+            
+            prefill_seconds += (prefill_timer.first_step_time or time.perf_counter()) - row_start
+            rows.extend(_decode_rows(outputs, prompt_length, inputs.attention_mask))
+    finally:
+        for hook in hooks:
+            hook.remove()
+    
+    # 每轮校验由目标模型前向一次，产出 (被接受的草稿token数 + 1) 个token
+    generated = sum(row["generated_tokens"] for row in rows)
+    accepted = max(generated - counters["target"], 0)
+    return rows, {
+        "prefix_tokens_reused": 0,
+        "tokenize_ms": round(tokenize_seconds * 1000 / max(len(requests), 1), 2),
+        "prefill_ms": round(prefill_seconds * 1000 / max(len(requests), 1), 2),
+        "prefill_seconds": tokenize_seconds + prefill_seconds,
+        "elapsed_seconds": time.perf_counter() - start,
+        "speculative": {
+            "draft_tokens": counters["draft"],
+            "accepted_tokens": accepted,
+            "target_forward_passes": counters["target"],
+            "accept_rate": round(accepted / counters["draft"], 4) if counters["draft"] else 0.0
+        }
+    }
+
+def _unwrap_model(wrapped):
+    """取出 PeftModel 包装下实际执行前向的模型"""
+    return wrapped.get_base_model() if isinstance(wrapped, PeftModel) else wrapped
+
+def _record_decode_speed(mode: str, generated_tokens: int, decode_seconds: float) -> float:
+    """累计各生成模式的解码速度，返回本次的 tokens/s"""
+    stats = decode_stats[mode]
+    stats["tokens"] += generated_tokens
+    stats["seconds"] += decode_seconds
+    tokens_per_second = generated_tokens / decode_seconds if decode_seconds > 0 else 0.0
+    TOKENS_PER_SECOND.set(tokens_per_second, mode=mode)
+    return tokens_per_second
+
+def get_decode_speed_summary() -> Dict[str, Any]:
+    """各生成模式的平均解码速度，以及辅助生成相对标准生成的加速比"""
+    summary = {}
+    for mode, stats in decode_stats.items():
+        summary[f"{mode}_tokens_per_second"] = round(stats["tokens"] / stats["seconds"], 2) if stats["seconds"] > 0 else 0.0
+    if summary["standard_tokens_per_second"] > 0 and summary["speculative_tokens_per_second"] > 0:
+        summary["speculative_speedup"] = round(
+            summary["speculative_tokens_per_second"] / summary["standard_tokens_per_second"], 3
+        )
+    return summary
+
+def _assemble_results(num_requests: int, top_k: int, rows: List[Dict[str, Any]],
+                      batch_metadata: Dict[str, Any], tokens_per_second: float,
+                      adapters: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """把按请求展开的生成行（每条请求 top_k 行）整理为各请求的预测结果
+    
+    adapters 给出时在各请求的 metadata 中记录实际使用的适配器。
+    """
+    results = []
+    for index in range(num_requests):
+        request_rows = rows[index * top_k:(index + 1) * top_k]
+        
+        # 合并文本相同的候选，保留概率最高的一条
+        candidates = {}
+        for row in request_rows:
+            probability = math.exp(row["log_prob"]) if row["log_prob"] > float("-inf") else 0.0
+            candidate = candidates.setdefault(row["text"], {
+                "prediction": row["text"],
+                "probability": 0.0,
+                "samples": 0
+            })
+            candidate["probability"] = round(max(candidate["probability"], probability), 4)
+            candidate["samples"] += 1
+        ranked = sorted(candidates.values(), key=lambda c: c["probability"], reverse=True)
+        best = ranked[0]
+        
+        results.append({
+            "prediction": best["prediction"],
+            "confidence": best["probability"],
+            "timestamp": datetime.now().isoformat(),
+            "candidates": ranked,
+            "metadata": {
+                "batch_size": num_requests,
+                "prompt_tokens": request_rows[0]["prompt_tokens"],
+                "generated_tokens": sum(row["generated_tokens"] for row in request_rows),
+                "tokens_per_second": round(tokens_per_second, 2),
+                **batch_metadata
+            }
+        })
+        if adapters is not None:
+            results[-1]["metadata"]["adapter"] = adapters[index]
+    
+    return results
+
+def generate_batch(requests: List[Tuple[str, str]], top_k: int = 1, speculative: bool = False,
+                   on_text: Optional[TextCallback] = None,
+                   user_ids: Optional[List[Optional[str]]] = None,
+                   constrained: bool = False) -> List[Dict[str, Any]]:
+    """对一批 (instruction, input) 执行生成，按顺序返回每条的预测结果
+    
+    top_k > 1 时每条请求采样 top_k 条候选，按动作部分归一化的序列概率（见 action_confidence）排序。
+    speculative 为 True 且草稿模型已加载时使用辅助生成。
+    on_text 用于流式预测（单条、top_k=1，不使用辅助生成）。
+    user_ids 与 requests 一一对应，选择各条请求的用户适配器（None 为默认适配器）。
+    constrained 为 True 时使用受限解码（不使用辅助生成）。
+    """
     if model is None or tokenizer is None:
         raise HTTPException(status_code=500, detail="模型未加载")
     
     try:
-        # 构建提示
-        system_prompt = (
-            "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n"
-            "Cutting Knowledge Date: December 2023\n"
-            "Today Date: 26 Jul 2024\n\n"
-            "你是一个智能助手，请根据用户最近的活动序列，预测下一个最有可能的用户活动。请确保输出格式与输入格式一致，应为\"时间 - 操作\"的形式。\n"
-            "<|eot_id|>"
-        )
+        # 每条请求复制 top_k 行，与其它请求一起生成
+        expanded = [request for request in requests for _ in range(top_k)]
         
-        user_prompt = (
-            "<|start_header_id|>user<|end_header_id|>\n\n"
-            f"{instruction}\n{input_text}"
-            "<|eot_id|>"
+        adapters = None
+        if user_ids and any(user_ids) and adapter_pool is not None:
+            adapters = adapter_pool.acquire(user_ids)
+        # 全部使用默认适配器时不传 adapter_names，走原来的路径
+        row_adapters = None
+        if adapters is not None and any(name != DEFAULT_ADAPTER for name in adapters):
+            row_adapters = [name for name in adapters for _ in range(top_k)]
+        
+        use_speculative = (speculative and draft_model is not None and on_text is None
+                           and row_adapters is None and not constrained)
+        if use_speculative:
+            rows, batch_metadata = _generate_speculative(expanded)
+        else:
+            rows, batch_metadata = _generate_standard(expanded, on_text, row_adapters, constrained)
+        
+        # 解码速度按整批计算（总耗时减去预填充）
+        total_tokens = sum(row["generated_tokens"] for row in rows)
+        decode_seconds = batch_metadata.pop("elapsed_seconds") - batch_metadata.pop("prefill_seconds")
+        batch_metadata["decode_ms"] = round(decode_seconds * 1000, 2)
+        tokens_per_second = _record_decode_speed(
+            "speculative" if use_speculative else "standard", total_tokens, decode_seconds
         )
+        if tokens_per_second > 0:
+            logger.info(f"解码延迟: {1000 / tokens_per_second:.1f} ms/token ({total_tokens} tokens, 模型格式: {model_format})")
         
-        assistant_prompt = "<|start_header_id|>assistant<|end_header_id|>\n\n"
+        return _assemble_results(len(requests), top_k, rows, batch_metadata, tokens_per_second, adapters)
         
-        prompt = system_prompt + user_prompt + assistant_prompt
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"生成预测时出错: {e}")
+        raise HTTPException(status_code=500, detail=f"预测生成失败: {str(e)}")
+
+class InferenceBackend:
+    """推理后端接口
+    
+    api.py 的批处理、缓存和接口层只依赖这几个方法，
+    不同的推理实现（transformers / llama.cpp）通过 MEMO_BACKEND 选择。
+    """
+    
+    name = "base"
+    
+    def load(self) -> bool:
+        """加载模型，成功返回 True"""
+        raise NotImplementedError
+    
+    def is_loaded(self) -> bool:
+        raise NotImplementedError
+    
+    def generate_batch(self, requests: List[Tuple[str, str]], top_k: int = 1, **options) -> List[Dict[str, Any]]:
+        """对一批 (instruction, input) 生成预测，结果格式与 PredictionResponse 一致"""
+        raise NotImplementedError
+    
+    def generate_stream(self, instruction: str, input_text: str, on_text: TextCallback,
+                        user_id: Optional[str] = None, **options) -> Dict[str, Any]:
+        """生成单条预测，生成过程中通过 on_text 回调增量文本，返回完整结果"""
+        if user_id:
+            options["user_ids"] = [user_id]
+        return self.generate_batch([(instruction, input_text)], on_text=on_text, **options)[0]
+    
+    def info(self) -> Dict[str, Any]:
+        """后端信息，用于 /model_info"""
+        return {"backend": self.name}
+    
+    def memory_bytes(self) -> int:
+        """模型权重占用的字节数，用于 /metrics"""
+        return 0
+    
+    # 是否真正批量生成；逐条生成的后端不需要按最大批大小预热
+    supports_batching = True
+    # 是否按 user_id 选择适配器；不支持时 user_id 被忽略，也不参与缓存键
+    supports_user_adapters = False
+    
+    def warmup(self):
+        """用代表性长度的提示各生成一次，提前付清首个请求的一次性开销
         
-        # 生成回答
-        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        （CUDA内核加载、显存分配器扩容、llama.cpp 的首次计算图构建等）
+        """
+        longest = build_warmup_input(max(WARMUP_SEQUENCE_LENGTHS))
+        for num_lines in WARMUP_SEQUENCE_LENGTHS:
+            start = time.perf_counter()
+            self.generate_batch([(WARMUP_INSTRUCTION, build_warmup_input(num_lines))])
+            logger.info(f"预热: {num_lines} 条活动, 耗时 {(time.perf_counter() - start) * 1000:.0f}ms")
+        if self.supports_batching and MAX_BATCH_SIZE > 1:
+            start = time.perf_counter()
+            self.generate_batch([(WARMUP_INSTRUCTION, longest)] * MAX_BATCH_SIZE)
+            logger.info(f"预热: 批大小 {MAX_BATCH_SIZE}, 耗时 {(time.perf_counter() - start) * 1000:.0f}ms")
+        # 预热的耗时不计入解码速度统计
+        for stats in decode_stats.values():
+            stats["tokens"] = 0
+            stats["seconds"] = 0.0
+
+class TransformersBackend(InferenceBackend):
+    """transformers + PEFT 后端（GPU服务器，支持批量生成、前缀缓存和辅助生成）"""
+    
+    name = "transformers"
+    
+    def load(self) -> bool:
+        return load_model()
+    
+    def is_loaded(self) -> bool:
+        return model is not None and tokenizer is not None
+    
+    @property
+    def supports_user_adapters(self) -> bool:
+        # 合并模型和量化模式不启用适配器池
+        return adapter_pool is not None
+    
+    def generate_batch(self, requests: List[Tuple[str, str]], top_k: int = 1, **options) -> List[Dict[str, Any]]:
+        return generate_batch(requests, top_k=top_k, **options)
+    
+    def info(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "base_model_path": BASE_MODEL_PATH,
+            "fine_tuned_model_path": FINE_TUNED_MODEL_PATH,
+            "merged_model_path": MERGED_MODEL_PATH,
+            "model_format": model_format,
+            "quantization": QUANTIZATION,
+            "model_load_seconds": round(model_load_seconds, 2),
+            "model_loaded": model is not None,
+            "tokenizer_loaded": tokenizer is not None,
+            "prefix_cache_tokens": prefix_cache["length"] if prefix_cache is not None else 0,
+            "prompt_compiler": prompt_compiler.stats() if prompt_compiler is not None else None,
+            "draft_model_path": DRAFT_MODEL_PATH,
+            "draft_model_loaded": draft_model is not None,
+            "adapter_pool": adapter_pool.stats() if adapter_pool is not None else None
+        }
+    
+    def memory_bytes(self) -> int:
+        total = 0
+        for loaded in (model, draft_model):
+            if loaded is not None:
+                total += loaded.get_memory_footprint()
+        return total
+
+class LlamaCppBackend(InferenceBackend):
+    """llama.cpp 后端：在无GPU的Linux机器上用CPU运行量化后的GGUF模型
+    
+    GGUF 由合并后的模型（merge_adapter.py 的输出）经 llama.cpp 的
+    convert_hf_to_gguf.py 转换并量化得到。llama.cpp 不支持批量采样，
+    批次内的请求逐条生成；辅助生成参数会被忽略。
+    """
+    
+    name = "llamacpp"
+    supports_batching = False
+    
+    def __init__(self, model_path: str = GGUF_MODEL_PATH, n_threads: int = CPU_THREADS, n_ctx: int = GGUF_CONTEXT_SIZE):
+        self.model_path = model_path
+        self.n_threads = n_threads
+        self.n_ctx = n_ctx
+        self.llm = None
+        self.grammar = None
+        self.load_seconds = 0.0
+    
+    def load(self) -> bool:
+        if Llama is None:
+            load_state["last_error"] = "未安装 llama-cpp-python"
+            logger.error("未安装 llama-cpp-python，无法使用 llamacpp 后端 (pip install llama-cpp-python)")
+            return False
+        try:
+            start = time.perf_counter()
+            load_state["stage"] = "GGUF模型"
+            logger.info(f"开始加载GGUF模型: {self.model_path} (线程数: {self.n_threads})")
+            self.llm = Llama(
+                model_path=self.model_path,
+                n_threads=self.n_threads,
+                n_ctx=self.n_ctx,
+                logits_all=True,  # 计算候选概率需要每个生成token的logprob
+                verbose=False
+            )
+            self.load_seconds = time.perf_counter() - start
+            logger.info(f"GGUF模型加载完成，耗时 {self.load_seconds:.1f}s")
+            # 受限解码使用 llama.cpp 自带的GBNF语法采样，格式与 activity_grammar 相同
+            self.grammar = LlamaGrammar.from_string(build_activity_gbnf(activity_grammar.apps), verbose=False)
+            return True
+        except Exception as e:
+            self.llm = None
+            load_state["last_error"] = str(e)
+            logger.error(f"GGUF模型加载失败: {e}")
+            return False
+    
+    def is_loaded(self) -> bool:
+        return self.llm is not None
+    
+    def _activity_line_stop(self, prompt_length: int):
+        """与 ActivityLineStoppingCriteria 相同的提前停止规则（llama.cpp 版本）"""
+        def should_stop(input_ids, logits) -> bool:
+            if not ENABLE_EARLY_STOP:
+                return False
+            last_token = self.llm.detokenize([int(input_ids[-1])]).decode("utf-8", errors="ignore")
+            if "\n" not in last_token:
+                return False
+            text = self.llm.detokenize([int(t) for t in input_ids[prompt_length:]]).decode("utf-8", errors="ignore")
+            return any(ACTIVITY_LINE_PATTERN.match(line.strip()) for line in text.split("\n")[:-1])
+        return should_stop
+    
+    def _generate_row(self, instruction: str, input_text: str, on_text: Optional[TextCallback] = None,
+                      constrained: bool = False) -> Tuple[Dict[str, Any], float, float]:
+        """生成一行，返回 (生成行, 分词耗时秒, 预填充耗时秒)"""
+        prompt = build_prompt(instruction, input_text)
+        tokenize_start = time.perf_counter()
+        prompt_length = len(self.llm.tokenize(prompt.encode("utf-8"), special=True))
         
-        generation_config = GenerationConfig(
-            max_new_tokens=100,
-            do_sample=True,
+        start = time.perf_counter()
+        first_chunk_time = None
+        text_parts = []
+        token_logprobs = []
+        chunk_logprob_groups = []
+        for chunk in self.llm.create_completion(
+            prompt,
+            max_tokens=100,
             temperature=0.7,
             top_p=0.9,
-            pad_token_id=tokenizer.pad_token_id,
-            eos_token_id=tokenizer.eos_token_id
+            logprobs=1,
+            stop=["<|eot_id|>"],
+            stopping_criteria=LlamaStoppingCriteriaList([self._activity_line_stop(prompt_length)]),
+            grammar=self.grammar if constrained else None,
+            stream=True
+        ):
+            if first_chunk_time is None:
+                first_chunk_time = time.perf_counter()
+            choice = chunk["choices"][0]
+            text_parts.append(choice.get("text", ""))
+            logprobs = choice.get("logprobs") or {}
+            chunk_logprobs = [lp for lp in logprobs.get("token_logprobs", []) if lp is not None]
+            token_logprobs.extend(chunk_logprobs)
+            chunk_logprob_groups.append(chunk_logprobs)
+            if on_text is not None:
+                on_text(choice.get("text", ""), chunk_logprobs)
+        
+        # llama.cpp 的 logprobs 由采样前的原始logits计算，与 transformers 后端口径一致
+        confidence = action_confidence(text_parts, chunk_logprob_groups) if token_logprobs else 0.0
+        log_prob = math.log(confidence) if confidence > 0 else float("-inf")
+        return {
+            "text": "".join(text_parts).strip(),
+            "log_prob": log_prob,
+            "generated_tokens": len(token_logprobs),
+            "prompt_tokens": prompt_length
+        }, start - tokenize_start, (first_chunk_time or time.perf_counter()) - start
+    
+    def generate_batch(self, requests: List[Tuple[str, str]], top_k: int = 1,
+                       on_text: Optional[TextCallback] = None, constrained: bool = False,
+                       **options) -> List[Dict[str, Any]]:
+        if self.llm is None:
+            raise HTTPException(status_code=500, detail="模型未加载")
+        
+        try:
+            start = time.perf_counter()
+            rows = []
+            tokenize_seconds = 0.0
+            prefill_seconds = 0.0
+            for instruction, input_text in requests:
+                for _ in range(top_k):
+                    row, row_tokenize, row_prefill = self._generate_row(instruction, input_text, on_text, constrained)
+                    rows.append(row)
+                    tokenize_seconds += row_tokenize
+                    prefill_seconds += row_prefill
+            
+            total_tokens = sum(row["generated_tokens"] for row in rows)
+            decode_seconds = time.perf_counter() - start - tokenize_seconds - prefill_seconds
+            tokens_per_second = _record_decode_speed("standard", total_tokens, decode_seconds)
+            batch_metadata = {
+                "prefix_tokens_reused": 0,
+                "tokenize_ms": round(tokenize_seconds * 1000 / max(len(rows), 1), 2),
+                "prefill_ms": round(prefill_seconds * 1000 / max(len(rows), 1), 2),
+                "decode_ms": round(decode_seconds * 1000, 2)
+            }
+            if constrained:
+                batch_metadata["constrained"] = True
+            return _assemble_results(len(requests), top_k, rows, batch_metadata, tokens_per_second)
+        
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"生成预测时出错: {e}")
+            raise HTTPException(status_code=500, detail=f"预测生成失败: {str(e)}")
+    
+    def info(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "gguf_model_path": self.model_path,
+            "n_threads": self.n_threads,
+            "n_ctx": self.n_ctx,
+            "model_load_seconds": round(self.load_seconds, 2),
+            "model_loaded": self.llm is not None
+        }
+    
+    def memory_bytes(self) -> int:
+        # llama.cpp 以 mmap 方式加载GGUF，权重占用约等于文件大小
+        if self.llm is None or not os.path.exists(self.model_path):
+            return 0
+        return os.path.getsize(self.model_path)
+
+class MockBackend(InferenceBackend):
+    """确定性的模拟后端：不加载模型，按配置的合成延迟返回预测
+    
+    预测为输入中最后一条活动的时间戳加上固定间隔，相同输入总是得到相同结果。
+    延迟模拟批量生成：每批一次预填充，之后每个解码步对整批耗时相同，
+    因此可以在普通Linux机器上观察批处理、缓存和排队的效果。
+    """
+    
+    name = "mock"
+    supports_user_adapters = True
+    
+    ACTIVITY_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - (.+)')
+    
+    def __init__(self, prefill_ms: float = MOCK_PREFILL_MS, token_latency_ms: float = MOCK_TOKEN_LATENCY_MS,
+                 generated_tokens: int = MOCK_GENERATED_TOKENS):
+        self.prefill_ms = prefill_ms
+        self.token_latency_ms = token_latency_ms
+        self.generated_tokens = max(1, generated_tokens)
+        self.loaded = False
+    
+    def load(self) -> bool:
+        self.loaded = True
+        logger.info(
+            f"使用mock后端: 预填充={self.prefill_ms}ms, 每token={self.token_latency_ms}ms, "
+            f"生成token数={self.generated_tokens}"
         )
+        return True
+    
+    def is_loaded(self) -> bool:
+        return self.loaded
+    
+    def _predict_row(self, input_text: str, rank: int) -> Dict[str, Any]:
+        """第 rank 个候选：最后一条活动的时间往后推 (rank + 1) 分钟"""
+        matches = self.ACTIVITY_PATTERN.findall(input_text)
+        if matches:
+            timestamp, action = matches[-1]
+            next_time = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S') + timedelta(minutes=rank + 1)
+            text = f"{next_time.strftime('%Y-%m-%d %H:%M:%S')} - {action.strip()}"
+        else:
+            text = ""
+        return {
+            "text": text,
+            "log_prob": math.log(0.8 / (rank + 1)),
+            "generated_tokens": self.generated_tokens,
+            # 粗略按每2个字符1个token估算
+            "prompt_tokens": len(build_prompt("", input_text)) // 2
+        }
+    
+    def generate_batch(self, requests: List[Tuple[str, str]], top_k: int = 1,
+                       on_text: Optional[TextCallback] = None,
+                       user_ids: Optional[List[Optional[str]]] = None, **options) -> List[Dict[str, Any]]:
+        rows = [self._predict_row(input_text, rank) for _, input_text in requests for rank in range(top_k)]
+        # 只记录各请求对应的适配器名，不模拟适配器加载
+        adapters = [f"user_{user_id}" if user_id else DEFAULT_ADAPTER for user_id in user_ids] if user_ids else None
+        
+        time.sleep(self.prefill_ms / 1000)
+        decode_seconds = self.generated_tokens * self.token_latency_ms / 1000
+        if on_text is None:
+            time.sleep(decode_seconds)
+        else:
+            # 流式时把第一行文本均分到各个解码步输出；log_prob 已是每token的平均对数概率
+            text = rows[0]["text"]
+            chunk_size = math.ceil(len(text) / self.generated_tokens) or 1
+            for step in range(self.generated_tokens):
+                time.sleep(self.token_latency_ms / 1000)
+                on_text(text[step * chunk_size:(step + 1) * chunk_size], [rows[0]["log_prob"]])
+        
+        tokens_per_second = _record_decode_speed("standard", sum(row["generated_tokens"] for row in rows), decode_seconds)
+        return _assemble_results(len(requests), top_k, rows, {
+            "prefix_tokens_reused": 0,
+            "tokenize_ms": 0.0,
+            "prefill_ms": self.prefill_ms,
+            "decode_ms": round(decode_seconds * 1000, 2)
+        }, tokens_per_second, adapters)
+    
+    def info(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "mock_prefill_ms": self.prefill_ms,
+            "mock_token_latency_ms": self.token_latency_ms,
+            "mock_generated_tokens": self.generated_tokens,
+            "model_loaded": self.loaded
+        }
+
+BACKENDS = {
+    TransformersBackend.name: TransformersBackend,
+    LlamaCppBackend.name: LlamaCppBackend,
+    MockBackend.name: MockBackend
+}
+
+def create_backend(name: str = BACKEND) -> InferenceBackend:
+    """按名称创建推理后端"""
+    if name not in BACKENDS:
+        raise ValueError(f"未知的推理后端: {name}，可选: {list(BACKENDS)}")
+    return BACKENDS[name]()
+
+def generate_prediction(instruction: str, input_text: str, **options) -> Dict[str, Any]:
+    """生成单条预测结果"""
+    return backend.generate_batch([(instruction, input_text)], **options)[0]
+
+class SharedDeadline:
+    """同一次生成的截止时间，由等待该结果的所有调用方共享，取其中最宽松的一个（任一调用方不设截止时间则为 None）"""
+    
+    def __init__(self, deadline: Optional[float] = None):
+        self.value = deadline
+    
+    def extend(self, deadline: Optional[float]):
+        if self.value is not None and (deadline is None or deadline > self.value):
+            self.value = deadline
+
+class MicroBatcher:
+    """动态微批处理调度器
+    
+    在 max_wait_ms 时间窗口内（或凑满 max_batch_size 条）收集并发的预测请求，
+    合并为一次批量生成，再把结果分发给各自的调用方。
+    
+    生成本身在专用的单线程推理执行器中运行，事件循环只负责排队和分发，
+    因此推理期间 /health 等接口仍可立即响应。
+    
+    请求可带截止时间：开始生成前已过期的请求直接丢弃（客户端已放弃等待）；
+    队列已满或预估排队时间超过上限/截止时间的新请求在入队前拒绝（503 + Retry-After）。
+    """
+    
+    def __init__(self, max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: float = MAX_BATCH_WAIT_MS,
+                 max_queue_size: int = MAX_QUEUE_SIZE, max_estimated_wait_ms: float = MAX_ESTIMATED_WAIT_MS):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.max_queue_size = max(1, max_queue_size)
+        self.max_estimated_wait = max(0.0, max_estimated_wait_ms) / 1000.0
+        self.queue = None
+        self.worker = None
+        self.executor = None
+        # 最近批次耗时的指数滑动平均，用于估算新请求的排队时间
+        self.batch_seconds = 0.0
+        # 当前批次开始生成的时间，空闲时为 None
+        self.batch_started = None
+        self.shed = {"queue_full": 0, "estimated_wait": 0, "deadline": 0}
+        self.expired = 0
+    
+    def start(self):
+        """启动后台调度任务（需在事件循环内调用）"""
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self.worker = asyncio.create_task(self._run())
+        logger.info(
+            f"批处理调度器已启动: max_batch_size={self.max_batch_size}, "
+            f"max_wait={self.max_wait * 1000:.1f}ms, max_queue_size={self.max_queue_size}"
+        )
+    
+    async def stop(self):
+        """停止后台调度任务和推理执行器"""
+        if self.worker:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+    
+    def queue_depth(self) -> int:
+        """当前排队等待的请求数"""
+        return self.queue.qsize() if self.queue is not None else 0
+    
+    def estimated_wait(self) -> float:
+        """新请求开始生成前预计的排队时间（秒）：当前批次的剩余时间 + 前面排满的批次数 × 最近批次的平均耗时"""
+        wait = (self.queue_depth() // self.max_batch_size) * self.batch_seconds
+        if self.batch_started is not None:
+            wait += max(0.0, self.batch_seconds - (time.perf_counter() - self.batch_started))
+        return wait
+    
+    def admit(self, deadline: Optional[float] = None):
+        """入队前的准入检查，过载时抛出 503，Retry-After 为预估的排队时间"""
+        wait = self.estimated_wait()
+        if self.queue_depth() >= self.max_queue_size:
+            reason, detail = "queue_full", "推理队列已满，请稍后重试"
+        elif self.max_estimated_wait and wait > self.max_estimated_wait:
+            reason, detail = "estimated_wait", f"预计排队 {wait:.1f}s，超过上限，请稍后重试"
+        # 排队时间之外再加上本请求所在批次自身的生成时间
+        elif deadline is not None and time.perf_counter() + wait + self.batch_seconds > deadline:
+            reason, detail = "deadline", f"预计排队 {wait:.1f}s，无法在截止时间前完成"
+        else:
+            return
+        self.shed[reason] += 1
+        REQUESTS_SHED.inc(reason=reason)
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(max(1, math.ceil(wait)))})
+    
+    def _count_expired(self):
+        self.expired += 1
+        REQUESTS_EXPIRED.inc()
+    
+    def _drop_expired(self, jobs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """丢弃已超过截止时间的请求，返回仍需生成的请求"""
+        now = time.perf_counter()
+        live = []
+        for job in jobs:
+            if job["deadline"].value is not None and now >= job["deadline"].value:
+                self._count_expired()
+                if not job["future"].done():
+                    job["future"].set_exception(HTTPException(status_code=504, detail="请求已超过截止时间"))
+            else:
+                live.append(job)
+        return live
+    
+    def stats(self) -> Dict[str, Any]:
+        """过载保护统计"""
+        return {
+            "max_estimated_wait_ms": self.max_estimated_wait * 1000,
+            "estimated_wait_ms": round(self.estimated_wait() * 1000, 2),
+            "avg_batch_ms": round(self.batch_seconds * 1000, 2),
+            "shed": dict(self.shed),
+            "expired": self.expired
+        }
+    
+    def run_exclusive(self, func: Callable[[], Any], deadline: Optional[float] = None) -> Awaitable[Any]:
+        """在推理执行器中单独运行一次生成（如流式预测），与批次依次执行，不会并发占用模型
+        
+        轮到执行时已超过 deadline 则不再生成，返回 504。
+        """
+        loop = asyncio.get_running_loop()
+        
+        def run():
+            if deadline is not None and time.perf_counter() >= deadline:
+                loop.call_soon_threadsafe(self._count_expired)
+                raise HTTPException(status_code=504, detail="请求已超过截止时间")
+            return func()
+        
+        return loop.run_in_executor(self.executor, run)
+    
+    async def submit(self, instruction: str, input_text: str, user_id: Optional[str] = None,
+                     deadline: Optional[Union[float, SharedDeadline]] = None, **options) -> Dict[str, Any]:
+        """提交一条请求并等待其所在批次的生成结果
+        
+        options 会原样传给 generate_batch；生成参数不同的请求在同一批次内分组生成。
+        user_id 不参与分组，不同用户（适配器）的请求在同一次生成中完成。
+        deadline 为 time.perf_counter() 时间，开始生成前已过期时返回 504；
+        传入 SharedDeadline 时按生成开始前的最新值判断（其它调用方加入后可能放宽）。
+        """
+        if not isinstance(deadline, SharedDeadline):
+            deadline = SharedDeadline(deadline)
+        self.admit(deadline.value)
+        job = {
+            "instruction": instruction,
+            "input": input_text,
+            "user_id": user_id,
+            "options": options,
+            "deadline": deadline,
+            "future": asyncio.get_running_loop().create_future(),
+            "enqueue_time": time.perf_counter()
+        }
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="推理队列已满，请稍后重试")
+        return await job["future"]
+    
+    async def _collect(self) -> List[Dict[str, Any]]:
+        """以第一条请求的到达时间为起点，收集一个批次"""
+        batch = [await self.queue.get()]
+        deadline = batch[0]["enqueue_time"] + self.max_wait
+        
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                # 窗口已过，只取走已经排队的请求
+                if self.queue.empty():
+                    break
+                batch.append(self.queue.get_nowait())
+                continue
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
         
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                generation_config=generation_config
+        return batch
+    
+    async def _run(self):
+        """调度主循环"""
+        while True:
+            batch = await self._collect()
+            # 跳过已被取消的请求（客户端断开）和已超过截止时间的请求
+            batch = self._drop_expired([job for job in batch if not job["future"].done()])
+            if not batch:
+                continue
+            
+            start = time.perf_counter()
+            wait_ms = (start - batch[0]["enqueue_time"]) * 1000
+            BATCH_SIZE.observe(len(batch))
+            for job in batch:
+                QUEUE_WAIT.observe(start - job["enqueue_time"])
+            
+            # 按生成参数分组，每组一次批量生成
+            groups = {}
+            for job in batch:
+                groups.setdefault(tuple(sorted(job["options"].items())), []).append(job)
+            
+            generated_tokens = []
+            self.batch_started = start
+            for options, jobs in groups.items():
+                # 前面的分组生成期间可能有请求过期
+                jobs = self._drop_expired(jobs)
+                if not jobs:
+                    continue
+                options = dict(options)
+                if any(job["user_id"] for job in jobs):
+                    options["user_ids"] = [job["user_id"] for job in jobs]
+                try:
+                    results = await asyncio.get_running_loop().run_in_executor(
+                        self.executor,
+                        functools.partial(
+                            backend.generate_batch,
+                            [(job["instruction"], job["input"]) for job in jobs],
+                            **options
+                        )
+                    )
+                    for job, result in zip(jobs, results):
+                        if not job["future"].done():
+                            job["future"].set_result(result)
+                    generated_tokens.extend(r["metadata"]["generated_tokens"] for r in results)
+                except Exception as e:
+                    for job in jobs:
+                        if not job["future"].done():
+                            job["future"].set_exception(e)
+            
+            self.batch_started = None
+            elapsed = time.perf_counter() - start
+            self.batch_seconds = elapsed if self.batch_seconds == 0 else 0.8 * self.batch_seconds + 0.2 * elapsed
+            
+            avg_tokens = sum(generated_tokens) / len(generated_tokens) if generated_tokens else 0.0
+            logger.info(
+                f"批处理完成: batch_size={len(batch)}, 分组={len(groups)}, 等待={wait_ms:.1f}ms, "
+                f"生成={elapsed * 1000:.1f}ms, 平均生成token数={avg_tokens:.1f}"
             )
+
+class PredictionCache:
+    """预测结果缓存（LRU + TTL）
+    
+    缓存键为 instruction 加上去掉（或按时间分桶）时间戳后的活动序列，
+    这样客户端重复发送相同的活动窗口时可以直接命中。
+    相同键的请求在首个请求生成期间到达时，会等待同一个生成任务（single-flight），
+    而不是重复排队推理。
+    """
+    
+    TIMESTAMP_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2}) (\d{2}):(\d{2}):(\d{2})')
+    
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, ttl_seconds: float = CACHE_TTL_SECONDS,
+                 time_bucket_seconds: int = CACHE_TIME_BUCKET_SECONDS):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.time_bucket_seconds = time_bucket_seconds
+        self.entries = OrderedDict()  # key -> (过期时间, 结果)
+        self.inflight = {}  # key -> (asyncio.Task, SharedDeadline)
+        self.hits = 0
+        self.misses = 0
+        self.inflight_joins = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+    
+    def _normalize_timestamp(self, match: re.Match) -> str:
+        if self.time_bucket_seconds <= 0:
+            return "<time>"
+        date, hour, minute, second = match.groups()
+        seconds = int(hour) * 3600 + int(minute) * 60 + int(second)
+        return f"{date}#{seconds // self.time_bucket_seconds}"
+    
+    def make_key(self, instruction: str, input_text: str, variant: str = "") -> str:
+        """生成缓存键，variant 用于区分影响输出的请求参数（如 top_k）"""
+        normalized_lines = [
+            self.TIMESTAMP_PATTERN.sub(self._normalize_timestamp, line.strip())
+            for line in input_text.strip().splitlines() if line.strip()
+        ]
+        return variant + "\n" + instruction.strip() + "\n" + "\n".join(normalized_lines)
+    
+    def get(self, key: str) -> Any:
+        """读取未过期的缓存项，命中时移到LRU末尾"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expire_at, result = entry
+        if time.monotonic() >= expire_at:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return result
+    
+    def put(self, key: str, result: Any):
+        """写入缓存，超出容量时淘汰最久未使用的项"""
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def lookup(self, instruction: str, input_text: str, variant: str = "") -> Tuple[str, Any]:
+        """直接查询缓存并计入命中统计，返回 (缓存键, 结果或None)；用于不经过 get_or_compute 的流式预测"""
+        key = self.make_key(instruction, input_text, variant)
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return key, cached
+    
+    async def get_or_compute(self, instruction: str, input_text: str,
+                             compute: Callable[[SharedDeadline], Awaitable[Dict[str, Any]]],
+                             variant: str = "", deadline: Optional[float] = None) -> Tuple[Dict[str, Any], str]:
+        """返回 (结果, 缓存状态)，缓存状态为 hit / inflight / miss
         
-        response = tokenizer.decode(
-            outputs[0][inputs.input_ids.shape[1]:], 
-            skip_special_tokens=True
-        ).strip()
+        相同请求共享一次计算：compute 收到的截止时间是所有等待者中最宽松的一个，
+        每个调用方再按自己的 deadline 单独超时（504），不会因先到的请求截止时间更紧而一起失败。
+        """
+        if not self.enabled:
+            return await compute(SharedDeadline(deadline)), "disabled"
         
-        # 计算简单的置信度（基于响应长度和格式匹配）
-        confidence = calculate_confidence(response)
+        key = self.make_key(instruction, input_text, variant)
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached, "hit"
         
+        inflight = self.inflight.get(key)
+        if inflight is not None:
+            self.inflight_joins += 1
+            task, shared_deadline = inflight
+            shared_deadline.extend(deadline)
+            return await self._wait(task, deadline), "inflight"
+        
+        self.misses += 1
+        shared_deadline = SharedDeadline(deadline)
+        task = asyncio.ensure_future(compute(shared_deadline))
+        self.inflight[key] = (task, shared_deadline)
+        task.add_done_callback(lambda t: self._on_done(key, t))
+        return await self._wait(task, deadline), "miss"
+    
+    @staticmethod
+    async def _wait(task: asyncio.Future, deadline: Optional[float]) -> Dict[str, Any]:
+        """等待共享的计算，超过本调用方的截止时间时返回 504
+        
+        shield: 发起请求的客户端断开或超时时不取消生成，等待中的其它请求仍可拿到结果。
+        """
+        if deadline is None:
+            return await asyncio.shield(task)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), max(deadline - time.perf_counter(), 0.0))
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="请求已超过截止时间")
+    
+    def _on_done(self, key: str, task: asyncio.Task):
+        self.inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+    
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计"""
+        lookups = self.hits + self.misses + self.inflight_joins
         return {
-            "prediction": response,
-            "confidence": confidence,
-            "timestamp": datetime.now().isoformat()
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "inflight_joins": self.inflight_joins,
+            "hit_rate": round((self.hits + self.inflight_joins) / lookups, 4) if lookups else 0.0
         }
-        
-    except Exception as e:
-        logger.error(f"生成预测时出错: {e}")
-        raise HTTPException(status_code=500, detail=f"预测生成失败: {str(e)}")
 
-def calculate_confidence(prediction: str) -> float:
-    """计算预测置信度"""
+def _process_rss_bytes() -> int:
+    """当前进程的常驻内存（Linux /proc）"""
     try:
-        # 基于响应格式和内容计算置信度
-        base_confidence = 0.5
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def _memory_samples() -> Dict[Tuple[str, ...], float]:
+    samples = {
+        ("weights",): backend.memory_bytes() if backend is not None else 0,
+        ("process_rss",): _process_rss_bytes()
+    }
+    if torch.cuda.is_available():
+        samples[("cuda_allocated",)] = torch.cuda.memory_allocated()
+        samples[("cuda_reserved",)] = torch.cuda.memory_reserved()
+    return samples
+
+def _cache_samples() -> Dict[Tuple[str, ...], float]:
+    if prediction_cache is None:
+        return {}
+    stats = prediction_cache.stats()
+    return {(result,): stats[key] for result, key in (("hit", "hits"), ("miss", "misses"), ("inflight", "inflight_joins"))}
+
+metrics.gauge("memo_model_ready", "模型是否已加载并预热完成", callback=lambda: {(): 1 if is_ready() else 0})
+metrics.gauge("memo_model_load_attempts", "模型加载尝试次数", callback=lambda: {(): load_state["attempts"]})
+metrics.gauge("memo_queue_depth", "批处理队列中等待的请求数",
+              callback=lambda: {(): batcher.queue_depth() if batcher is not None else 0})
+metrics.gauge("memo_estimated_wait_seconds", "新请求预计的排队时间（用于过载拒绝）",
+              callback=lambda: {(): batcher.estimated_wait() if batcher is not None else 0})
+metrics.counter("memo_cache_lookups_total", "预测缓存查询次数（按结果）", ["result"], callback=_cache_samples)
+metrics.gauge("memo_cache_hit_ratio", "预测缓存命中率（含等待同一生成任务）",
+              callback=lambda: {(): prediction_cache.stats()["hit_rate"]} if prediction_cache is not None else {})
+metrics.gauge("memo_cache_entries", "预测缓存当前条目数",
+              callback=lambda: {(): len(prediction_cache.entries)} if prediction_cache is not None else {})
+metrics.gauge("memo_adapter_pool", "用户LoRA适配器池状态（常驻数 / 常驻字节 / 累计加载 / 累计淘汰）", ["field"],
+              callback=lambda: {
+                  ("resident",): len(adapter_pool.resident),
+                  ("resident_bytes",): adapter_pool.resident_bytes(),
+                  ("loads",): adapter_pool.loads,
+                  ("evictions",): adapter_pool.evictions
+              } if adapter_pool is not None else {})
+metrics.gauge("memo_model_memory_bytes", "模型内存占用（权重 / CUDA显存 / 进程RSS）", ["kind"], callback=_memory_samples)
+
+def _cache_variant(top_k: int, user_id: Optional[str], constrained: bool = False) -> str:
+    """影响生成结果的请求参数，作为缓存键的一部分（不同用户的适配器结果不同）"""
+    if not backend.supports_user_adapters:
+        user_id = None
+    return f"top_k={top_k}" + (f";user={user_id}" if user_id else "") + (";constrained" if constrained else "")
+
+def _use_constrained(request_value: Optional[bool]) -> bool:
+    """请求未指定时使用服务端默认的受限解码开关"""
+    return ENABLE_CONSTRAINED_DECODING if request_value is None else request_value
+
+def _observe_request(result: Dict[str, Any], cache_status: str, elapsed_seconds: float):
+    """记录一次预测请求的指标；缓存命中的请求只计入总耗时"""
+    REQUEST_LATENCY.observe(elapsed_seconds, stage="total")
+    REQUESTS_TOTAL.inc(status="200", cache=cache_status)
+    if cache_status in ("hit", "inflight"):
+        return
+    metadata = result.get("metadata", {})
+    for stage in ("tokenize", "prefill", "decode"):
+        if f"{stage}_ms" in metadata:
+            REQUEST_LATENCY.observe(metadata[f"{stage}_ms"] / 1000, stage=stage)
+    PROMPT_TOKENS.inc(metadata.get("prompt_tokens", 0))
+    GENERATED_TOKENS.inc(metadata.get("generated_tokens", 0))
+
+def _request_deadline(request: PredictionRequest, header_deadline_ms: Optional[float]) -> Optional[float]:
+    """把客户端给出的剩余等待时间（请求字段优先，其次 X-Deadline-Ms 请求头）换算为本地 perf_counter 截止时间
+    
+    只传相对时间，避免依赖客户端与服务器的时钟同步。不大于0说明客户端已不再等待，返回 422 而不是当作没有截止时间。
+    """
+    deadline_ms = request.deadline_ms if request.deadline_ms is not None else header_deadline_ms
+    if deadline_ms is None:
+        return None
+    if deadline_ms <= 0:
+        raise HTTPException(status_code=422, detail=f"deadline_ms 必须大于0，实际为 {deadline_ms}")
+    return time.perf_counter() + deadline_ms / 1000
+
+def is_ready() -> bool:
+    return load_state["status"] == "ready"
+
+def _not_ready_error() -> HTTPException:
+    """模型未就绪时的 503 响应，Retry-After 提示客户端稍后重试"""
+    retry_after = 5
+    if load_state["status"] == "retrying" and load_state["next_retry_at"]:
+        retry_after = max(1, int(load_state["next_retry_at"] - time.time()) + 1)
+    return HTTPException(
+        status_code=503,
+        detail=f"模型未就绪: {load_state['status']}",
+        headers={"Retry-After": str(retry_after)}
+    )
+
+async def _log_load_progress(start: float):
+    """加载期间定期输出当前阶段和已耗时"""
+    while True:
+        await asyncio.sleep(LOAD_PROGRESS_INTERVAL_SECONDS)
+        logger.info(f"模型加载中: 阶段={load_state['stage'] or '初始化'}, 已耗时 {time.perf_counter() - start:.0f}s")
+
+async def load_backend_in_background():
+    """在推理线程中加载模型并预热，失败时按指数退避重试；期间 /live 正常、/ready 返回 503"""
+    while True:
+        load_state["attempts"] += 1
+        load_state["status"] = "loading"
+        load_state["next_retry_at"] = None
+        attempt = load_state["attempts"]
         
-        # 检查时间格式
-        if "2024" in prediction and ":" in prediction:
-            base_confidence += 0.2
+        start = time.perf_counter()
+        progress = asyncio.create_task(_log_load_progress(start))
+        try:
+            # worker_pool.py 在fork工作进程前已加载好模型时直接进入预热
+            success = backend.is_loaded() or await batcher.run_exclusive(backend.load)
+        except Exception as e:
+            load_state["last_error"] = str(e)
+            logger.error(f"模型加载出错: {e}")
+            success = False
+        finally:
+            progress.cancel()
+        load_state["load_seconds"] = round(time.perf_counter() - start, 2)
         
-        # 检查操作格式
-        if any(keyword in prediction for keyword in ["启动应用", "切换到窗口", "访问网站", "访问文件"]):
-            base_confidence += 0.2
+        if success:
+            logger.info(f"模型加载完成，耗时 {load_state['load_seconds']:.1f}s (第 {attempt} 次尝试)")
+            load_state["last_error"] = None
+            if ENABLE_WARMUP:
+                load_state["status"] = "warming_up"
+                warmup_start = time.perf_counter()
+                try:
+                    await batcher.run_exclusive(backend.warmup)
+                except Exception as e:
+                    # 预热失败不影响服务，首个请求承担一次性开销
+                    logger.warning(f"模型预热失败: {e}")
+                load_state["warmup_seconds"] = round(time.perf_counter() - warmup_start, 2)
+                logger.info(f"模型预热完成，耗时 {load_state['warmup_seconds']:.1f}s")
+            load_state["status"] = "ready"
+            load_state["stage"] = None
+            logger.info("API服务已就绪")
+            return
         
-        # 检查应用名称
-        common_apps = ["chrome.exe", "notepad.exe", "explorer.exe", "code.exe", "calc.exe"]
-        if any(app in prediction for app in common_apps):
-            base_confidence += 0.1
+        # 释放失败尝试中已加载的部分权重
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
         
-        return min(base_confidence, 0.95)  # 最大置信度0.95
+        if LOAD_MAX_ATTEMPTS and attempt >= LOAD_MAX_ATTEMPTS:
+            load_state["status"] = "failed"
+            logger.error(f"模型加载失败 {attempt} 次，不再重试: {load_state['last_error']}")
+            return
         
-    except:
-        return 0.3  # 默认低置信度
+        delay = min(LOAD_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1), LOAD_RETRY_MAX_BACKOFF_SECONDS)
+        load_state["status"] = "retrying"
+        load_state["next_retry_at"] = time.time() + delay
+        logger.warning(f"模型加载失败（第 {attempt} 次），{delay:.0f}s 后重试: {load_state['last_error']}")
+        await asyncio.sleep(delay)
 
 @app.on_event("startup")
 async def startup_event():
-    """启动时加载模型"""
+    """启动批处理调度器，并在后台加载模型（不阻塞服务启动）"""
     logger.info("API服务启动中...")
-    success = load_model()
-    if not success:
-        logger.error("模型加载失败，API服务可能无法正常工作")
-    else:
-        logger.info("API服务启动完成")
+    global backend, batcher, prediction_cache, loader_task
+    # worker_pool.py 的工作进程会预先创建（或加载）后端
+    if backend is None:
+        backend = create_backend(BACKEND)
+    
+    batcher = MicroBatcher(MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS)
+    batcher.start()
+    prediction_cache = PredictionCache(CACHE_MAX_SIZE, CACHE_TTL_SECONDS, CACHE_TIME_BUCKET_SECONDS)
+    
+    loader_task = asyncio.create_task(load_backend_in_background())
+    logger.info("API服务启动完成，模型在后台加载（就绪状态见 /ready）")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """关闭时停止后台加载和批处理调度器"""
+    if loader_task is not None and not loader_task.done():
+        loader_task.cancel()
+    if batcher is not None:
+        await batcher.stop()
 
 @app.get("/")
 async def root():
     """根路径"""
     return {"message": "LLM Activity Prediction API", "status": "running"}
 
+@app.get("/live")
+async def liveness():
+    """存活检查：进程和事件循环正常即返回 200，与模型是否加载无关"""
+    return {"status": "alive", "timestamp": datetime.now().isoformat()}
+
+@app.get("/ready")
+async def readiness():
+    """就绪检查：模型加载并预热完成后返回 200，否则返回 503 和当前加载状态"""
+    body = {**load_state, "ready": is_ready(), "timestamp": datetime.now().isoformat()}
+    if not is_ready():
+        error = _not_ready_error()
+        return JSONResponse(status_code=503, content=body, headers=error.headers)
+    return body
+
 @app.get("/health")
 async def health_check():
     """健康检查"""
-    model_status = "loaded" if model is not None else "not_loaded"
+    model_status = "loaded" if is_ready() else "not_loaded"
     return {
         "status": "healthy",
         "model_status": model_status,
+        "load_state": load_state["status"],
+        "queue_depth": batcher.queue_depth() if batcher is not None else 0,
+        "cache": prediction_cache.stats() if prediction_cache is not None else None,
         "timestamp": datetime.now().isoformat()
     }
 
 @app.post("/predict", response_model=PredictionResponse)
-async def predict_activity(request: PredictionRequest):
+async def predict_activity(request: PredictionRequest, x_deadline_ms: Optional[float] = Header(None)):
     """预测用户活动"""
+    if not is_ready():
+        REQUESTS_TOTAL.inc(status="503", cache="none")
+        raise _not_ready_error()
+    start = time.perf_counter()
     try:
-        result = generate_prediction(request.instruction, request.input)
-        return PredictionResponse(**result)
+        deadline = _request_deadline(request, x_deadline_ms)
+        top_k = min(max(request.top_k, 1), MAX_TOP_K)
+        constrained = _use_constrained(request.constrained)
+        result, cache_status = await prediction_cache.get_or_compute(
+            request.instruction,
+            request.input,
+            lambda shared_deadline: batcher.submit(
+                request.instruction, request.input, user_id=request.user_id, deadline=shared_deadline,
+                top_k=top_k, speculative=request.speculative, constrained=constrained
+            ),
+            variant=_cache_variant(top_k, request.user_id, constrained),
+            deadline=deadline
+        )
+        response = dict(result)
+        response["metadata"] = {**result.get("metadata", {}), "cache": cache_status}
+        if cache_status == "hit":
+            response["timestamp"] = datetime.now().isoformat()
+        _observe_request(result, cache_status, time.perf_counter() - start)
+        return PredictionResponse(**response)
     
+    except HTTPException as e:
+        REQUESTS_TOTAL.inc(status=str(e.status_code), cache="none")
+        raise
     except Exception as e:
+        REQUESTS_TOTAL.inc(status="500", cache="none")
         logger.error(f"预测请求失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def detect_action(text: str) -> Optional[Dict[str, Any]]:
+    """在（可能尚未生成完的）第一条活动行中识别应用/动作部分"""
+    line = text.strip().split("\n")[0]
+    for action_type, pattern in STREAM_ACTION_PATTERNS:
+        match = pattern.search(line)
+        if match:
+            groups = match.groupdict()
+            time_match = re.match(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})', line)
+            return {
+                "action_type": action_type,
+                "app": groups.get("app"),
+                "target": groups.get("target") or groups.get("app"),
+                "timestamp": time_match.group(1) if time_match else None,
+                "partial_prediction": line
+            }
+    return None
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _stream_prediction(request: PredictionRequest, deadline: Optional[float] = None):
+    """流式预测的事件生成器"""
+    start = time.perf_counter()
+    constrained = _use_constrained(request.constrained)
+    cache_key, cached = None, None
+    if prediction_cache.enabled:
+        cache_key, cached = prediction_cache.lookup(
+            request.instruction, request.input, _cache_variant(1, request.user_id, constrained)
+        )
+    
+    if cached is not None:
+        action = detect_action(cached["prediction"])
+        if action:
+            yield _sse_event("action", {**action, "confidence": cached["confidence"], "elapsed_ms": 0.0})
+        _observe_request(cached, "hit", time.perf_counter() - start)
+        yield _sse_event("done", {
+            **cached,
+            "timestamp": datetime.now().isoformat(),
+            "metadata": {**cached.get("metadata", {}), "cache": "hit"}
+        })
+        return
+    
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    
+    def on_text(text: str, log_probs: List[float]):
+        loop.call_soon_threadsafe(chunks.put_nowait, (text, log_probs))
+    
+    def on_done(future: asyncio.Future):
+        chunks.put_nowait(None)
+        # 客户端中途断开时生成仍会完成，结果写入缓存供后续请求使用
+        if cache_key is not None and not future.cancelled() and future.exception() is None:
+            prediction_cache.put(cache_key, future.result())
+    
+    generation = batcher.run_exclusive(
+        functools.partial(backend.generate_stream, request.instruction, request.input, on_text, request.user_id,
+                          constrained=constrained),
+        deadline
+    )
+    generation.add_done_callback(on_done)
+    
+    text = ""
+    pieces = []
+    piece_log_probs = []
+    action_ms = None
+    while True:
+        chunk = await chunks.get()
+        if chunk is None:
+            break
+        delta, delta_log_probs = chunk
+        text += delta
+        pieces.append(delta)
+        piece_log_probs.append(delta_log_probs)
+        if delta:
+            yield _sse_event("token", {"text": delta})
+        if action_ms is None:
+            action = detect_action(text)
+            if action:
+                elapsed = time.perf_counter() - start
+                action_ms = round(elapsed * 1000, 2)
+                STREAM_TIME_TO_ACTION.observe(elapsed)
+                # 置信度为已生成的动作部分的概率（见 action_confidence），最终值以 done 事件为准
+                confidence = action_confidence(pieces, piece_log_probs)
+                yield _sse_event("action", {**action, "confidence": round(confidence, 4), "elapsed_ms": action_ms})
+    
+    try:
+        result = generation.result()
+    except Exception as e:
+        status_code = e.status_code if isinstance(e, HTTPException) else 500
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        REQUESTS_TOTAL.inc(status=str(status_code), cache="none")
+        logger.error(f"流式预测失败: {detail}")
+        yield _sse_event("error", {"status_code": status_code, "detail": detail})
+        return
+    
+    # 后端不支持逐token输出时，在完整结果上识别一次
+    if action_ms is None:
+        action = detect_action(result["prediction"])
+        if action:
+            action_ms = round((time.perf_counter() - start) * 1000, 2)
+            yield _sse_event("action", {**action, "confidence": result["confidence"], "elapsed_ms": action_ms})
+    
+    cache_status = "miss" if cache_key is not None else "disabled"
+    _observe_request(result, cache_status, time.perf_counter() - start)
+    yield _sse_event("done", {
+        **result,
+        "metadata": {**result.get("metadata", {}), "cache": cache_status, "time_to_action_ms": action_ms}
+    })
+
+@app.post("/predict/stream")
+async def predict_stream(request: PredictionRequest, x_deadline_ms: Optional[float] = Header(None)):
+    """流式预测（Server-Sent Events）
+    
+    依次推送 token（增量文本）、action（活动行的应用/动作部分已解码，附当前置信度）
+    和 done（与 /predict 响应格式相同的完整结果）事件；出错时推送 error 事件。
+    流式预测只生成一条候选，top_k 和 speculative 参数会被忽略。
+    """
+    if not is_ready():
+        REQUESTS_TOTAL.inc(status="503", cache="none")
+        raise _not_ready_error()
+    try:
+        deadline = _request_deadline(request, x_deadline_ms)
+        batcher.admit(deadline)
+    except HTTPException as e:
+        REQUESTS_TOTAL.inc(status=str(e.status_code), cache="none")
+        raise
+    return StreamingResponse(
+        _stream_prediction(request, deadline),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _length_sorted_buckets(items: List[BulkPredictionItem], bucket_size: int) -> List[List[int]]:
+    """按提示长度排序后切分为批次，返回各批次的原始下标
+    
+    同一批次内长度接近，左填充的token和生成时的无效计算更少。用字符数近似token数，
+    不需要为排序额外分词（也适用于不提供分词器的后端）。
+    """
+    order = sorted(range(len(items)), key=lambda i: len(items[i].instruction) + len(items[i].input))
+    return [order[i:i + bucket_size] for i in range(0, len(order), bucket_size)]
+
+@app.post("/predict_batch", response_model=BulkPredictionResponse)
+async def predict_batch(request: BulkPredictionRequest):
+    """批量预测（离线评估/回放）
+    
+    一次提交整份验证集，服务端按提示长度排序分桶做批量生成，结果按提交顺序返回。
+    每个桶作为一个独立的推理任务提交，桶之间在线请求的批次仍可插队执行；不经过预测缓存。
+    各条的 metadata 给出所在桶的编号、生成耗时和从请求开始到该条完成的时间。
+    """
+    if not is_ready():
+        REQUESTS_TOTAL.inc(status="503", cache="none")
+        raise _not_ready_error()
+    if len(request.items) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=413, detail=f"单次最多 {MAX_BULK_ITEMS} 条，当前 {len(request.items)} 条")
+    
+    start = time.perf_counter()
+    top_k = min(max(request.top_k, 1), MAX_TOP_K)
+    bucket_size = max(1, request.bucket_size or MAX_BATCH_SIZE)
+    buckets = _length_sorted_buckets(request.items, bucket_size)
+    predictions = [None] * len(request.items)
+    
+    try:
+        for bucket_index, indices in enumerate(buckets):
+            options = {"top_k": top_k, "constrained": _use_constrained(request.constrained)}
+            if request.user_id:
+                options["user_ids"] = [request.user_id] * len(indices)
+            bucket_start = time.perf_counter()
+            results = await batcher.run_exclusive(functools.partial(
+                backend.generate_batch,
+                [(request.items[i].instruction, request.items[i].input) for i in indices],
+                **options
+            ))
+            bucket_ms = round((time.perf_counter() - bucket_start) * 1000, 2)
+            completed_ms = round((time.perf_counter() - start) * 1000, 2)
+            
+            for i, result in zip(indices, results):
+                _observe_request(result, "bulk", bucket_ms / 1000)
+                predictions[i] = PredictionResponse(**{
+                    **result,
+                    "metadata": {
+                        **result.get("metadata", {}),
+                        "bucket": bucket_index,
+                        "bucket_ms": bucket_ms,
+                        "completed_ms": completed_ms
+                    }
+                })
+    
+    except HTTPException as e:
+        REQUESTS_TOTAL.inc(status=str(e.status_code), cache="none")
+        raise
+    except Exception as e:
+        REQUESTS_TOTAL.inc(status="500", cache="none")
+        logger.error(f"批量预测失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    elapsed = time.perf_counter() - start
+    logger.info(f"批量预测完成: {len(request.items)} 条, {len(buckets)} 个批次, 耗时 {elapsed:.1f}s")
+    return BulkPredictionResponse(predictions=predictions, metadata={
+        "items": len(request.items),
+        "buckets": len(buckets),
+        "bucket_size": bucket_size,
+        "elapsed_ms": round(elapsed * 1000, 2),
+        "items_per_second": round(len(request.items) / elapsed, 2) if elapsed > 0 else 0.0
+    })
+
 @app.get("/model_info")
 async def model_info():
     """获取模型信息"""
     return {
-        "base_model_path": BASE_MODEL_PATH,
-        "fine_tuned_model_path": FINE_TUNED_MODEL_PATH,
-        "model_loaded": model is not None,
-        "tokenizer_loaded": tokenizer is not None
+        **(backend.info() if backend is not None else {"backend": BACKEND}),
+        "max_batch_size": MAX_BATCH_SIZE,
+        "max_batch_wait_ms": MAX_BATCH_WAIT_MS,
+        "max_queue_size": MAX_QUEUE_SIZE,
+        "load_shedding": batcher.stats() if batcher is not None else None,
+        "early_stop": ENABLE_EARLY_STOP,
+        "constrained_decoding": {
+            "default": ENABLE_CONSTRAINED_DECODING,
+            "apps": len(activity_grammar.apps),
+            "top_candidates": GRAMMAR_TOP_CANDIDATES
+        },
+        "max_top_k": MAX_TOP_K,
+        "load_state": load_state,
+        "decode_speed": get_decode_speed_summary()
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Prometheus 格式的服务指标"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     # 在云服务器上运行API服务
     uvicorn.run(
         app, 
         host="0.0.0.0",  # 监听所有网络接口
         port=8000,
-        log_level="info"
+        log_level="info",
+        timeout_keep_alive=KEEP_ALIVE_SECONDS
     )
\ No newline at end of file
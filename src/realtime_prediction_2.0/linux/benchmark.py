@@ -0,0 +1,225 @@
+"""
+预测API压测工具
+从 local_version/data/alpaca_fine_tuning_data*.json 中取 input 字段，按指定的并发数或到达速率
+回放到 /predict，统计 p50/p95/p99 延迟、吞吐量和错误率。
+
+配合 api.py 的 mock 后端（MEMO_BACKEND=mock）可以在普通Linux机器上压测批处理、缓存和排队行为：
+
+    MEMO_BACKEND=mock python api.py
+    python benchmark.py --concurrency 16 --requests 500
+    python benchmark.py --rate 20 --duration 60
+"""
+
+import os
+import glob
+import json
+import time
+import random
+import argparse
+import logging
+import threading
+import requests
+from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Dict, Any
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATA_PATTERN = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "local_version", "data", "alpaca_fine_tuning_data*.json"
+)
+# 与 Windows 端 LLMPredictor._predict_via_cloud_api 的超时一致
+DEFAULT_TIMEOUT = 15
+
+def load_payloads(pattern: str) -> List[Dict[str, str]]:
+    """读取微调数据集中的 instruction / input 作为请求体"""
+    payloads = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'r', encoding='utf-8') as f:
+            for item in json.load(f):
+                if item.get("input"):
+                    payloads.append({"instruction": item.get("instruction", ""), "input": item["input"]})
+    return payloads
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """最近秩法计算分位数，sorted_values 需已排序"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+class LoadGenerator:
+    """向 /predict 回放请求并收集每条请求的结果"""
+
+    def __init__(self, url: str, payloads: List[Dict[str, str]], concurrency: int = 8,
+                 timeout: float = DEFAULT_TIMEOUT, top_k: int = 1, seed: int = 0):
+        self.url = url.rstrip("/") + "/predict"
+        self.payloads = payloads
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.top_k = top_k
+        self.random = random.Random(seed)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.results = []
+
+    def _session(self) -> requests.Session:
+        # 每个线程复用一个连接
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def _next_payload(self) -> Dict[str, str]:
+        with self.lock:
+            payload = dict(self.random.choice(self.payloads))
+        payload["top_k"] = self.top_k
+        return payload
+
+    def _send(self, payload: Dict[str, str], scheduled_at: float):
+        """发送一条请求；延迟从计划到达时间算起，包含客户端排队时间"""
+        record = {"status": None, "error": None, "cache": None, "server": {}}
+        try:
+            response = self._session().post(self.url, json=payload, timeout=self.timeout)
+            record["status"] = response.status_code
+            if response.status_code == 200:
+                metadata = response.json().get("metadata", {})
+                record["cache"] = metadata.get("cache")
+                record["server"] = {k: metadata[k] for k in ("tokenize_ms", "prefill_ms", "decode_ms", "batch_size") if k in metadata}
+            else:
+                record["error"] = f"HTTP {response.status_code}"
+        except requests.exceptions.Timeout:
+            record["error"] = "timeout"
+        except requests.exceptions.RequestException as e:
+            record["error"] = type(e).__name__
+        record["latency"] = time.perf_counter() - scheduled_at
+        with self.lock:
+            self.results.append(record)
+
+    def run_closed_loop(self, total_requests: int = 0, duration: float = 0.0) -> float:
+        """固定并发：每个工作线程收到响应后立即发送下一条，返回总耗时"""
+        start = time.perf_counter()
+        counter = {"sent": 0}
+
+        def worker():
+            while True:
+                with self.lock:
+                    if total_requests and counter["sent"] >= total_requests:
+                        return
+                    counter["sent"] += 1
+                if duration and time.perf_counter() - start >= duration:
+                    return
+                self._send(self._next_payload(), time.perf_counter())
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def run_open_loop(self, rate: float, total_requests: int = 0, duration: float = 0.0) -> float:
+        """固定到达速率（泊松到达），与响应速度无关；并发上限为 concurrency，返回总耗时"""
+        start = time.perf_counter()
+        next_arrival = start
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while (not total_requests or len(futures) < total_requests) and (not duration or next_arrival - start < duration):
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(executor.submit(self._send, self._next_payload(), next_arrival))
+                next_arrival += self.random.expovariate(rate)
+            # 总耗时包含仍在排队和处理中的请求，等全部完成后再计时
+            wait(futures)
+            elapsed = time.perf_counter() - start
+        return elapsed
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    """汇总延迟分位数、吞吐量、错误率和服务端耗时"""
+    ok = [r for r in results if r["error"] is None]
+    latencies = sorted(r["latency"] * 1000 for r in ok)
+    summary = {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "errors": dict(Counter(r["error"] for r in results if r["error"] is not None)),
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(latencies[-1], 2) if latencies else 0.0
+        },
+        "cache": dict(Counter(r["cache"] for r in ok if r["cache"] is not None))
+    }
+
+    # 服务端各阶段平均耗时（仅统计实际推理的请求）
+    generated = [r["server"] for r in ok if r["cache"] in ("miss", "disabled")]
+    if generated:
+        summary["server_ms"] = {
+            key: round(sum(s.get(key, 0) for s in generated) / len(generated), 2)
+            for key in ("tokenize_ms", "prefill_ms", "decode_ms", "batch_size")
+        }
+    return summary
+
+def print_summary(summary: Dict[str, Any]):
+    latency = summary["latency_ms"]
+    print("\n===== 压测结果 =====")
+    print(f"请求数: {summary['requests']}  成功: {summary['succeeded']}  错误率: {summary['error_rate']:.2%}")
+    if summary["errors"]:
+        print(f"错误分布: {summary['errors']}")
+    print(f"耗时: {summary['elapsed_seconds']}s  吞吐量: {summary['throughput_rps']} req/s")
+    print(f"延迟(ms): mean={latency['mean']} p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} max={latency['max']}")
+    if summary["cache"]:
+        print(f"缓存状态: {summary['cache']}")
+    if "server_ms" in summary:
+        print(f"服务端平均: {summary['server_ms']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="预测API压测工具")
+    parser.add_argument("--url", type=str, default="http://localhost:8000", help="API服务地址")
+    parser.add_argument("--data", type=str, default=DEFAULT_DATA_PATTERN, help="请求数据文件（glob）")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发数（固定速率模式下为最大在途请求数）")
+    parser.add_argument("--rate", type=float, default=0.0, help="到达速率 req/s，为 0 时按固定并发压测")
+    parser.add_argument("--requests", type=int, default=200, help="总请求数，为 0 时只按 --duration 限制")
+    parser.add_argument("--duration", type=float, default=0.0, help="压测时长（秒），为 0 时只按 --requests 限制")
+    parser.add_argument("--top-k", type=int, default=1, help="请求的候选数")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="单个请求超时（秒）")
+    parser.add_argument("--seed", type=int, default=0, help="抽样和到达间隔的随机种子")
+    parser.add_argument("--output", type=str, default="", help="将结果保存为JSON文件")
+
+    args = parser.parse_args()
+    if not args.requests and not args.duration:
+        parser.error("--requests 和 --duration 不能同时为 0")
+
+    payloads = load_payloads(args.data)
+    if not payloads:
+        parser.error(f"未找到请求数据: {args.data}")
+    logger.info(f"已加载 {len(payloads)} 条请求数据")
+
+    generator = LoadGenerator(args.url, payloads, args.concurrency, args.timeout, args.top_k, args.seed)
+    if args.rate > 0:
+        logger.info(f"固定到达速率压测: {args.rate} req/s, 最大并发 {args.concurrency}")
+        elapsed = generator.run_open_loop(args.rate, args.requests, args.duration)
+    else:
+        logger.info(f"固定并发压测: 并发 {args.concurrency}")
+        elapsed = generator.run_closed_loop(args.requests, args.duration)
+
+    summary = summarize(generator.results, elapsed)
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                "config": vars(args),
+                "summary": summary,
+                "finished_at": datetime.now().isoformat()
+            }, f, ensure_ascii=False, indent=2)
+        logger.info(f"结果已保存到: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+活动行的受限解码
+用正则描述一条活动行（时间戳 + 允许的操作类型 + 目标），生成时屏蔽会让输出偏离该格式的token，
+保证生成的活动行都能被 Windows 端的 _parse_prediction 和 train.py 的 clean_output 解析，
+也不会在格式错误的分支上浪费解码步。
+
+操作类型覆盖训练数据中的格式（启动应用 / 关闭应用 / 使用应用 / 切换到窗口 / 访问文件 /
+"访问网站 域名 的页面 '标题'"）以及 Windows 端提示中要求的 "访问网页: URL (应用: xxx.exe)"。
+可选地给出已知应用列表，把应用名限制在其中。
+"""
+
+import os
+import json
+import regex
+import torch
+from transformers import LogitsProcessor
+from typing import List, Optional, Iterable
+
+TIMESTAMP = r'\d{4}-(?:0[1-9]|1[0-2])-(?:[0-2]\d|3[01]) (?:[01]\d|2[0-3]):[0-5]\d:[0-5]\d'
+# 未给出应用列表时：不含空白和括号的Windows文件名
+DEFAULT_APP = r'[^\s()<>:"/\\|?*]+\.(?i:exe)'
+
+def build_activity_pattern(apps: Optional[Iterable[str]] = None) -> str:
+    """活动行的正则（不含行尾换行）"""
+    app = DEFAULT_APP
+    if apps:
+        app = "(?:" + "|".join(regex.escape(name) for name in sorted(set(apps), key=len, reverse=True)) + ")"
+    bodies = [
+        rf'(?:启动应用|关闭应用): {app}',
+        rf'使用应用: {app}(?: \(时长: [^)\n]*\))?',
+        rf'(?:切换到窗口|访问网页): [^\n]+? \(应用: {app}\)',
+        r"访问网站 [A-Za-z0-9.-]+(?: 的页面 '[^'\n]*')?",
+        r'访问文件: [^\n]+'
+    ]
+    return rf'{TIMESTAMP} - (?:' + "|".join(bodies) + ')'
+
+def build_activity_gbnf(apps: Optional[Iterable[str]] = None) -> str:
+    """与 build_activity_pattern 等价的 GBNF 语法，供 llama.cpp 后端使用"""
+    if apps:
+        app_rule = " | ".join(json.dumps(name, ensure_ascii=False) for name in sorted(set(apps)))
+    else:
+        app_rule = '[^ \\t\\n()<>:"/\\\\|?*]+ (".exe" | ".EXE")'
+    return "\n".join([
+        'root ::= ts " - " body "\\n"?',
+        'ts ::= d d d d "-" ("0" [1-9] | "1" [0-2]) "-" ([0-2] d | "3" [01]) " " ([01] d | "2" [0-3]) ":" [0-5] d ":" [0-5] d',
+        'd ::= [0-9]',
+        'body ::= ("启动应用" | "关闭应用") ": " app'
+        ' | "使用应用: " app (" (时长: " [^)\\n]* ")")?'
+        ' | ("切换到窗口" | "访问网页") ": " [^\\n]+ " (应用: " app ")"'
+        ' | "访问网站 " [A-Za-z0-9.-]+ (" 的页面 \'" [^\'\\n]* "\'")?'
+        ' | "访问文件: " [^\\n]+',
+        f'app ::= {app_rule}'
+    ])
+
+def _byte_level_decoder() -> dict:
+    """GPT-2 风格字节级BPE的 token字符 -> 字节 映射（Llama-3、Qwen 的分词器都使用这种编码）"""
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    codes = printable[:]
+    extra = 0
+    for byte in range(256):
+        if byte not in printable:
+            printable.append(byte)
+            codes.append(256 + extra)
+            extra += 1
+    return {chr(code): byte for byte, code in zip(printable, codes)}
+
+def load_app_vocabulary(path: str) -> List[str]:
+    """读取已知应用列表：JSON 数组或每行一个应用名的文本文件"""
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(".json"):
+            return [str(name) for name in json.load(f)]
+        return [line.strip() for line in f if line.strip()]
+
+class ActivityGrammar:
+    """活动行格式的前缀判定"""
+
+    def __init__(self, apps: Optional[Iterable[str]] = None):
+        self.apps = list(apps or [])
+        line = build_activity_pattern(self.apps)
+        # 允许开头少量空白；一行结束后只允许一个换行
+        self.pattern = regex.compile(rf'\s{{0,2}}{line}\n?')
+        # 格式中固定出现的非ASCII字符（操作类型等），用于判断未解码完整的字节能否补全为合法字符
+        self.literal_chars = sorted({char for char in line if ord(char) > 127})
+
+    def is_prefix(self, text: str) -> bool:
+        """text 是否可以继续生成为一条合法的活动行"""
+        return self.pattern.fullmatch(text, partial=True) is not None
+
+    def is_complete(self, text: str) -> bool:
+        """text 是否已经是一条完整的活动行（可以结束生成）"""
+        return self.pattern.fullmatch(text) is not None
+    
+    def allows_pending_bytes(self, text: str, pending: Optional[bytes]) -> bool:
+        """text 之后能否接一个以 pending 开头的多字节字符；pending 未知时只要能接任意非ASCII字符即可"""
+        if self.is_prefix(text + "一"):
+            # 自由文本位置，任意字符都合法
+            return True
+        return any(
+            (pending is None or char.encode("utf-8").startswith(pending)) and self.is_prefix(text + char)
+            for char in self.literal_chars
+        )
+
+class ActivityGrammarProcessor(LogitsProcessor):
+    """按 ActivityGrammar 屏蔽非法token
+
+    逐个检查词表代价太高，因此只检查分数最高的 top_candidates 个token，其余一律屏蔽；
+    采样阶段的 top_p 本来也只会从这些token中选择。若其中没有合法token，再按分数顺序
+    继续检查（最多 max_scan 个），仍找不到时保持原分数不变，不让生成中断。
+    """
+
+    def __init__(self, tokenizer, grammar: ActivityGrammar, prompt_length: int,
+                 stop_token_ids: Iterable[int], top_candidates: int = 32, max_scan: int = 2048):
+        self.tokenizer = tokenizer
+        self.grammar = grammar
+        self.prompt_length = prompt_length
+        self.stop_token_ids = set(stop_token_ids)
+        self.top_candidates = max(1, top_candidates)
+        self.max_scan = max(self.top_candidates, max_scan)
+        self.fallbacks = 0
+        self.byte_decoder = _byte_level_decoder()
+
+    def _pending_bytes(self, ids: List[int], stripped: str) -> Optional[bytes]:
+        """末尾尚未组成完整字符的字节；分词器不是字节级BPE时返回 None"""
+        try:
+            raw = b"".join(bytes(self.byte_decoder[char] for char in token)
+                           for token in self.tokenizer.convert_ids_to_tokens(ids))
+        except (KeyError, TypeError):
+            return None
+        prefix = stripped.encode("utf-8")
+        return raw[len(prefix):] if raw.startswith(prefix) else None
+
+    def _decode(self, ids: List[int]) -> str:
+        # 保留特殊token的文本，使其无法匹配格式而被屏蔽
+        return self.tokenizer.decode(ids, skip_special_tokens=False)
+
+    def _is_valid(self, ids: List[int]) -> bool:
+        text = self._decode(ids)
+        # 多字节字符可能被拆到多个token中，末尾未完整的字节解码为 U+FFFD（最多3个），待后续token补全
+        stripped = text.rstrip("\ufffd")
+        if len(stripped) == len(text):
+            return self.grammar.is_prefix(text)
+        return (len(text) - len(stripped) <= 3 and self.grammar.is_prefix(stripped)
+                and self.grammar.allows_pending_bytes(stripped, self._pending_bytes(ids, stripped)))
+
+    def _allowed(self, generated: List[int], text: str, candidates: List[int]) -> List[int]:
+        allowed = []
+        complete = self.grammar.is_complete(text)
+        for token_id in candidates:
+            if token_id in self.stop_token_ids:
+                if complete:
+                    allowed.append(token_id)
+            elif self._is_valid(generated + [token_id]):
+                allowed.append(token_id)
+        return allowed
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        masked = torch.full_like(scores, float("-inf"))
+        for row in range(input_ids.shape[0]):
+            generated = input_ids[row, self.prompt_length:].tolist()
+            if any(token_id in self.stop_token_ids for token_id in generated):
+                # 该行已结束，之后的token都是填充
+                masked[row] = scores[row]
+                continue
+            text = self._decode(generated)
+            ranked = torch.argsort(scores[row], descending=True)
+
+            allowed = self._allowed(generated, text, ranked[:self.top_candidates].tolist())
+            scanned = self.top_candidates
+            while not allowed and scanned < self.max_scan:
+                allowed = self._allowed(generated, text, ranked[scanned:scanned + self.top_candidates * 4].tolist())
+                scanned += self.top_candidates * 4
+
+            if allowed:
+                if scanned > self.top_candidates:
+                    self.fallbacks += 1
+                index = torch.tensor(allowed, device=scores.device)
+                masked[row, index] = scores[row, index]
+            else:
+                self.fallbacks += 1
+                masked[row] = scores[row]
+        return masked
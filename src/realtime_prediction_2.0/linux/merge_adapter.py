@@ -0,0 +1,73 @@
+"""
+将LoRA微调检查点合并进基础模型权重并导出
+导出的 safetensors 可被 api.py 直接加载（设置 MEMO_MERGED_MODEL_PATH），
+省去每次启动时的 PeftModel 包装，推理时也不再有LoRA旁路的额外计算
+"""
+
+import os
+import json
+import time
+import argparse
+import logging
+import torch
+from datetime import datetime
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from peft import PeftModel
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 默认与 api.py 中的模型路径保持一致
+DEFAULT_BASE_MODEL_PATH = "/home/vipuser/llm/LLM-Research/Meta-Llama-3___1-8B-Instruct"
+DEFAULT_ADAPTER_PATH = "/home/vipuser/llm/output/exp16_lr0.0003_bs2_r32_a128_ep4_d0.05/checkpoint-356"
+
+def merge_adapter(base_model_path: str, adapter_path: str, output_dir: str,
+                  dtype: str = "bfloat16", max_shard_size: str = "5GB"):
+    """加载基础模型和LoRA，合并后以 safetensors 格式保存"""
+    start = time.perf_counter()
+    
+    logger.info(f"加载基础模型: {base_model_path}")
+    base_model = AutoModelForCausalLM.from_pretrained(
+        base_model_path,
+        torch_dtype=getattr(torch, dtype),
+        device_map="cpu",
+        trust_remote_code=True
+    )
+    
+    logger.info(f"加载LoRA检查点: {adapter_path}")
+    model = PeftModel.from_pretrained(base_model, adapter_path)
+    
+    logger.info("合并LoRA权重...")
+    merged_model = model.merge_and_unload()
+    
+    logger.info(f"保存合并后的模型到: {output_dir}")
+    os.makedirs(output_dir, exist_ok=True)
+    merged_model.save_pretrained(output_dir, safe_serialization=True, max_shard_size=max_shard_size)
+    
+    tokenizer = AutoTokenizer.from_pretrained(base_model_path, use_fast=False, trust_remote_code=True)
+    tokenizer.save_pretrained(output_dir)
+    
+    # 记录合并来源，便于排查服务端加载的是哪个检查点
+    with open(os.path.join(output_dir, "merge_info.json"), 'w', encoding='utf-8') as f:
+        json.dump({
+            "base_model_path": base_model_path,
+            "adapter_path": adapter_path,
+            "dtype": dtype,
+            "merged_at": datetime.now().isoformat()
+        }, f, ensure_ascii=False, indent=2)
+    
+    logger.info(f"合并完成，耗时 {time.perf_counter() - start:.1f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description="合并LoRA检查点并导出 safetensors")
+    parser.add_argument("--base", type=str, default=DEFAULT_BASE_MODEL_PATH, help="基础模型路径")
+    parser.add_argument("--adapter", type=str, default=DEFAULT_ADAPTER_PATH, help="LoRA检查点路径，如 exp16_.../checkpoint-356")
+    parser.add_argument("--output", type=str, required=True, help="合并后模型的输出目录")
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=["bfloat16", "float16", "float32"], help="保存的权重精度")
+    parser.add_argument("--max-shard-size", type=str, default="5GB", help="单个 safetensors 分片的最大大小")
+    
+    args = parser.parse_args()
+    merge_adapter(args.base, args.adapter, args.output, args.dtype, args.max_shard_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+提示编译：按段缓存token ID，拼接出 input_ids
+提示由固定模板（系统提示、用户/助手头）、instruction 和逐行的活动序列组成。
+模板只编码一次，instruction 和活动行按文本做LRU缓存，连续请求的活动窗口大部分行
+都在上一次请求中出现过，因此每个请求只需编码新出现的行，不必用（慢速）分词器重新编码整段提示。
+"""
+
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+class PromptCompiler:
+    """Llama-3 对话模板的分段编码器
+
+    用户部分按以下分段编码后拼接：
+      用户头 + instruction + "\\n" | 活动行 + "\\n" | ... | 最后一行活动 | <|eot_id|> + 助手头
+    BPE 的预分词会把标点与其后的换行合成一个片段，所以换行随所在行一起编码；
+    换行不会与下一行开头的非空白字符合并，因此逐段编码再拼接与整段编码的结果相同。
+    空行或首尾带空白的行不满足这一点，此时 compile 返回 None，由调用方整段编码。
+    """
+
+    def __init__(self, tokenizer, system_prompt: str, user_header: str, assistant_suffix: str,
+                 max_lines: int = 4096, max_instructions: int = 64):
+        self.tokenizer = tokenizer
+        self.user_header = user_header
+        self.max_lines = max(1, max_lines)
+        self.max_instructions = max(1, max_instructions)
+        # 与完整提示的编码方式一致：系统提示包含分词器自动添加的特殊token，其余部分不添加
+        self.system_ids = tokenizer(system_prompt).input_ids
+        self.suffix_ids = self._encode(assistant_suffix)
+        self.instructions = OrderedDict()  # 用户头 + instruction -> token ID
+        self.lines = OrderedDict()  # 活动行（含行尾换行） -> token ID
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self.timings = {}
+
+    def _encode(self, text: str) -> List[int]:
+        return self.tokenizer(text, add_special_tokens=False).input_ids
+
+    def _lookup(self, cache: OrderedDict, text: str, max_size: int) -> List[int]:
+        ids = cache.get(text)
+        if ids is not None:
+            cache.move_to_end(text)
+            self.hits += 1
+            return ids
+        self.misses += 1
+        ids = self._encode(text)
+        cache[text] = ids
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+        return ids
+
+    def compile(self, instruction: str, input_text: str, include_system: bool = False) -> Optional[List[int]]:
+        """返回用户部分（include_system 时为完整提示）的token ID；无法逐行拼接时返回 None"""
+        lines = input_text.split("\n")
+        if any(not line or line != line.strip() for line in lines):
+            self.fallbacks += 1
+            return None
+
+        ids = list(self.system_ids) if include_system else []
+        ids += self._lookup(self.instructions, self.user_header + instruction + "\n", self.max_instructions)
+        for line in lines[:-1]:
+            ids += self._lookup(self.lines, line + "\n", self.max_lines)
+        ids += self._lookup(self.lines, lines[-1], self.max_lines)
+        ids += self.suffix_ids
+        return ids
+
+    def verify(self, samples: List[Tuple[str, str]], full_prompt) -> bool:
+        """检查分段拼接与整段编码的结果是否一致（分词器的预分词规则不同时可能不一致）
+
+        full_prompt(instruction, input_text) 返回完整提示文本。
+        """
+        for instruction, input_text in samples:
+            compiled = self.compile(instruction, input_text, include_system=True)
+            if compiled is not None and compiled != self.tokenizer(full_prompt(instruction, input_text)).input_ids:
+                return False
+        return True
+
+    def measure(self, samples: List[Tuple[str, str]], full_prompt, repeats: int = 5) -> Dict[str, float]:
+        """对比整段编码和分段拼接（缓存已预热）的平均耗时（毫秒/条）"""
+        for instruction, input_text in samples:
+            self.compile(instruction, input_text, include_system=True)
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for instruction, input_text in samples:
+                self.tokenizer(full_prompt(instruction, input_text))
+        full_ms = (time.perf_counter() - start) * 1000 / (repeats * len(samples))
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for instruction, input_text in samples:
+                self.compile(instruction, input_text, include_system=True)
+        compiled_ms = (time.perf_counter() - start) * 1000 / (repeats * len(samples))
+
+        self.timings = {"full_tokenize_ms": round(full_ms, 3), "compiled_tokenize_ms": round(compiled_ms, 3)}
+        return self.timings
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "cached_lines": len(self.lines),
+            "cached_instructions": len(self.instructions),
+            "max_lines": self.max_lines,
+            "hits": self.hits,
+            "misses": self.misses,
+            "fallbacks": self.fallbacks,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            **self.timings
+        }
@@ -0,0 +1,242 @@
+"""
+CPU量化推理对比工具
+在 alpaca 验证集上分别以 bf16（none）、int8、int4 加载 api.py 的 transformers 后端，
+对比单条请求延迟、解码速度、常驻内存和预测准确率。
+
+验证集的划分与 local_version/train.py 的 Qwen3FineTuner.load_datasets 一致（每个json文件
+sample(frac=0.8, random_state=42) 之外的样本），准确率按 Qwen3FineTuner.evaluate_model 的定义计算：
+  完全匹配 = 时间、操作类型和操作目标都匹配
+  部分匹配 = 操作类型和操作目标都匹配（时间不要求）
+  不合规预测 = 预测中没有合法的活动行
+
+每种模式在独立的子进程中运行，避免前一个模型的内存影响常驻内存统计：
+
+    python quant_benchmark.py --modes none,int8,int4 --limit 100 --output quant_results.json
+
+也可以用 --url 通过 /predict_batch 一次性评估已运行的服务（使用服务当前的配置）：
+
+    python quant_benchmark.py --url http://localhost:8000
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import resource
+import argparse
+import logging
+import subprocess
+import pandas as pd
+from datetime import datetime
+from typing import List, Dict, Any, Tuple
+
+from benchmark import percentile
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "local_version", "data"
+)
+# 与 train.py 默认配置的 train_ratio 一致
+DEFAULT_TRAIN_RATIO = 0.8
+
+EVENT_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - ([^:]+): (.+)$')
+VALID_OPERATIONS = ['启动应用', '关闭应用', '访问网站', '访问文件', '切换到窗口', '使用应用']
+
+def load_validation_set(data_dir: str, train_ratio: float = DEFAULT_TRAIN_RATIO) -> pd.DataFrame:
+    """按 Qwen3FineTuner.load_datasets 的方式取出验证集"""
+    val_dfs = []
+    for json_file in glob.glob(os.path.join(data_dir, '*.json')):
+        df = pd.read_json(json_file)
+        train_df = df.sample(frac=train_ratio, random_state=42)
+        val_dfs.append(df.drop(train_df.index).reset_index(drop=True))
+    return pd.concat(val_dfs, ignore_index=True) if val_dfs else pd.DataFrame()
+
+def split_event(event: str) -> Tuple[str, str, str]:
+    match = EVENT_PATTERN.match(event.strip())
+    return match.groups() if match else ("", "", "")
+
+def clean_prediction(text: str) -> str:
+    """取第一条合法活动行，与 Qwen3FineTuner.generate_prediction 的 clean_output 一致"""
+    text = re.sub(r'<\|.*?\|>', '', text)
+    text = re.sub(r'</?.*?>', '', text)
+    text = text.replace('</s>', '').strip()
+    if '>' in text:
+        text = text.split('>')[0].strip()
+    for line in (line.strip() for line in text.split('\n') if line.strip()):
+        match = EVENT_PATTERN.match(line)
+        if match and match.group(2) in VALID_OPERATIONS:
+            return f"{match.group(1)} - {match.group(2)}: {match.group(3)}"
+    return ""
+
+def score_predictions(predictions: List[str], references: List[str]) -> Dict[str, Any]:
+    """完全匹配、部分匹配准确率和不合规预测占比，定义同 evaluate_model"""
+    exact_matches, partial_matches, empty_predictions = 0, 0, 0
+    for prediction, reference in zip(predictions, references):
+        pt, po, po2 = split_event(prediction)
+        rt, ro, ro2 = split_event(reference.strip())
+        if pt == rt and po == ro and po2 == ro2 and pt and po and po2:
+            exact_matches += 1
+        if po == ro and po2 == ro2 and po and po2:
+            partial_matches += 1
+        if prediction == "":
+            empty_predictions += 1
+    total = len(references)
+    return {
+        "total": total,
+        "exact_match": round(exact_matches / total, 4) if total else 0.0,
+        "partial_match": round(partial_matches / total, 4) if total else 0.0,
+        "empty_ratio": round(empty_predictions / total, 4) if total else 0.0
+    }
+
+def run_single(mode: str, data_dir: str, limit: int, seed: int) -> Dict[str, Any]:
+    """在当前进程中以指定量化模式加载模型并跑完验证集"""
+    # 对比的是CPU推理；bf16 也固定在CPU上，否则会被 device_map=auto 放到GPU
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    import torch
+    import api
+
+    api.QUANTIZATION = mode
+    torch.set_num_threads(api.CPU_THREADS)
+
+    start = time.perf_counter()
+    if not api.load_model():
+        raise RuntimeError(f"模型加载失败: {api.load_state.get('last_error')}")
+    load_seconds = time.perf_counter() - start
+    rss_after_load = api._process_rss_bytes()
+
+    val_df = load_validation_set(data_dir)
+    if limit:
+        val_df = val_df.head(limit)
+
+    predictions, latencies, generated_tokens, decode_seconds = [], [], 0, 0.0
+    for i, row in val_df.iterrows():
+        torch.manual_seed(seed + i)
+        request_start = time.perf_counter()
+        result = api.generate_batch([(row.get('instruction', ''), row.get('input', ''))])[0]
+        latencies.append((time.perf_counter() - request_start) * 1000)
+        predictions.append(clean_prediction(result["prediction"]))
+        generated_tokens += result["metadata"]["generated_tokens"]
+        decode_seconds += result["metadata"]["decode_ms"] / 1000
+        if (i + 1) % 10 == 0:
+            logger.info(f"[{mode}] 已完成 {i + 1}/{len(val_df)} 条预测")
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "model_format": api.model_format,
+        "load_seconds": round(load_seconds, 2),
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2)
+        },
+        "tokens_per_second": round(generated_tokens / decode_seconds, 2) if decode_seconds > 0 else 0.0,
+        "memory_mb": {
+            "weights": round(api.model.get_memory_footprint() / 2**20, 1),
+            "rss_after_load": round(rss_after_load / 2**20, 1),
+            # ru_maxrss 在Linux上以KB为单位
+            "peak_rss": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        },
+        "accuracy": score_predictions(predictions, val_df['output'].tolist())
+    }
+
+def run_isolated(mode: str, args) -> Dict[str, Any]:
+    """在子进程中运行一种模式，结果通过临时JSON文件传回"""
+    result_path = f"{args.output or 'quant_results.json'}.{mode}.tmp"
+    command = [
+        sys.executable, os.path.abspath(__file__), "--single", mode,
+        "--data-dir", args.data_dir, "--limit", str(args.limit),
+        "--seed", str(args.seed), "--output", result_path
+    ]
+    logger.info(f"开始测试量化模式: {mode}")
+    subprocess.run(command, check=True)
+    try:
+        with open(result_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    finally:
+        os.remove(result_path)
+
+def run_remote(url: str, data_dir: str, limit: int, bucket_size: int = 0) -> Dict[str, Any]:
+    """把验证集一次提交到 /predict_batch，按同样的指标评分"""
+    import requests
+
+    val_df = load_validation_set(data_dir)
+    if limit:
+        val_df = val_df.head(limit)
+    items = [{"instruction": row.get('instruction', ''), "input": row.get('input', '')} for _, row in val_df.iterrows()]
+    payload = {"items": items}
+    if bucket_size:
+        payload["bucket_size"] = bucket_size
+
+    logger.info(f"提交 {len(items)} 条验证样本到 {url}/predict_batch")
+    response = requests.post(url.rstrip("/") + "/predict_batch", json=payload)
+    response.raise_for_status()
+    body = response.json()
+    predictions = [clean_prediction(p["prediction"]) for p in body["predictions"]]
+    model_info = requests.get(url.rstrip("/") + "/model_info").json()
+    return {
+        "mode": model_info.get("quantization", "none"),
+        "model_format": model_info.get("model_format"),
+        "batch": body["metadata"],
+        "accuracy": score_predictions(predictions, val_df['output'].tolist())
+    }
+
+def print_comparison(results: List[Dict[str, Any]]):
+    print("\n===== 量化推理对比 =====")
+    print(f"{'模式':<6}{'p50(ms)':>10}{'mean(ms)':>10}{'tok/s':>8}{'权重(MB)':>10}{'RSS(MB)':>10}{'峰值(MB)':>10}{'完全匹配':>10}{'部分匹配':>10}{'不合规':>8}")
+    for r in results:
+        memory, accuracy = r["memory_mb"], r["accuracy"]
+        print(f"{r['mode']:<6}{r['latency_ms']['p50']:>10}{r['latency_ms']['mean']:>10}{r['tokens_per_second']:>8}"
+              f"{memory['weights']:>10}{memory['rss_after_load']:>10}{memory['peak_rss']:>10}"
+              f"{accuracy['exact_match']:>10.4f}{accuracy['partial_match']:>10.4f}{accuracy['empty_ratio']:>8.4f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU量化推理对比工具")
+    parser.add_argument("--modes", type=str, default="none,int8,int4", help="逗号分隔的量化模式（none 为 bf16）")
+    parser.add_argument("--data-dir", type=str, default=DEFAULT_DATA_DIR, help="alpaca 微调数据目录")
+    parser.add_argument("--limit", type=int, default=0, help="只评估验证集前 N 条，为 0 时评估全部")
+    parser.add_argument("--seed", type=int, default=42, help="采样随机种子（每条样本为 seed + 序号）")
+    parser.add_argument("--output", type=str, default="", help="将结果保存为JSON文件")
+    parser.add_argument("--url", type=str, default="", help="评估已运行的API服务（/predict_batch），不在本地加载模型")
+    parser.add_argument("--bucket-size", type=int, default=0, help="--url 模式下每次批量生成的条数，为 0 时使用服务端默认值")
+    parser.add_argument("--single", type=str, default="", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.url:
+        result = run_remote(args.url, args.data_dir, args.limit, args.bucket_size)
+        accuracy, batch = result["accuracy"], result["batch"]
+        print(f"\n===== {result['model_format']} ({result['mode']}) =====")
+        print(f"样本数: {accuracy['total']}  耗时: {batch['elapsed_ms'] / 1000:.1f}s  吞吐量: {batch['items_per_second']} 条/s")
+        print(f"完全匹配: {accuracy['exact_match']:.4f}  部分匹配: {accuracy['partial_match']:.4f}  不合规: {accuracy['empty_ratio']:.4f}")
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump({"config": vars(args), "results": [result], "finished_at": datetime.now().isoformat()},
+                          f, ensure_ascii=False, indent=2)
+        return
+
+    if args.single:
+        result = run_single(args.single, args.data_dir, args.limit, args.seed)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        return
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    results = [run_isolated(mode, args) for mode in modes]
+    print_comparison(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                "config": vars(args),
+                "results": results,
+                "finished_at": datetime.now().isoformat()
+            }, f, ensure_ascii=False, indent=2)
+        logger.info(f"结果已保存到: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+"""
+CPU多副本工作进程池
+在无GPU的机器上，一个 api.py 进程只有一份模型、一个推理线程，多核利用不充分。
+本模块启动一个监督进程：
+
+  - transformers 后端：先在监督进程中加载模型，再 fork 出 N 个工作进程，
+    权重页按写时复制共享，不会占用 N 份内存；
+    llamacpp 后端：各工作进程自行加载，GGUF 以 mmap 方式映射，权重同样共享操作系统的页缓存
+  - 每个工作进程绑定到一组CPU核（sched_setaffinity），推理线程数等于核数
+  - 另 fork 一个路由进程监听对外端口，把 /predict、/predict/stream、/predict_batch
+    转发给当前在途请求最少的就绪工作进程
+  - 工作进程或路由进程退出后由监督进程重新 fork
+
+    MEMO_QUANTIZATION=int8 python worker_pool.py --workers 4 --port 8000
+
+工作进程只监听本机端口（--worker-base-port 起），各自的 /metrics、/model_info 可直接访问；
+路由进程的 /workers 给出各工作进程的状态。
+"""
+
+import os
+
+# 工作进程池只用于CPU推理；fork 之后子进程不能使用父进程初始化过的CUDA
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+import sys
+import time
+import signal
+import asyncio
+import argparse
+import logging
+import threading
+import requests
+import uvicorn
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Callable
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import Response, JSONResponse, StreamingResponse, PlainTextResponse
+
+import torch
+import api
+from metrics import MetricsRegistry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 工作进程数，为 0 时按 可用核数 / MEMO_CORES_PER_WORKER 计算
+NUM_WORKERS = int(os.environ.get("MEMO_WORKERS", "0"))
+# 每个工作进程绑定的核数，为 0 时把可用核平均分给各工作进程
+CORES_PER_WORKER = int(os.environ.get("MEMO_CORES_PER_WORKER", "0"))
+# 工作进程监听 127.0.0.1 上从该端口开始的连续端口
+WORKER_BASE_PORT = int(os.environ.get("MEMO_WORKER_BASE_PORT", "8100"))
+# 路由进程检查各工作进程 /ready 的间隔（秒）
+HEALTH_CHECK_INTERVAL_SECONDS = float(os.environ.get("MEMO_HEALTH_CHECK_INTERVAL_SECONDS", "2"))
+# 路由进程同时转发的最大请求数
+ROUTER_MAX_CONCURRENCY = int(os.environ.get("MEMO_ROUTER_MAX_CONCURRENCY", "64"))
+# 子进程连续快速退出时，重新 fork 前的等待时间（秒）
+RESTART_BACKOFF_SECONDS = float(os.environ.get("MEMO_RESTART_BACKOFF_SECONDS", "5"))
+
+# 原样转发给工作进程 / 客户端的请求头和响应头
+FORWARD_REQUEST_HEADERS = ("content-type", "x-deadline-ms")
+FORWARD_RESPONSE_HEADERS = ("content-type", "retry-after", "cache-control")
+
+def assign_cores(num_workers: int, cores_per_worker: int) -> List[List[int]]:
+    """把当前进程可用的CPU核切分给各工作进程，返回每个工作进程的核列表"""
+    available = sorted(os.sched_getaffinity(0))
+    if num_workers <= 0:
+        num_workers = max(1, len(available) // cores_per_worker) if cores_per_worker > 0 else 1
+    if cores_per_worker <= 0:
+        cores_per_worker = max(1, len(available) // num_workers)
+    if num_workers * cores_per_worker > len(available):
+        logger.warning(
+            f"{num_workers} 个工作进程 × {cores_per_worker} 核超过可用的 {len(available)} 核，部分核将被多个工作进程共用"
+        )
+    return [
+        [available[(i * cores_per_worker + j) % len(available)] for j in range(cores_per_worker)]
+        for i in range(num_workers)
+    ]
+
+def preload_backend() -> bool:
+    """在监督进程中加载模型，工作进程 fork 后共享权重（仅 transformers 后端）
+
+    加载时只用1个线程：OpenMP 线程池在 fork 后的子进程中不可用，父进程不能先启动它。
+    """
+    api.backend = api.create_backend(api.BACKEND)
+    if api.backend.name != "transformers":
+        # llamacpp 以 mmap 加载GGUF，各工作进程自行加载即可共享页缓存；mock 后端不需要预加载
+        return True
+    api.CPU_THREADS = 1
+    torch.set_num_threads(1)
+    logger.info("在监督进程中预加载模型（工作进程fork后共享权重）...")
+    start = time.perf_counter()
+    if not api.backend.load():
+        logger.error(f"模型预加载失败: {api.load_state.get('last_error')}")
+        return False
+    logger.info(f"模型预加载完成，耗时 {time.perf_counter() - start:.1f}s")
+    return True
+
+def run_worker(index: int, port: int, cores: List[int]):
+    """工作进程：绑定CPU核后运行 api.py 的服务（预热在工作进程内进行）"""
+    os.sched_setaffinity(0, cores)
+    threads = len(cores)
+    api.CPU_THREADS = threads
+    torch.set_num_threads(threads)
+    if api.backend is None:
+        api.backend = api.create_backend(api.BACKEND)
+    if isinstance(api.backend, api.LlamaCppBackend):
+        api.backend.n_threads = threads
+    logger.info(f"工作进程 {index} (pid {os.getpid()}) 启动: 端口 {port}, CPU核 {cores}")
+    uvicorn.run(api.app, host="127.0.0.1", port=port, log_level="warning", timeout_keep_alive=api.KEEP_ALIVE_SECONDS)
+
+class WorkerRouter:
+    """按在途请求数选择工作进程（最少优先，相同时选累计请求数少的）"""
+
+    def __init__(self, ports: List[int]):
+        self.workers = [{
+            "index": index,
+            "url": f"http://127.0.0.1:{port}",
+            "ready": False,
+            "inflight": 0,
+            "requests": 0,
+            "errors": 0,
+            "status": "starting"
+        } for index, port in enumerate(ports)]
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(ports), pool_maxsize=ROUTER_MAX_CONCURRENCY)
+        self.session.mount("http://", adapter)
+
+    def acquire(self, exclude: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        with self.lock:
+            candidates = [w for w in self.workers if w["ready"] and w is not exclude]
+            if not candidates:
+                raise HTTPException(status_code=503, detail="没有就绪的工作进程", headers={"Retry-After": "5"})
+            worker = min(candidates, key=lambda w: (w["inflight"], w["requests"]))
+            worker["inflight"] += 1
+            worker["requests"] += 1
+            return worker
+
+    def release(self, worker: Dict[str, Any], failed: bool = False):
+        with self.lock:
+            worker["inflight"] -= 1
+            if failed:
+                # 连接失败说明工作进程已退出或正在重启，等健康检查恢复
+                worker["errors"] += 1
+                worker["ready"] = False
+                worker["status"] = "unreachable"
+
+    def check_health(self):
+        for worker in self.workers:
+            try:
+                response = self.session.get(worker["url"] + "/ready", timeout=2)
+                status = response.json().get("status", "unknown")
+                ready = response.status_code == 200
+            except (requests.RequestException, ValueError):
+                status, ready = "unreachable", False
+            with self.lock:
+                worker["ready"] = ready
+                worker["status"] = "ready" if ready else status
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [dict(worker) for worker in self.workers]
+
+class RelayResponse(StreamingResponse):
+    """转发工作进程的流式响应，响应结束（完成、出错或客户端中途断开）时调用 on_close
+
+    客户端在开始转发前就断开时，中继生成器不会启动，生成器里的 finally 也不会执行；
+    因此关闭上游连接、释放工作进程放在响应本身的 finally 中。
+    """
+
+    def __init__(self, content, on_close: Callable[[], None], **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+def create_router_app(ports: List[int]) -> FastAPI:
+    """路由进程的服务：对外接口与 api.py 相同，预测请求转发给工作进程"""
+    router_app = FastAPI(title="LLM Activity Prediction Router", version="1.0.0")
+    router = WorkerRouter(ports)
+    executor = ThreadPoolExecutor(max_workers=ROUTER_MAX_CONCURRENCY)
+
+    registry = MetricsRegistry()
+    routed_total = registry.counter("memo_router_requests_total", "路由转发的请求数（按工作进程和结果）", ["worker", "status"])
+    registry.gauge("memo_router_inflight", "各工作进程的在途请求数", ["worker"],
+                   callback=lambda: {(str(w["index"]),): w["inflight"] for w in router.stats()})
+    registry.gauge("memo_router_workers_ready", "就绪的工作进程数",
+                   callback=lambda: {(): sum(1 for w in router.stats() if w["ready"])})
+
+    async def health_loop():
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(executor, router.check_health)
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL_SECONDS)
+
+    @router_app.on_event("startup")
+    async def startup_event():
+        router_app.state.health_task = asyncio.create_task(health_loop())
+        logger.info(f"路由进程启动: {len(ports)} 个工作进程")
+
+    def post(worker: Dict[str, Any], path: str, body: bytes, headers: Dict[str, str], stream: bool = False):
+        # 只限制连接时间，生成耗时由工作进程按截止时间控制
+        return router.session.post(worker["url"] + path, data=body, headers=headers, stream=stream, timeout=(2, None))
+
+    def buffered(response: requests.Response, worker: Dict[str, Any]) -> Response:
+        """读完工作进程的响应并释放该工作进程"""
+        content = response.content
+        response.close()
+        router.release(worker)
+        return Response(content=content, status_code=response.status_code,
+                        headers=response_headers(response, worker), media_type=response.headers.get("content-type"))
+
+    def response_headers(response: requests.Response, worker: Dict[str, Any]) -> Dict[str, str]:
+        headers = {name: value for name, value in response.headers.items()
+                   if name.lower() in FORWARD_RESPONSE_HEADERS and name.lower() != "content-type"}
+        headers["X-Worker"] = str(worker["index"])
+        return headers
+
+    async def forward(request: Request, path: str, stream: bool = False):
+        """转发给最空闲的工作进程；连接失败或被过载拒绝（503）时换一个工作进程重试一次"""
+        body = await request.body()
+        headers = {name: value for name, value in request.headers.items() if name.lower() in FORWARD_REQUEST_HEADERS}
+        loop = asyncio.get_running_loop()
+
+        tried = None
+        shed = None  # 第一个工作进程的 503 响应，重试也失败时返回它（带 Retry-After）
+        for _ in range(2):
+            try:
+                worker = router.acquire(exclude=tried)
+            except HTTPException:
+                if shed is not None:
+                    return shed
+                raise
+            try:
+                response = await loop.run_in_executor(executor, post, worker, path, body, headers, stream)
+            except requests.RequestException as e:
+                router.release(worker, failed=True)
+                routed_total.inc(worker=str(worker["index"]), status="error")
+                logger.warning(f"转发到工作进程 {worker['index']} 失败: {e}")
+                tried = worker
+                continue
+            routed_total.inc(worker=str(worker["index"]), status=str(response.status_code))
+
+            if response.status_code == 503 and shed is None:
+                shed = buffered(response, worker)
+                tried = worker
+                continue
+            if not stream or response.status_code != 200:
+                return buffered(response, worker)
+
+            def relay(response=response):
+                for chunk in response.iter_content(chunk_size=None):
+                    yield chunk
+
+            def close(response=response, worker=worker):
+                response.close()
+                router.release(worker)
+
+            return RelayResponse(relay(), on_close=close, status_code=200, headers=response_headers(response, worker),
+                                 media_type=response.headers.get("content-type"))
+
+        if shed is not None:
+            return shed
+        raise HTTPException(status_code=502, detail="工作进程不可用", headers={"Retry-After": "5"})
+
+    @router_app.post("/predict")
+    async def predict(request: Request):
+        return await forward(request, "/predict")
+
+    @router_app.post("/predict/stream")
+    async def predict_stream(request: Request):
+        return await forward(request, "/predict/stream", stream=True)
+
+    @router_app.post("/predict_batch")
+    async def predict_batch(request: Request):
+        return await forward(request, "/predict_batch")
+
+    @router_app.get("/")
+    async def root():
+        return {"message": "LLM Activity Prediction Router", "status": "running"}
+
+    @router_app.get("/live")
+    async def liveness():
+        return {"status": "alive", "timestamp": time.time()}
+
+    @router_app.get("/ready")
+    async def readiness():
+        """至少一个工作进程就绪即可接收请求"""
+        workers = router.stats()
+        ready = sum(1 for w in workers if w["ready"])
+        body = {"status": "ready" if ready else "loading", "workers_ready": ready, "workers": len(workers)}
+        if ready:
+            return body
+        return JSONResponse(body, status_code=503, headers={"Retry-After": "5"})
+
+    @router_app.get("/workers")
+    async def workers():
+        """各工作进程的就绪状态、在途请求数和累计请求数"""
+        return {"workers": router.stats()}
+
+    @router_app.get("/model_info")
+    async def model_info():
+        """任一就绪工作进程的模型信息，附工作进程列表"""
+        info = {}
+        for worker in router.stats():
+            if worker["ready"]:
+                try:
+                    info = router.session.get(worker["url"] + "/model_info", timeout=2).json()
+                    break
+                except (requests.RequestException, ValueError):
+                    continue
+        return {**info, "workers": router.stats()}
+
+    @router_app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics_endpoint():
+        """路由进程自身的指标；各工作进程的指标在其端口的 /metrics"""
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+    return router_app
+
+def run_router(host: str, port: int, worker_ports: List[int]):
+    logger.info(f"路由进程 (pid {os.getpid()}) 监听 {host}:{port}")
+    uvicorn.run(create_router_app(worker_ports), host=host, port=port, log_level="info",
+                timeout_keep_alive=api.KEEP_ALIVE_SECONDS)
+
+def spawn(target, *args) -> int:
+    """fork 一个子进程运行 target，子进程结束后直接退出"""
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            target(*args)
+        except BaseException as e:
+            logger.error(f"子进程异常退出: {e}")
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+def supervise(args):
+    core_sets = assign_cores(args.workers, args.cores_per_worker)
+    worker_ports = [args.worker_base_port + i for i in range(len(core_sets))]
+    logger.info(f"启动 {len(core_sets)} 个工作进程，每个 {len(core_sets[0])} 核")
+
+    if not args.no_preload and not preload_backend():
+        sys.exit(1)
+
+    # pid -> (名称, 启动函数, 参数, 启动时间)
+    children = {}
+
+    def start(name: str, target, *target_args):
+        pid = spawn(target, *target_args)
+        children[pid] = (name, target, target_args, time.time())
+
+    for index, (port, cores) in enumerate(zip(worker_ports, core_sets)):
+        start(f"工作进程 {index}", run_worker, index, port, cores)
+    start("路由进程", run_router, args.host, args.port, worker_ports)
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        if pid not in children:
+            continue
+        name, target, target_args, started_at = children.pop(pid)
+        if stopping:
+            continue
+        logger.warning(f"{name} (pid {pid}) 已退出 (状态 {os.waitstatus_to_exitcode(status)})，重新启动")
+        if time.time() - started_at < RESTART_BACKOFF_SECONDS:
+            time.sleep(RESTART_BACKOFF_SECONDS)
+        start(name, target, *target_args)
+    logger.info("工作进程池已停止")
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU多副本工作进程池")
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS, help="工作进程数，为 0 时按可用核数计算")
+    parser.add_argument("--cores-per-worker", type=int, default=CORES_PER_WORKER, help="每个工作进程绑定的核数，为 0 时平均分配")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="路由进程监听地址")
+    parser.add_argument("--port", type=int, default=8000, help="路由进程监听端口（Windows端连接的端口）")
+    parser.add_argument("--worker-base-port", type=int, default=WORKER_BASE_PORT, help="工作进程的起始端口（仅本机）")
+    parser.add_argument("--no-preload", action="store_true", help="不在监督进程中预加载，各工作进程自行加载模型")
+
+    args = parser.parse_args()
+    if args.workers <= 0 and args.cores_per_worker <= 0:
+        # 默认每个工作进程4核：单个请求的解码在4核以上提升已不明显
+        args.cores_per_worker = 4
+    supervise(args)
+
+if __name__ == "__main__":
+    main()
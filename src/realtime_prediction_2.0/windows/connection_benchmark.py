@@ -0,0 +1,131 @@
+"""
+连接复用对比工具
+依次用两种方式向API服务发送相同的请求，对比每个请求的往返延迟：
+
+  new    : 每个请求调用 requests.get/post（每次新建TCP连接，经SSH隧道时还要在远端新建一次转发连接）
+  pooled : 所有请求共用一个 requests.Session（与 LLMPredictor 相同的连接池和 keep-alive）
+
+/health 几乎没有服务端耗时，反映纯网络往返；/predict 使用固定的活动序列，
+第一条之后都命中服务端的预测缓存，反映一次预测请求除推理外的开销。
+
+    python connection_benchmark.py --url http://localhost:8000 --requests 50
+    python connection_benchmark.py --interval 30   # 按预测冷却间隔发送，检查空闲连接是否被服务端关闭
+"""
+
+import json
+import time
+import argparse
+import logging
+import requests
+from datetime import datetime
+from typing import List, Dict, Any, Callable
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SAMPLE_PAYLOAD = {
+    "instruction": "根据用户最近的活动序列，预测下一个最有可能的用户活动。",
+    "input": "用户活动序列:\n" + "\n".join([
+        "2025-06-29 15:30:00 - 启动应用: chrome.exe",
+        "2025-06-29 15:30:05 - 切换到窗口: GitHub - Microsoft/vscode (应用: chrome.exe)",
+        "2025-06-29 15:31:10 - 切换到窗口: main.py - Visual Studio Code (应用: Code.exe)"
+    ])
+}
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """最近秩法计算分位数，sorted_values 需已排序"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def create_session(pool_size: int = 4) -> requests.Session:
+    """与 LLMPredictor._create_session 相同的会话配置"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def measure(send: Callable[[], requests.Response], count: int, interval: float) -> Dict[str, Any]:
+    """顺序发送 count 个请求，返回往返延迟统计（毫秒）"""
+    latencies, errors = [], 0
+    for i in range(count):
+        if i and interval:
+            time.sleep(interval)
+        start = time.perf_counter()
+        try:
+            response = send()
+            response.content
+            if response.status_code != 200:
+                errors += 1
+                continue
+        except requests.RequestException as e:
+            logger.warning(f"请求失败: {e}")
+            errors += 1
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    first = latencies[0] if latencies else 0.0
+    latencies.sort()
+    return {
+        "requests": count,
+        "errors": errors,
+        "first_ms": round(first, 2),
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2)
+    }
+
+def run(url: str, count: int, interval: float, connect_timeout: float, read_timeout: float) -> Dict[str, Dict[str, Any]]:
+    url = url.rstrip("/")
+    timeout = (connect_timeout, read_timeout)
+    session = create_session()
+    # 先让 /predict 的结果进入服务端缓存，两种方式测到的都是缓存命中
+    requests.post(f"{url}/predict", json=SAMPLE_PAYLOAD, timeout=timeout)
+
+    results = {}
+    for endpoint, method, payload in (("/health", "get", None), ("/predict", "post", SAMPLE_PAYLOAD)):
+        for mode, client in (("new", requests), ("pooled", session)):
+            logger.info(f"测试 {endpoint} ({mode}): {count} 个请求")
+            send = getattr(client, method)
+            kwargs = {"json": payload} if payload is not None else {}
+            results[f"{endpoint} {mode}"] = measure(lambda: send(f"{url}{endpoint}", timeout=timeout, **kwargs), count, interval)
+    session.close()
+    return results
+
+def print_results(results: Dict[str, Dict[str, Any]]):
+    print("\n===== 连接复用对比 =====")
+    print(f"{'请求':<20}{'首个(ms)':>10}{'mean(ms)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'错误':>6}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['first_ms']:>10}{r['mean_ms']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['errors']:>6}")
+    for endpoint in ("/health", "/predict"):
+        new, pooled = results[f"{endpoint} new"], results[f"{endpoint} pooled"]
+        saved = new["p50_ms"] - pooled["p50_ms"]
+        print(f"{endpoint}: 复用连接后 p50 降低 {saved:.2f}ms"
+              + (f" ({saved / new['p50_ms']:.0%})" if new["p50_ms"] else ""))
+
+def main():
+    parser = argparse.ArgumentParser(description="连接复用对比工具")
+    parser.add_argument("--url", type=str, default="http://localhost:8000", help="API服务地址（经SSH隧道时为本地转发端口）")
+    parser.add_argument("--requests", type=int, default=50, help="每种方式、每个接口的请求数")
+    parser.add_argument("--interval", type=float, default=0.0, help="相邻请求的间隔（秒）")
+    parser.add_argument("--connect-timeout", type=float, default=3, help="连接超时（秒）")
+    parser.add_argument("--timeout", type=float, default=15, help="读取超时（秒）")
+    parser.add_argument("--output", type=str, default="", help="将结果保存为JSON文件")
+
+    args = parser.parse_args()
+    results = run(args.url, args.requests, args.interval, args.connect_timeout, args.timeout)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                "config": vars(args),
+                "results": results,
+                "finished_at": datetime.now().isoformat()
+            }, f, ensure_ascii=False, indent=2)
+        logger.info(f"结果已保存到: {args.output}")
+
+if __name__ == "__main__":
+    main()
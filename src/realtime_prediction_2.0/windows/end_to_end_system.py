@@ -18,11 +18,14 @@ import webbrowser
 import urllib.parse
 from datetime import datetime, timedelta
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Dict, List, Any, Optional, Tuple
+from typing import Dict, List, Any, Optional, Tuple, Callable
 import re
 import atexit
 
+from local_predictor import NGramPredictor
+
 # 导入现有模块
 try:
     from activity_monitor import ActivityMonitor
@@ -577,6 +580,86 @@ class SmartApplicationManager:
         except Exception as e:
             logger.error(f"定期清理出错: {e}")
 
+class CircuitBreaker:
+    """云端调用熔断器
+    
+    closed: 正常请求云端，连续失败 failure_threshold 次后打开
+    open: 请求直接失败（使用本地预测），退避时间到后由后台探测检查服务端
+    half_open: 正在探测；成功则关闭，失败则重新打开并加倍退避时间（不超过 max_backoff）
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold: int = 3, base_backoff: float = 5.0, max_backoff: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.state = self.CLOSED
+        self.failures = 0
+        self.backoff = base_backoff
+        self.open_until = 0.0
+        self.changed = threading.Condition()
+    
+    def start_open(self):
+        """以打开状态启动，后台探测立即检查服务端"""
+        with self.changed:
+            self.state = self.OPEN
+            self.open_until = time.monotonic()
+            self.changed.notify_all()
+    
+    def allow_request(self) -> bool:
+        """是否可以请求云端；打开期间直接返回 False，不必等待请求超时"""
+        return self.state == self.CLOSED
+    
+    def record_success(self):
+        with self.changed:
+            if self.state != self.CLOSED:
+                logger.info("🟢 云服务器LLM已就绪，熔断器关闭")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.backoff = self.base_backoff
+            self.changed.notify_all()
+    
+    def record_failure(self, reason: str):
+        with self.changed:
+            if self.state == self.CLOSED:
+                self.failures += 1
+                if self.failures < self.failure_threshold:
+                    return
+            self._open(reason, escalate=True)
+    
+    def trip(self, reason: str, escalate: bool = True):
+        """立即打开熔断器；escalate=False 时按基础退避时间重试（服务端可达但尚未就绪）"""
+        with self.changed:
+            self._open(reason, escalate)
+    
+    def _open(self, reason: str, escalate: bool):
+        if self.state == self.HALF_OPEN:
+            self.backoff = min(self.backoff * 2, self.max_backoff) if escalate else self.base_backoff
+        self.state = self.OPEN
+        self.open_until = time.monotonic() + self.backoff
+        logger.warning(f"🔴 熔断器打开 ({reason})，{self.backoff:.0f}秒后探测服务端")
+        self.changed.notify_all()
+    
+    def wait_for_probe(self, stop_event: threading.Event) -> bool:
+        """阻塞到需要探测服务端（进入 half_open），stop_event 被设置时返回 False"""
+        with self.changed:
+            while not stop_event.is_set():
+                if self.state == self.OPEN:
+                    remaining = self.open_until - time.monotonic()
+                    if remaining <= 0:
+                        self.state = self.HALF_OPEN
+                        return True
+                    self.changed.wait(remaining)
+                else:
+                    self.changed.wait()
+            return False
+    
+    def wake(self):
+        with self.changed:
+            self.changed.notify_all()
+
 # 更新LLMPredictor类的解析方法
 class LLMPredictor:
     """LLM预测器 - 增强版本"""
@@ -585,6 +668,10 @@ class LLMPredictor:
         self.config = config
         self.use_ssh_tunnel = config['llm'].get('use_ssh_tunnel', True)
         self.ssh_tunnel_manager = None
+        self.session = self._create_session()
+        # 非流式请求在有界线程池中发送，与连接池同样大小：被放弃的请求不会无限堆积线程
+        self.request_executor = ThreadPoolExecutor(max_workers=config['llm'].get('pool_size', 4),
+                                                   thread_name_prefix="llm-request")
         
         if self.use_ssh_tunnel:
             self.api_url = f"http://localhost:{config['ssh']['tunnel_local_port']}"
@@ -596,80 +683,237 @@ class LLMPredictor:
         else:
             self.api_url = f"http://{config['llm']['server_host']}:{config['llm']['server_port']}"
         
-        self.use_local_backup = False
+        # 熔断器取代一旦连接失败就不再尝试云端的本地备用标志：打开期间后台探测 /ready，服务端就绪后恢复
+        breaker_config = config.get('circuit_breaker', {})
+        self.breaker = CircuitBreaker(
+            failure_threshold=breaker_config.get('failure_threshold', 3),
+            base_backoff=breaker_config.get('base_backoff', 5),
+            max_backoff=breaker_config.get('max_backoff', 60)
+        )
+        self.probe_stop = threading.Event()
+        self.probe_thread = threading.Thread(target=self._probe_loop, daemon=True)
+        self.probe_thread.start()
+        self.local_predictor = self._load_local_predictor()
+        self.local_updates_since_save = 0
+        
+        # 级联预测：本地预测器足够确定时不请求云端
+        cascade_config = config.get('cascade', {})
+        self.cascade_enabled = cascade_config.get('enabled', True)
+        self.cascade_threshold = cascade_config.get('local_threshold', 0.6)
+        self.cascade_lock = threading.Lock()
+        # local: 本地直接给出; cloud: 升级到云端; fallback: 云端不可用时采用本地结果
+        # compared/agreed: 升级到云端时两层的第一候选应用是否一致
+        self.cascade_stats = {"requests": 0, "local": 0, "cloud": 0, "fallback": 0, "compared": 0, "agreed": 0}
+        self.tier_latencies = {"local": deque(maxlen=200), "cloud": deque(maxlen=200)}
         atexit.register(self._cleanup)
-        self._test_connection()
+        # 不在启动时阻塞等待服务端：熔断器以打开状态启动，由后台探测在服务端就绪后关闭
+        logger.info(f"⏳ 等待云服务器 {self.api_url} 就绪，在此之前使用本地预测器")
+        self.breaker.start_open()
+    
+    def _create_session(self) -> requests.Session:
+        """所有请求共用的HTTP会话（连接池 + keep-alive）
+        
+        经SSH隧道每新建一个TCP连接，都要由ssh在远端再建立一次转发连接；复用连接后只有第一个请求承担这部分开销。
+        服务端的 keep-alive 超时（MEMO_KEEP_ALIVE_SECONDS）需要长于预测间隔，空闲连接才不会被关闭。
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.config['llm'].get('pool_size', 4))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+    
+    def _timeout(self, read_timeout: Optional[float] = None) -> Tuple[float, float]:
+        """(连接超时, 读取超时)；连接超时单独设置，隧道断开时不必等满整个读取超时"""
+        if read_timeout is None:
+            read_timeout = self.config['llm'].get('timeout', 15)
+        return self.config['llm'].get('connect_timeout', 3), read_timeout
     
     def _test_local_connection(self) -> bool:
         """测试本地连接"""
         try:
-            response = requests.get(f"http://localhost:{self.config['ssh']['tunnel_local_port']}/health", timeout=3)
+            response = self.session.get(f"http://localhost:{self.config['ssh']['tunnel_local_port']}/health", timeout=self._timeout(3))
             return response.status_code == 200
         except:
             return False
     
+    def _load_local_predictor(self) -> NGramPredictor:
+        """加载本地n-gram预测器；还没有模型文件时从 activity_data 中的历史活动训练"""
+        local_config = self.config.get('local_model', {})
+        model_path = local_config.get('path', 'local_predictor.json.gz')
+        if os.path.exists(model_path):
+            try:
+                predictor = NGramPredictor.load(model_path)
+                logger.info(f"✓ 已加载本地预测模型: {model_path} ({predictor.stats()})")
+                return predictor
+            except Exception as e:
+                logger.warning(f"加载本地预测模型失败: {e}")
+        
+        predictor = NGramPredictor(max_order=local_config.get('max_order', 3))
+        data_dir = local_config.get('data_dir', 'activity_data')
+        if os.path.isdir(data_dir):
+            try:
+                learned = predictor.train_from_activity_data(data_dir)
+                predictor.save(model_path)
+                logger.info(f"✓ 已从 {data_dir} 学习 {learned} 条活动，本地预测模型保存到 {model_path}")
+            except Exception as e:
+                logger.warning(f"从历史活动训练本地预测模型失败: {e}")
+        return predictor
+    
+    def observe_activity(self, activity_line: str):
+        """用新活动在线更新本地预测器，每 local_model.save_interval 条保存一次"""
+        if not self.local_predictor.observe(activity_line):
+            return
+        self.local_updates_since_save += 1
+        if self.local_updates_since_save >= self.config.get('local_model', {}).get('save_interval', 20):
+            self._save_local_predictor()
+    
+    def _save_local_predictor(self):
+        try:
+            self.local_predictor.save(self.config.get('local_model', {}).get('path', 'local_predictor.json.gz'))
+            self.local_updates_since_save = 0
+        except Exception as e:
+            logger.warning(f"保存本地预测模型失败: {e}")
+    
     def _cleanup(self):
         """清理资源"""
+        self.probe_stop.set()
+        self.breaker.wake()
+        if self.local_updates_since_save:
+            self._save_local_predictor()
+        self.request_executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
         if self.ssh_tunnel_manager:
             self.ssh_tunnel_manager.close_tunnel()
     
-    def _test_connection(self):
-        """测试连接"""
-        max_retries = 3
-        for attempt in range(max_retries):
+    def _check_ready(self, read_timeout: float = 10) -> Tuple[bool, Dict[str, Any]]:
+        """查询服务端就绪状态，返回 (是否就绪, 状态)；旧版服务端没有 /ready 时按 /health 判断"""
+        response = self.session.get(f"{self.api_url}/ready", timeout=self._timeout(read_timeout))
+        if response.status_code == 404:
+            response = self.session.get(f"{self.api_url}/health", timeout=self._timeout(read_timeout))
+            state = response.json() if response.status_code == 200 else {}
+            logger.info(f"模型状态: {state.get('model_status')}")
+            return state.get("model_status") == "loaded", {"status": state.get("model_status", "unknown")}
+        return response.status_code == 200, response.json()
+    
+    def _probe_loop(self):
+        """熔断器打开后，按退避时间在后台探测服务端；就绪则关闭熔断器，恢复使用云端"""
+        probe_timeout = self.config.get('circuit_breaker', {}).get('probe_timeout', 3)
+        while self.breaker.wait_for_probe(self.probe_stop):
             try:
-                logger.info(f"测试连接到: {self.api_url} (尝试 {attempt + 1}/{max_retries})")
-                
-                response = requests.get(f"{self.api_url}/health", timeout=10)
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    logger.info(f"连接成功！")
-                    logger.info(f"模型状态: {result.get('model_status')}")
-                    
-                    if result.get("model_status") == "loaded":
-                        logger.info("✓ 云服务器LLM模型已就绪")
-                        self.use_local_backup = False
-                        return
-                    else:
-                        logger.warning("连接成功但模型未加载")
-                        
-                else:
-                    logger.warning(f"连接响应异常: {response.status_code}")
-                    
-            except requests.exceptions.ConnectionError as e:
-                logger.warning(f"连接失败 (尝试 {attempt + 1}): 连接被拒绝")
-                if attempt < max_retries - 1:
-                    logger.info("等待5秒后重试...")
-                    time.sleep(5)
-                    
+                ready, state = self._check_ready(probe_timeout)
             except Exception as e:
-                logger.error(f"连接测试出错: {e}")
-                break
-        
-        logger.warning("无法连接到云服务器LLM，将使用本地备用模型")
-        self.use_local_backup = True
+                self.breaker.record_failure(f"探测失败: {type(e).__name__}")
+                continue
+            if ready:
+                self.breaker.record_success()
+            else:
+                # 服务端可达但模型仍在加载，不加倍退避，以便加载完成后尽快切回
+                self.breaker.trip(f"服务端未就绪: {state.get('status')}", escalate=False)
+    
+    def _record_response(self, status_code: int):
+        """按HTTP状态更新熔断器：5xx（503过载保护除外）计为失败，其余说明服务端可达"""
+        if status_code >= 500 and status_code != 503:
+            self.breaker.record_failure(f"HTTP {status_code}")
+        else:
+            self.breaker.record_success()
     
-    def predict_next_activity(self, activity_sequence: List[str]) -> Optional[Dict[str, Any]]:
-        """预测下一个用户活动"""
+    def predict_next_activity(self, activity_sequence: List[str],
+                              on_action: Optional[Callable[[Dict[str, Any]], None]] = None,
+                              cancel_event: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+        """预测下一个用户活动
+        
+        级联预测（cascade.enabled）：先由本地预测器预测，校准后的置信度不低于 cascade.local_threshold 时直接采用，
+        只有不确定的情况才请求云端LLM。
+        启用流式预测（llm.stream）时，服务端解码出应用/动作部分后会先以初步预测调用 on_action，
+        不必等整行生成完再开始预加载。cancel_event 被设置后（活动窗口已变化）尽快放弃本次预测并返回 None。
+        """
         try:
-            if not self.use_local_backup:
+            local_prediction = None
+            if self.cascade_enabled:
+                start = time.perf_counter()
+                local_prediction = self._predict_via_local_model(activity_sequence)
+                self._record_tier_latency("local", start)
+                if local_prediction and local_prediction['confidence'] >= self.cascade_threshold:
+                    logger.info(f"⚡ 本地预测置信度 {local_prediction['confidence']:.2f} ≥ {self.cascade_threshold}，不请求云端")
+                    self._record_cascade("local")
+                    return local_prediction
+            
+            if self.breaker.allow_request():
                 if self.ssh_tunnel_manager and not self.ssh_tunnel_manager.is_tunnel_alive():
                     logger.warning("SSH隧道已断开，尝试重新连接...")
                     if not self.ssh_tunnel_manager.create_tunnel():
                         logger.error("重新建立SSH隧道失败，切换到本地备用模型")
-                        self.use_local_backup = True
-                        return self._predict_via_local_backup(activity_sequence)
+                        self.breaker.trip("SSH隧道断开")
+                        return self._fallback_prediction(activity_sequence, local_prediction)
                 
-                return self._predict_via_cloud_api(activity_sequence)
+                start = time.perf_counter()
+                prediction = self._predict_via_cloud_api(activity_sequence, on_action, cancel_event)
+                if prediction is not None:
+                    self._record_tier_latency("cloud", start)
+                    self._record_cascade("cloud", local_prediction, prediction)
+                elif local_prediction is not None and not (cancel_event is not None and cancel_event.is_set()):
+                    logger.info("🏠 云端预测失败，使用本地预测结果")
+                    self._record_cascade("fallback")
+                    return local_prediction
+                return prediction
             else:
-                return self._predict_via_local_backup(activity_sequence)
+                return self._fallback_prediction(activity_sequence, local_prediction)
         except Exception as e:
             logger.error(f"预测失败: {e}")
             return None
     
-    def _predict_via_cloud_api(self, activity_sequence: List[str]) -> Optional[Dict[str, Any]]:
+    def _fallback_prediction(self, activity_sequence: List[str],
+                             local_prediction: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """云端不可用时使用本地预测（级联中已经算过的本地结果直接复用）"""
+        if self.cascade_enabled:
+            self._record_cascade("fallback")
+            logger.info("🏠 云端不可用，使用本地预测结果")
+            return local_prediction
+        return self._predict_via_local_backup(activity_sequence)
+    
+    def _record_tier_latency(self, tier: str, start: float):
+        with self.cascade_lock:
+            self.tier_latencies[tier].append((time.perf_counter() - start) * 1000)
+    
+    def _record_cascade(self, tier: str, local_prediction: Optional[Dict[str, Any]] = None,
+                        cloud_prediction: Optional[Dict[str, Any]] = None):
+        """记录本次预测由哪一层给出；请求了云端时比较两层的第一候选应用是否一致"""
+        with self.cascade_lock:
+            stats = self.cascade_stats
+            stats["requests"] += 1
+            stats[tier] += 1
+            if local_prediction and cloud_prediction:
+                stats["compared"] += 1
+                stats["agreed"] += int(local_prediction['app_name'] == cloud_prediction['app_name'])
+            report = stats["requests"] % self.config.get('cascade', {}).get('stats_interval', 20) == 0
+        if report:
+            logger.info(f"📊 级联预测统计: {self.get_cascade_stats()}")
+    
+    def get_cascade_stats(self) -> Dict[str, Any]:
+        """级联预测统计：升级到云端的比例、各层延迟（毫秒）和两层预测一致的比例"""
+        with self.cascade_lock:
+            stats = dict(self.cascade_stats)
+            latencies = {tier: sorted(values) for tier, values in self.tier_latencies.items()}
+        summary = {
+            "requests": stats["requests"],
+            "answered_locally": stats["local"],
+            "escalated": stats["cloud"],
+            "fallback": stats["fallback"],
+            "escalation_rate": round(stats["cloud"] / stats["requests"], 3) if stats["requests"] else 0.0,
+            "agreement_rate": round(stats["agreed"] / stats["compared"], 3) if stats["compared"] else None,
+            "breaker": self.breaker.state
+        }
+        for tier, values in latencies.items():
+            if values:
+                summary[f"{tier}_p50_ms"] = round(values[len(values) // 2], 2)
+                summary[f"{tier}_p95_ms"] = round(values[min(len(values) - 1, int(len(values) * 0.95))], 2)
+        return summary
+    
+    def _predict_via_cloud_api(self, activity_sequence: List[str],
+                               on_action: Optional[Callable[[Dict[str, Any]], None]] = None,
+                               cancel_event: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
         """通过云服务器API进行预测"""
+        timeout = self.config['llm'].get('timeout', 15)
         try:
             # 增强的指令，明确要求预测应用和内容
             payload = {
@@ -689,19 +933,39 @@ class LLMPredictor:
 2025-06-29 15:30:00 - 切换到窗口: GitHub - Microsoft/vscode (应用: chrome.exe)
 2025-06-29 15:30:00 - 访问网页: https://www.bilibili.com (应用: chrome.exe)
 """,
-                "input": "用户活动序列:\n" + "\n".join(activity_sequence)
+                "input": "用户活动序列:\n" + "\n".join(activity_sequence),
+                "top_k": self.config['llm'].get('top_k', 1),
+                "speculative": self.config['llm'].get('speculative', False),
+                "user_id": self.config['llm'].get('user_id'),
+                # 受限解码（只生成符合活动行格式的输出），为 None 时使用服务端默认设置
+                "constrained": self.config['llm'].get('constrained'),
+                # 与本地请求超时一致，超时后服务端不再为这条请求生成
+                "deadline_ms": timeout * 1000
             }
             
             logger.info("🔮 向云服务器LLM发送预测请求...")
             
-            response = requests.post(
-                f"{self.api_url}/predict",
-                json=payload,
-                timeout=15
-            )
+            if self.config['llm'].get('stream', False):
+                result = self._request_stream(payload, on_action, timeout, cancel_event)
+            else:
+                response = self._post_cancellable(f"{self.api_url}/predict", payload, timeout, cancel_event)
+                if response is None:
+                    return None
+                self._record_response(response.status_code)
+                if response.status_code == 200:
+                    result = response.json()
+                elif response.status_code == 503:
+                    logger.warning(f"⏳ 服务端繁忙，跳过本次预测 (Retry-After: {response.headers.get('Retry-After', '-')}s)")
+                    result = None
+                else:
+                    logger.error(f"❌ API请求失败: {response.status_code}")
+                    result = None
+            
+            if cancel_event is not None and cancel_event.is_set():
+                # 结果返回时活动窗口已变化，直接丢弃
+                return None
             
-            if response.status_code == 200:
-                result = response.json()
+            if result:
                 prediction_text = result.get("prediction", "")
                 confidence = result.get("confidence", 0.5)
                 
@@ -711,151 +975,148 @@ class LLMPredictor:
                 parsed_result = self._parse_prediction(prediction_text)
                 if parsed_result:
                     parsed_result["confidence"] = confidence
+                    parsed_result["alternatives"] = self._parse_candidates(result.get("candidates", [])[1:])
                     return parsed_result
                 else:
                     logger.warning("❌ 无法解析云服务器预测结果")
                     return None
             else:
-                logger.error(f"❌ API请求失败: {response.status_code}")
                 return None
                 
-        except Exception as e:
+        except requests.exceptions.RequestException as e:
+            if not (cancel_event is not None and cancel_event.is_set()):
+                self.breaker.record_failure(type(e).__name__)
             logger.error(f"❌ 云服务器API调用出错: {e}")
             return None
-    
-    def _predict_via_local_backup(self, activity_sequence: List[str]) -> Optional[Dict[str, Any]]:
-        """使用本地备用模型进行预测"""
-        try:
-            logger.info("🏠 使用本地备用预测模型")
-            return self._rule_based_prediction(activity_sequence)
         except Exception as e:
-            logger.error(f"本地预测失败: {e}")
+            logger.error(f"❌ 云服务器API调用出错: {e}")
             return None
     
-    def _rule_based_prediction(self, activity_sequence: List[str]) -> Optional[Dict[str, Any]]:
-        """基于规则的预测 - 增强版"""
-        if not activity_sequence:
-            return None
+    def _post_cancellable(self, url: str, payload: Dict[str, Any], timeout: float,
+                          cancel_event: Optional[threading.Event] = None) -> Optional[requests.Response]:
+        """发送非流式请求；cancel_event 被设置时立即返回 None，不再占用调用方的线程
         
-        # 分析最近的活动模式
-        recent_patterns = self._analyze_activity_patterns(activity_sequence)
+        requests 无法中断等待响应的请求，因此请求在 request_executor 中发送：被放弃时尚未发出的请求直接取消，
+        已发出的请求最长 timeout 秒内自行结束，结束后的结果仍计入熔断器。
+        """
+        if cancel_event is None:
+            return self.session.post(url, json=payload, timeout=self._timeout(timeout))
         
-        # 生成预测
-        prediction = self._generate_pattern_based_prediction(recent_patterns)
-        
-        return prediction
+        future = self.request_executor.submit(self.session.post, url, json=payload, timeout=self._timeout(timeout))
+        while not wait([future], timeout=0.05).done:
+            if cancel_event.is_set():
+                logger.info("⏹️ 活动窗口已变化，放弃等待非流式预测")
+                if not future.cancel():
+                    future.add_done_callback(self._record_abandoned)
+                return None
+        return future.result()
     
-    def _analyze_activity_patterns(self, activity_sequence: List[str]) -> Dict[str, Any]:
-        """分析活动模式"""
-        patterns = {
-            'recent_apps': [],
-            'browser_activities': [],
-            'frequent_websites': [],
-            'time_patterns': []
-        }
-        
-        for activity in activity_sequence[-5:]:
-            # 提取应用信息
-            app_match = re.search(r'\(应用: (.+?)\)', activity)
-            if app_match:
-                app_name = app_match.group(1).strip()
-                patterns['recent_apps'].append(app_name)
-                
-                # 如果是浏览器活动，提取网站信息
-                if app_name in ['chrome.exe', 'msedge.exe']:
-                    window_match = re.search(r'切换到窗口: (.+?) \(应用:', activity)
-                    if window_match:
-                        window_title = window_match.group(1).strip()
-                        patterns['browser_activities'].append(window_title)
-                        
-                        # 提取网站类型
-                        website_patterns = ['bilibili', 'github', 'google', 'baidu', 'zhihu']
-                        for site in website_patterns:
-                            if site in window_title.lower():
-                                patterns['frequent_websites'].append(site)
-        
-        return patterns
-    
-    def _generate_pattern_based_prediction(self, patterns: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """基于模式生成预测"""
+    def _record_abandoned(self, future):
+        """被放弃的非流式请求结束后，按其结果更新熔断器"""
         try:
-            recent_apps = patterns['recent_apps']
-            browser_activities = patterns['browser_activities']
-            frequent_websites = patterns['frequent_websites']
-            
-            # 应用切换模式
-            app_transitions = {
-                'chrome.exe': ['Code.exe', 'notepad.exe', 'explorer.exe'],
-                'Code.exe': ['chrome.exe', 'cmd.exe'],
-                'explorer.exe': ['notepad.exe', 'Code.exe'],
-                'notepad.exe': ['chrome.exe', 'explorer.exe']
-            }
-            
-            # 网站访问模式
-            website_transitions = {
-                'bilibili': ['github', 'zhihu'],
-                'github': ['bilibili', 'google'],
-                'google': ['bilibili', 'github'],
-                'zhihu': ['bilibili', 'baidu']
-            }
-            
-            predicted_time = datetime.now() + timedelta(minutes=2)
-            
-            # 如果最近主要是浏览器活动
-            if recent_apps and recent_apps[-1] in ['chrome.exe', 'msedge.exe']:
-                browser_app = recent_apps[-1]
-                
-                # 如果有网站访问历史，预测下一个网站
-                if frequent_websites:
-                    last_website = frequent_websites[-1]
-                    if last_website in website_transitions:
-                        next_website = website_transitions[last_website][0]
-                        
-                        # 构建网页访问预测
-                        website_urls = {
-                            'bilibili': 'https://www.bilibili.com',
-                            'github': 'https://github.com',
-                            'google': 'https://www.google.com',
-                            'baidu': 'https://www.baidu.com',
-                            'zhihu': 'https://www.zhihu.com'
-                        }
-                        
-                        predicted_url = website_urls.get(next_website, 'https://www.google.com')
-                        window_title = f"{next_website.title()} Homepage"
-                        
-                        return {
-                            "predicted_time": predicted_time,
-                            "app_name": browser_app,
-                            "action_type": "访问网页",
-                            "confidence": 0.7,
-                            "raw_prediction": f"{predicted_time.strftime('%Y-%m-%d %H:%M:%S')} - 访问网页: {predicted_url} (应用: {browser_app})",
-                            "predicted_content": {
-                                "content_type": "webpage",
-                                "website": next_website,
-                                "window_title": window_title,
-                                "predicted_url": predicted_url
-                            }
-                        }
-            
-            # 普通应用切换预测
-            if recent_apps:
-                last_app = recent_apps[-1]
-                if last_app in app_transitions:
-                    next_app = app_transitions[last_app][0]
-                    
-                    return {
-                        "predicted_time": predicted_time,
-                        "app_name": next_app,
-                        "action_type": "启动应用",
-                        "confidence": 0.6,
-                        "raw_prediction": f"{predicted_time.strftime('%Y-%m-%d %H:%M:%S')} - 启动应用: {next_app}",
-                        "predicted_content": {}
-                    }
+            self._record_response(future.result().status_code)
+        except requests.exceptions.RequestException as e:
+            self.breaker.record_failure(type(e).__name__)
+        except Exception:
+            pass
+    
+    def _request_stream(self, payload: Dict[str, Any],
+                        on_action: Optional[Callable[[Dict[str, Any]], None]] = None,
+                        timeout: float = 15,
+                        cancel_event: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+        """调用 /predict/stream（Server-Sent Events），返回 done 事件中的完整结果；cancel_event 被设置时断开连接"""
+        with self.session.post(f"{self.api_url}/predict/stream", json=payload, stream=True,
+                               timeout=self._timeout(timeout)) as response:
+            self._record_response(response.status_code)
+            if response.status_code == 503:
+                logger.warning(f"⏳ 服务端繁忙，跳过本次预测 (Retry-After: {response.headers.get('Retry-After', '-')}s)")
+                return None
+            if response.status_code != 200:
+                logger.error(f"❌ API请求失败: {response.status_code}")
+                return None
+            # text/event-stream 未声明编码，requests 默认按 ISO-8859-1 解码
+            response.encoding = 'utf-8'
             
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if cancel_event is not None and cancel_event.is_set():
+                    logger.info("⏹️ 活动窗口已变化，中止流式预测")
+                    return None
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:"):])
+                    if event == "action":
+                        early_prediction = self._parse_stream_action(data)
+                        if early_prediction and on_action:
+                            on_action(early_prediction)
+                    elif event == "done":
+                        return data
+                    elif event == "error":
+                        logger.error(f"❌ 流式预测失败: {data.get('detail')}")
+                        return None
+        
+        logger.warning("❌ 流式预测连接提前结束")
+        return None
+    
+    def _parse_stream_action(self, action: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """把流式预测的 action 事件转换为初步预测（只含应用，不含窗口标题等细节）"""
+        if not action.get("app"):
             return None
-            
+        
+        if action.get("timestamp"):
+            predicted_time = datetime.strptime(action["timestamp"], '%Y-%m-%d %H:%M:%S')
+        else:
+            predicted_time = datetime.now() + timedelta(minutes=2)
+        
+        action_type = {"切换到窗口": "切换窗口"}.get(action.get("action_type"), action.get("action_type"))
+        logger.info(f"⚡ 流式预测已解码应用: {action_type} {action['app']} "
+                    f"(置信度: {action.get('confidence', 0.0):.2f}, {action.get('elapsed_ms', 0.0):.0f}ms)")
+        return {
+            "predicted_time": predicted_time,
+            "app_name": self._normalize_app_name(action["app"]),
+            "action_type": action_type,
+            "confidence": action.get("confidence", 0.0),
+            "raw_prediction": action.get("partial_prediction", ""),
+            "predicted_content": {}
+        }
+    
+    def _parse_candidates(self, candidates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """解析服务端返回的备选候选预测（按概率从高到低）"""
+        alternatives = []
+        for candidate in candidates:
+            parsed = self._parse_prediction(candidate.get("prediction", ""))
+            if parsed:
+                parsed["confidence"] = candidate.get("probability", 0.0)
+                alternatives.append(parsed)
+        if alternatives:
+            summary = ", ".join(f"{a['app_name']}({a['confidence']:.2f})" for a in alternatives)
+            logger.info(f"📋 备选预测: {summary}")
+        return alternatives
+    
+    def _predict_via_local_backup(self, activity_sequence: List[str]) -> Optional[Dict[str, Any]]:
+        """云端不可用时使用本地预测器"""
+        logger.info("🏠 使用本地备用预测模型")
+        return self._predict_via_local_model(activity_sequence)
+    
+    def _predict_via_local_model(self, activity_sequence: List[str]) -> Optional[Dict[str, Any]]:
+        """使用本地n-gram预测器进行预测，置信度为校准后的概率"""
+        try:
+            candidates = self.local_predictor.predict(activity_sequence, top_k=self.config['llm'].get('top_k', 3))
+            predictions = []
+            for candidate in candidates:
+                parsed = self._parse_prediction(candidate["line"])
+                if parsed:
+                    parsed["confidence"] = candidate["probability"]
+                    predictions.append(parsed)
+            if not predictions:
+                logger.info("本地预测器尚无足够的历史，跳过本次预测")
+                return None
+            prediction = predictions[0]
+            prediction["alternatives"] = predictions[1:]
+            return prediction
         except Exception as e:
-            logger.error(f"生成模式预测失败: {e}")
+            logger.error(f"本地预测失败: {e}")
             return None
     
     def _parse_prediction(self, prediction_text: str) -> Optional[Dict[str, Any]]:
@@ -1032,13 +1293,44 @@ class RealTimeActivityQueue:
     def __init__(self, max_size: int = 10):
         self.queue = deque(maxlen=max_size)
         self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # 每添加一条活动加1，用于判断预测所依据的活动窗口是否已过期
+        self.version = 0
+        # 最近一条活动被观察到的时间（perf_counter），用于统计事件到预加载决策的延迟
+        self.last_event_time = 0.0
+        # 每条新活动（格式化后的字符串）都会传给这些回调，如本地预测器的在线更新
+        self.listeners = []
+        
+    def add_listener(self, callback: Callable[[str], None]):
+        """注册新活动回调"""
+        self.listeners.append(callback)
         
     def add_activity(self, activity: Dict[str, Any]):
         """添加新活动到队列"""
         with self.lock:
             formatted_activity = self._format_activity(activity)
             self.queue.append(formatted_activity)
+            self.version += 1
+            self.last_event_time = time.perf_counter()
+            self.changed.notify_all()
             logger.info(f"📊 新活动: {formatted_activity}")
+        for callback in self.listeners:
+            try:
+                callback(formatted_activity)
+            except Exception as e:
+                logger.error(f"活动回调出错: {e}")
+    
+    def wait_for_change(self, last_version: int, timeout: float) -> int:
+        """等待队列版本不同于 last_version（最长 timeout 秒），返回当前版本"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != last_version, timeout)
+            return self.version
+    
+    def snapshot(self, count: int = None) -> Tuple[int, List[str], float]:
+        """返回 (版本, 最近的活动, 最近一条活动的观察时间)"""
+        with self.lock:
+            activities = list(self.queue) if count is None else list(self.queue)[-count:]
+            return self.version, activities, self.last_event_time
     
     def get_recent_activities(self, count: int = None) -> List[str]:
         """获取最近的活动"""
@@ -1080,17 +1372,26 @@ class EndToEndSystem:
         self.activity_queue = RealTimeActivityQueue(max_size=self.queue_size)
         self.llm_predictor = LLMPredictor(config)
         self.app_manager = SmartApplicationManager()
+        self.activity_queue.add_listener(self.llm_predictor.observe_activity)
         
         # 运行状态
         self.running = False
         self.monitor_thread = None
         self.prediction_thread = None
+        self.preload_thread = None
         self.cleanup_thread = None
         
-        # 预测状态
-        self.last_queue_hash = 0
+        # 预测状态：预测在线程池中执行，结果经 preload_queue 交给预加载线程
+        self.last_queue_version = 0
         self.prediction_cooldown = config['system'].get('prediction_cooldown', 30)
         self.last_prediction_time = 0
+        # 进行中的预测不会阻塞新预测：被取代的请求（流式或非流式）收到取消后立即释放线程
+        self.prediction_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prediction")
+        self.prediction_lock = threading.Lock()
+        self.current_cancel = None
+        self.preload_queue = queue.Queue()
+        # 最近的 事件 -> 预加载决策 延迟（毫秒）
+        self.decision_latencies = deque(maxlen=100)
         
         logger.info("🎉 增强版端到端系统初始化完成")
     
@@ -1107,6 +1408,10 @@ class EndToEndSystem:
         self.prediction_thread = threading.Thread(target=self._prediction_loop, daemon=True)
         self.prediction_thread.start()
         
+        # 启动预加载线程
+        self.preload_thread = threading.Thread(target=self._preload_loop, daemon=True)
+        self.preload_thread.start()
+        
         # 启动清理线程
         self.cleanup_thread = threading.Thread(target=self._cleanup_loop, daemon=True)
         self.cleanup_thread.start()
@@ -1130,10 +1435,19 @@ class EndToEndSystem:
         
         if self.prediction_thread and self.prediction_thread.is_alive():
             self.prediction_thread.join(timeout=5)
+        
+        with self.prediction_lock:
+            if self.current_cancel is not None:
+                self.current_cancel.set()
+        self.prediction_executor.shutdown(wait=False, cancel_futures=True)
+        self.preload_queue.put(None)
+        if self.preload_thread and self.preload_thread.is_alive():
+            self.preload_thread.join(timeout=5)
             
         if self.cleanup_thread and self.cleanup_thread.is_alive():
             self.cleanup_thread.join(timeout=5)
         
+        logger.info(f"📊 级联预测统计: {self.llm_predictor.get_cascade_stats()}")
         logger.info("✓ 增强版端到端系统已停止")
     
     def _monitor_activities(self):
@@ -1200,77 +1514,188 @@ class EndToEndSystem:
             return None
     
     def _prediction_loop(self):
-        """预测循环"""
+        """预测调度循环：活动队列一变化就开始新的预测，并取代仍在进行中的旧预测"""
         logger.info("🔮 开始增强版预测循环...")
         
         while self.running:
             try:
-                queue_changed, current_hash = self.activity_queue.is_activity_queue_changed(self.last_queue_hash)
+                version = self.activity_queue.wait_for_change(self.last_queue_version, timeout=1.0)
+                if version == self.last_queue_version:
+                    continue
                 
-                if queue_changed:
-                    self.last_queue_hash = current_hash
-                    
-                    current_time = time.time()
-                    if current_time - self.last_prediction_time >= self.prediction_cooldown:
-                        self._make_prediction()
-                        self.last_prediction_time = current_time
+                # 有预测进行中时新活动立即取代它；空闲时距上次预测结束不足冷却时间则等待，
+                # 冷却结束后按届时最新的活动窗口预测
+                if self.current_cancel is None:
+                    remaining = self.prediction_cooldown - (time.time() - self.last_prediction_time)
+                    if remaining > 0:
+                        time.sleep(min(remaining, 1.0))
+                        continue
                 
-                time.sleep(5)
+                self.last_queue_version = version
+                self._start_prediction()
                 
             except Exception as e:
                 logger.error(f"预测循环出错: {e}")
                 time.sleep(10)
     
-    def _cleanup_loop(self):
-        """清理循环"""
-        logger.info("🧹 开始定期清理循环...")
+    def _start_prediction(self):
+        """按最新的活动窗口提交一次预测，并取消进行中的旧预测"""
+        version, recent_activities, event_time = self.activity_queue.snapshot(self.prediction_window)
+        if len(recent_activities) < 3:
+            return
         
-        while self.running:
-            try:
-                self.app_manager.periodic_cleanup()
-                time.sleep(300)  # 每5分钟清理一次
-                
-            except Exception as e:
-                logger.error(f"清理循环出错: {e}")
-                time.sleep(60)
+        with self.prediction_lock:
+            if self.current_cancel is not None:
+                self.current_cancel.set()
+                logger.info("⏹️ 活动窗口已变化，取消进行中的预测")
+            cancel_event = threading.Event()
+            self.current_cancel = cancel_event
+        self.prediction_executor.submit(self._run_prediction, version, recent_activities, event_time, cancel_event)
+    
+    def _is_stale(self, version: int, cancel_event: threading.Event) -> bool:
+        """预测已被取消，或其依据的活动窗口之后又有新活动"""
+        return cancel_event.is_set() or self.activity_queue.version != version
     
-    def _make_prediction(self):
-        """执行预测"""
+    def _run_prediction(self, version: int, recent_activities: List[str], event_time: float,
+                        cancel_event: threading.Event):
+        """在线程池中执行预测，未过期的结果放入预加载队列"""
         try:
-            recent_activities = self.activity_queue.get_recent_activities(self.prediction_window)
+            logger.info(f"🔮 开始增强版预测，基于最近 {len(recent_activities)} 个活动")
+            started = time.perf_counter()
             
-            if len(recent_activities) < 3:
-                return
+            # 流式预测中应用名一解码出来就先交给预加载线程
+            def on_action(early_prediction: Dict[str, Any]):
+                if not self._is_stale(version, cancel_event):
+                    self.preload_queue.put(("early", early_prediction, version, event_time, started))
             
-            logger.info(f"🔮 开始增强版预测，基于最近 {len(recent_activities)} 个活动")
+            prediction = self.llm_predictor.predict_next_activity(
+                recent_activities, on_action=on_action, cancel_event=cancel_event
+            )
             
-            prediction = self.llm_predictor.predict_next_activity(recent_activities)
+            if self._is_stale(version, cancel_event):
+                logger.info(f"🗑️ 活动窗口已变化，丢弃过期的预测结果 (耗时 {(time.perf_counter() - started) * 1000:.0f}ms)")
+                self._finish_prediction(cancel_event, completed=False)
+                return
             
             if prediction:
-                app_name = prediction['app_name']
-                predicted_time = prediction['predicted_time']
-                confidence = prediction.get('confidence', 0.0)
-                action_type = prediction.get('action_type', '未知')
-                content_info = prediction.get('predicted_content', {})
-                
-                logger.info(f"📈 预测结果: {action_type} {app_name} 在 {predicted_time.strftime('%H:%M:%S')} (置信度: {confidence:.2f})")
-                
-                if content_info.get('content_type') == 'webpage':
-                    logger.info(f"🌐 预测网页内容: {content_info.get('window_title', 'N/A')}")
-                
-                # 智能预加载
-                confidence_threshold = self.config['system'].get('confidence_threshold', 0.6)
-                if confidence >= confidence_threshold:
-                    success = self.app_manager.smart_preload(prediction)
-                    if success:
-                        logger.info(f"✅ 已安排智能预加载: {app_name}")
-                else:
-                    logger.info(f"📊 置信度过低 ({confidence:.2f} < {confidence_threshold})，跳过预加载")
+                self.preload_queue.put(("final", prediction, version, event_time, started))
             else:
                 logger.info("❌ 预测失败，未获得有效预测结果")
+            self._finish_prediction(cancel_event, completed=True)
                 
         except Exception as e:
             logger.error(f"执行预测时出错: {e}")
+            self._finish_prediction(cancel_event, completed=True)
+    
+    def _finish_prediction(self, cancel_event: threading.Event, completed: bool):
+        """预测结束后不再视为进行中
+        
+        完成或失败时从此刻开始冷却，服务端持续失败时也不会每条活动都发一次请求；
+        因活动窗口变化而丢弃结果时不计冷却，由新活动立即发起的预测接替。
+        """
+        with self.prediction_lock:
+            if self.current_cancel is cancel_event:
+                self.current_cancel = None
+                if completed:
+                    self.last_prediction_time = time.time()
+    
+    def _preload_loop(self):
+        """预加载线程：按顺序处理预测结果，跳过活动窗口已变化的结果"""
+        logger.info("📦 开始预加载决策循环...")
+        # 同一活动窗口中已由初步预测（流式 action 事件）预加载的应用
+        early_preloaded = set()
+        early_version = None
+        
+        while self.running:
+            try:
+                item = self.preload_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            
+            kind, prediction, version, event_time, started = item
+            if self.activity_queue.version != version:
+                logger.info(f"🗑️ 活动窗口已变化，跳过过期预测的预加载: {prediction.get('app_name')}")
+                continue
+            if version != early_version:
+                early_preloaded, early_version = set(), version
+            
+            try:
+                if kind == "early":
+                    self._preload_early(prediction, early_preloaded)
+                else:
+                    self._apply_prediction(prediction, early_preloaded)
+            except Exception as e:
+                logger.error(f"执行预加载时出错: {e}")
+            self._log_decision_latency(kind, event_time, started)
+    
+    def _log_decision_latency(self, kind: str, event_time: float, started: float):
+        """记录从活动被观察到（含冷却等待和预测耗时）到做出预加载决策的延迟"""
+        now = time.perf_counter()
+        latency_ms = (now - event_time) * 1000
+        self.decision_latencies.append(latency_ms)
+        recent = sorted(self.decision_latencies)
+        logger.info(
+            f"⏱️ 事件到预加载决策: {latency_ms:.0f}ms ({'初步' if kind == 'early' else '最终'}预测, "
+            f"其中预测 {(now - started) * 1000:.0f}ms; 最近 {len(recent)} 次中位数 {recent[len(recent) // 2]:.0f}ms)"
+        )
+    
+    def _cleanup_loop(self):
+        """清理循环"""
+        logger.info("🧹 开始定期清理循环...")
+        
+        while self.running:
+            try:
+                self.app_manager.periodic_cleanup()
+                time.sleep(300)  # 每5分钟清理一次
+                
+            except Exception as e:
+                logger.error(f"清理循环出错: {e}")
+                time.sleep(60)
+    
+    def _preload_early(self, early_prediction: Dict[str, Any], early_preloaded: set):
+        """流式预测中应用名一解码出来就先预加载"""
+        confidence_threshold = self.config['system'].get('confidence_threshold', 0.6)
+        if early_prediction['confidence'] < confidence_threshold:
+            return
+        if self.app_manager.smart_preload(early_prediction):
+            early_preloaded.add(early_prediction['app_name'])
+            logger.info(f"✅ 已提前安排预加载: {early_prediction['app_name']}")
+    
+    def _apply_prediction(self, prediction: Dict[str, Any], early_preloaded: set):
+        """根据完整的预测结果做预加载决策"""
+        confidence_threshold = self.config['system'].get('confidence_threshold', 0.6)
+        app_name = prediction['app_name']
+        predicted_time = prediction['predicted_time']
+        confidence = prediction.get('confidence', 0.0)
+        action_type = prediction.get('action_type', '未知')
+        content_info = prediction.get('predicted_content', {})
+        
+        logger.info(f"📈 预测结果: {action_type} {app_name} 在 {predicted_time.strftime('%H:%M:%S')} (置信度: {confidence:.2f})")
+        
+        if content_info.get('content_type') == 'webpage':
+            logger.info(f"🌐 预测网页内容: {content_info.get('window_title', 'N/A')}")
+        
+        # 智能预加载
+        if app_name in early_preloaded and not content_info:
+            logger.info(f"⏭️ {app_name} 已在流式预测中预加载")
+        elif confidence >= confidence_threshold:
+            success = self.app_manager.smart_preload(prediction)
+            if success:
+                logger.info(f"✅ 已安排智能预加载: {app_name}")
+        else:
+            logger.info(f"📊 置信度过低 ({confidence:.2f} < {confidence_threshold})，跳过预加载")
+        
+        # 备选候选中置信度足够高的其它应用也一并预加载
+        preloaded_apps = {app_name} | early_preloaded
+        for alternative in prediction.get('alternatives', []):
+            if alternative['app_name'] in preloaded_apps:
+                continue
+            if alternative.get('confidence', 0.0) >= confidence_threshold:
+                preloaded_apps.add(alternative['app_name'])
+                if self.app_manager.smart_preload(alternative):
+                    logger.info(f"✅ 已安排备选预加载: {alternative['app_name']} (置信度: {alternative['confidence']:.2f})")
 
 def create_default_config() -> Dict[str, Any]:
     """创建默认配置"""
@@ -1285,7 +1710,30 @@ def create_default_config() -> Dict[str, Any]:
             "use_ssh_tunnel": True,
             "server_host": "js2.blockelite.cn",
             "server_port": 8000,
-            "timeout": 15
+            "timeout": 15,
+            "connect_timeout": 3,
+            "pool_size": 4,
+            "top_k": 3,
+            "stream": False,
+            "user_id": None,
+            "constrained": None
+        },
+        "local_model": {
+            "path": "local_predictor.json.gz",
+            "data_dir": "activity_data",
+            "max_order": 3,
+            "save_interval": 20
+        },
+        "cascade": {
+            "enabled": True,
+            "local_threshold": 0.6,
+            "stats_interval": 20
+        },
+        "circuit_breaker": {
+            "failure_threshold": 3,
+            "base_backoff": 5,
+            "max_backoff": 60,
+            "probe_timeout": 3
         },
         "ssh": {
             "host": "js2.blockelite.cn",
@@ -0,0 +1,356 @@
+"""
+本地n-gram（变阶马尔可夫）活动预测器
+把活动行（ActivityAnalyzer._format_activity / RealTimeActivityQueue._format_activity 的格式）
+归约为离散状态（操作类型 + 应用/域名），统计 1~max_order 阶的状态转移次数，
+用 Witten-Bell 插值平滑给出下一个状态的概率，再按在线记录的命中率校准。
+
+  - 离线训练：从 activity_monitor 采集的 activity_data_*.json 学习
+  - 在线更新：每条新活动调用 observe
+  - 预测只做字典查找，单次几十微秒，可作为云端LLM之前的第一层预测和离线时的备用预测
+  - 模型以状态编号 + 计数的形式保存为 gzip 压缩的JSON
+
+    python local_predictor.py --data-dir activity_data --output local_predictor.json.gz
+"""
+
+import os
+import re
+import math
+import gzip
+import json
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta
+from collections import deque
+from typing import List, Dict, Any, Optional, Tuple
+
+try:
+    from activity_analyzer import ActivityAnalyzer
+except ImportError:
+    ActivityAnalyzer = None
+
+EVENT_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - (.+)$')
+URL_DOMAIN_PATTERN = re.compile(r'https?://([^/\s()]+)')
+BROWSERS = ('chrome.exe', 'msedge.exe', 'firefox.exe')
+# 超过该间隔没有活动视为新会话，不跨会话统计转移（与 ActivityAnalyzer.segment_by_session 的默认阈值一致）
+SESSION_GAP_SECONDS = 30 * 60
+# 可以据此预加载的状态（关闭应用、访问文件等只作为上下文）
+ACTIONABLE_OPERATIONS = ('切换到窗口', '启动应用', '使用应用', '访问网站')
+# 校准时每个概率分箱的先验权重：样本少时接近模型原始概率
+CALIBRATION_PRIOR = 5.0
+# 每个状态保留的代表性细节（窗口标题）数
+MAX_DETAILS = 5
+
+def parse_activity(line: str) -> Optional[Tuple[datetime, str, str]]:
+    """把活动行解析为 (时间, 状态, 细节)；时间上下文、会话开始/结束等不参与预测的行返回 None"""
+    match = EVENT_PATTERN.match(line.strip())
+    if not match:
+        return None
+    timestamp = datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S')
+    body = match.group(2)
+
+    window = re.match(r'^切换到窗口: (.*) \(应用: ([^()]+)\)$', body)
+    if window:
+        return timestamp, f"切换到窗口|{window.group(2).strip()}", window.group(1).strip()
+    for operation in ('启动应用', '关闭应用', '使用应用'):
+        if body.startswith(operation + ": "):
+            app = body[len(operation) + 2:].split(" (")[0].strip()
+            return timestamp, f"{operation}|{app}", ""
+    if body.startswith("访问网站"):
+        # "访问网站 域名 的页面 '标题'" 或 "访问网站: 域名 - 标题"
+        domain = re.match(r'^访问网站:? ([^\s]+)', body)
+        if domain:
+            return timestamp, f"访问网站|{domain.group(1)}", ""
+    if body.startswith("访问网页"):
+        domain = URL_DOMAIN_PATTERN.search(body)
+        if domain:
+            return timestamp, f"访问网站|{domain.group(1)}", ""
+    if body.startswith("访问文件: "):
+        name = body[len("访问文件: "):].split(" (位于")[0]
+        return timestamp, f"访问文件|{os.path.splitext(name)[1].lower()}", ""
+    if body.startswith(("时间上下文", "会话开始", "会话结束")):
+        return None
+    return timestamp, body.split(":")[0].strip(), ""
+
+class NGramPredictor:
+    """变阶马尔可夫链预测器（Witten-Bell 插值平滑 + 在线概率校准）"""
+
+    def __init__(self, max_order: int = 3, calibration_bins: int = 10):
+        self.max_order = max(1, max_order)
+        self.calibration_bins = calibration_bins
+        self.states = []  # 状态编号 -> 状态名
+        self.state_ids = {}
+        self.counts = {}  # 上下文（状态编号元组，长度 0~max_order） -> {下一个状态: 次数}
+        self.totals = {}
+        self.details = {}  # 状态 -> {窗口标题: 次数}
+        self.gaps = {}  # 状态 -> 出现前与上一条活动的平均间隔（秒）
+        self.browser = "chrome.exe"
+        # 每个分箱: [预测概率之和, 命中次数, 预测次数]，只统计第一候选
+        self.calibration = [[0.0, 0, 0] for _ in range(calibration_bins)]
+        self.history = deque(maxlen=self.max_order)
+        self.last_time = None
+        self.updates = 0
+        self.top_unigrams = []
+        self.lock = threading.Lock()
+
+    def _state_id(self, state: str) -> int:
+        if state not in self.state_ids:
+            self.state_ids[state] = len(self.states)
+            self.states.append(state)
+        return self.state_ids[state]
+
+    def _probability(self, history: Tuple[int, ...], state: int) -> float:
+        """从0阶到最长上下文逐阶插值：P = (c(h, w) + T(h)·P_低阶) / (c(h) + T(h))，T(h) 为 h 之后出现过的不同状态数"""
+        probability = 1.0 / (len(self.states) + 1)
+        for order in range(len(history) + 1):
+            context = history[len(history) - order:]
+            following = self.counts.get(context)
+            if not following:
+                break
+            types = len(following)
+            probability = (following.get(state, 0) + types * probability) / (self.totals[context] + types)
+        return probability
+
+    def _ranked(self, history: Tuple[int, ...], limit: int) -> List[Tuple[int, float]]:
+        """按概率排序的候选状态
+
+        只在各阶上下文之后出现过的状态和最常见的若干状态中查找：其余状态只能从0阶分到概率，
+        排序与出现次数相同，不会超过最常见的状态。
+        """
+        candidates = set(self.top_unigrams[:limit + 8])
+        for order in range(1, len(history) + 1):
+            candidates.update(self.counts.get(history[len(history) - order:], ()))
+        ranked = sorted(((state, self._probability(history, state)) for state in candidates),
+                        key=lambda item: item[1], reverse=True)
+        return ranked
+
+    def _history_ids(self, states: List[str]) -> Tuple[int, ...]:
+        """把状态序列转换为上下文；未见过的状态截断上下文"""
+        ids = []
+        for state in states[-self.max_order:]:
+            if state in self.state_ids:
+                ids.append(self.state_ids[state])
+            else:
+                ids = []
+        return tuple(ids)
+
+    def calibrate(self, probability: float) -> float:
+        """按在线记录的命中率校准模型概率（分箱，样本少时向原始概率收缩）"""
+        _, hits, count = self.calibration[min(int(probability * self.calibration_bins), self.calibration_bins - 1)]
+        return (hits + CALIBRATION_PRIOR * probability) / (count + CALIBRATION_PRIOR)
+
+    def observe(self, line: str) -> bool:
+        """用一条新活动在线更新模型，返回是否被计入"""
+        parsed = parse_activity(line)
+        if parsed is None:
+            return False
+        timestamp, state, detail = parsed
+        with self.lock:
+            gap = (timestamp - self.last_time).total_seconds() if self.last_time else None
+            if gap is None or gap < 0 or gap > SESSION_GAP_SECONDS:
+                self.history.clear()
+                gap = None
+
+            history = tuple(self.history)
+            state_id = self.state_ids.get(state)
+            if history and self.states:
+                # 更新前先对这一条做一次预测，记录第一候选的概率和是否命中
+                best, probability = self._ranked(history, 1)[0]
+                bucket = self.calibration[min(int(probability * self.calibration_bins), self.calibration_bins - 1)]
+                bucket[0] += probability
+                bucket[1] += int(best == state_id)
+                bucket[2] += 1
+
+            state_id = self._state_id(state)
+            for order in range(len(history) + 1):
+                context = history[len(history) - order:]
+                following = self.counts.setdefault(context, {})
+                following[state_id] = following.get(state_id, 0) + 1
+                self.totals[context] = self.totals.get(context, 0) + 1
+
+            if detail:
+                details = self.details.setdefault(state_id, {})
+                details[detail] = details.get(detail, 0) + 1
+                if len(details) > MAX_DETAILS * 4:
+                    self.details[state_id] = dict(sorted(details.items(), key=lambda item: item[1], reverse=True)[:MAX_DETAILS])
+            if gap is not None:
+                self.gaps[state_id] = 0.8 * self.gaps.get(state_id, gap) + 0.2 * gap
+            app = state.split("|", 1)[-1]
+            if app.lower() in BROWSERS:
+                self.browser = app
+
+            self.history.append(state_id)
+            self.last_time = timestamp
+            self.updates += 1
+            if self.updates % 100 == 1 or len(self.top_unigrams) < 16:
+                self._refresh_top_unigrams()
+        return True
+
+    def _refresh_top_unigrams(self):
+        unigrams = self.counts.get((), {})
+        self.top_unigrams = sorted(unigrams, key=unigrams.get, reverse=True)[:32]
+
+    def fit_lines(self, lines: List[str]) -> int:
+        """按时间顺序学习活动行，返回计入的条数"""
+        return sum(1 for line in lines if self.observe(line))
+
+    def train_from_activity_data(self, data_dir: str) -> int:
+        """从 activity_monitor 采集的 activity_data_*.json 学习，格式化方式与 ActivityAnalyzer 生成训练数据时相同"""
+        if ActivityAnalyzer is None:
+            raise RuntimeError("无法导入 activity_analyzer，不能从 activity_data 训练")
+        analyzer = ActivityAnalyzer(data_dir=data_dir, output_dir=os.path.join(data_dir, "dataset"))
+        activities = analyzer.preprocess_data()
+        return self.fit_lines(analyzer._format_sequence(activities))
+
+    def _format_line(self, state_id: int, predicted_time: datetime) -> Optional[str]:
+        """把预测的状态还原为 LLMPredictor._parse_prediction 能解析的活动行"""
+        operation, _, target = self.states[state_id].partition("|")
+        if operation not in ACTIONABLE_OPERATIONS or not target:
+            return None
+        time_str = predicted_time.strftime('%Y-%m-%d %H:%M:%S')
+        if operation == "切换到窗口":
+            details = self.details.get(state_id)
+            title = max(details, key=details.get) if details else target
+            return f"{time_str} - 切换到窗口: {title} (应用: {target})"
+        if operation == "访问网站":
+            return f"{time_str} - 访问网页: https://{target} (应用: {self.browser})"
+        return f"{time_str} - 启动应用: {target}"
+
+    def predict(self, activity_sequence: List[str], top_k: int = 3) -> List[Dict[str, Any]]:
+        """预测下一条可预加载的活动，返回按概率排序的候选: {"line", "probability", "raw_probability", "state"}"""
+        parsed = [p for p in (parse_activity(line) for line in activity_sequence) if p is not None]
+        if not parsed:
+            return []
+        last_time = parsed[-1][0]
+        with self.lock:
+            if not self.states:
+                return []
+            history = self._history_ids([state for _, state, _ in parsed])
+            predictions = []
+            for state_id, probability in self._ranked(history, top_k):
+                gap = min(max(self.gaps.get(state_id, 120.0), 10.0), 600.0)
+                line = self._format_line(state_id, last_time + timedelta(seconds=gap))
+                if line is None:
+                    continue
+                predictions.append({
+                    "line": line,
+                    "probability": round(min(self.calibrate(probability), 1.0), 4),
+                    "raw_probability": round(probability, 4),
+                    "state": self.states[state_id]
+                })
+                if len(predictions) >= top_k:
+                    break
+            return predictions
+
+    def calibration_stats(self) -> Dict[str, Any]:
+        """在线第一候选的准确率和期望校准误差（ECE）"""
+        total = sum(count for _, _, count in self.calibration)
+        if total == 0:
+            return {"predictions": 0, "accuracy": 0.0, "ece": 0.0}
+        hits = sum(hit for _, hit, _ in self.calibration)
+        ece = sum(abs(hit - predicted) for predicted, hit, count in self.calibration if count) / total
+        return {"predictions": total, "accuracy": round(hits / total, 4), "ece": round(ece, 4)}
+
+    def save(self, path: str):
+        """以状态编号 + 计数的形式保存（gzip压缩的JSON）"""
+        with self.lock:
+            data = {
+                "version": 1,
+                "max_order": self.max_order,
+                "states": self.states,
+                "counts": [[list(context), list(following.items())] for context, following in self.counts.items()],
+                "details": {str(state): details for state, details in self.details.items()},
+                "gaps": {str(state): round(gap, 1) for state, gap in self.gaps.items()},
+                "browser": self.browser,
+                "calibration": self.calibration,
+                "updates": self.updates
+            }
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "NGramPredictor":
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        predictor = cls(max_order=data["max_order"], calibration_bins=len(data["calibration"]))
+        predictor.states = data["states"]
+        predictor.state_ids = {state: i for i, state in enumerate(predictor.states)}
+        for context, following in data["counts"]:
+            predictor.counts[tuple(context)] = dict((state, count) for state, count in following)
+            predictor.totals[tuple(context)] = sum(count for _, count in following)
+        predictor.details = {int(state): details for state, details in data["details"].items()}
+        predictor.gaps = {int(state): gap for state, gap in data["gaps"].items()}
+        predictor.browser = data.get("browser", predictor.browser)
+        predictor.calibration = data["calibration"]
+        predictor.updates = data.get("updates", 0)
+        predictor._refresh_top_unigrams()
+        return predictor
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "states": len(self.states),
+            "contexts": len(self.counts),
+            "updates": self.updates,
+            **self.calibration_stats()
+        }
+
+def evaluate(lines: List[str], max_order: int = 3, train_ratio: float = 0.8) -> Dict[str, Any]:
+    """按时间顺序切分，前 train_ratio 学习，其余逐条先预测再更新，统计第一候选准确率、对数损失和预测耗时"""
+    split = int(len(lines) * train_ratio)
+    predictor = NGramPredictor(max_order=max_order)
+    predictor.fit_lines(lines[:split])
+    predictor.calibration = [[0.0, 0, 0] for _ in range(predictor.calibration_bins)]
+
+    hits, total, log_loss, elapsed = 0, 0, 0.0, 0.0
+    window = deque(maxlen=max_order)
+    for line in lines[split:]:
+        parsed = parse_activity(line)
+        if parsed is None:
+            continue
+        if window:
+            history = predictor._history_ids([state for _, state, _ in window])
+            start = time.perf_counter()
+            best, _ = predictor._ranked(history, 1)[0]
+            elapsed += time.perf_counter() - start
+            actual = predictor.state_ids.get(parsed[1], -1)
+            hits += int(best == actual)
+            log_loss -= math.log(predictor._probability(history, actual) if actual >= 0 else 1.0 / (len(predictor.states) + 1))
+            total += 1
+        window.append(parsed)
+        predictor.observe(line)
+
+    return {
+        "train_events": split,
+        "test_events": total,
+        "top1_accuracy": round(hits / total, 4) if total else 0.0,
+        "log_loss": round(log_loss / total, 4) if total else 0.0,
+        "predict_us": round(elapsed / total * 1e6, 1) if total else 0.0,
+        "online_calibration": predictor.calibration_stats()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="本地n-gram活动预测器")
+    parser.add_argument("--data-dir", type=str, default="activity_data", help="activity_monitor 采集的数据目录")
+    parser.add_argument("--output", type=str, default="local_predictor.json.gz", help="模型保存路径")
+    parser.add_argument("--max-order", type=int, default=3, help="最长上下文（阶数）")
+    parser.add_argument("--evaluate", action="store_true", help="按时间顺序切分，评估准确率、对数损失和预测耗时")
+
+    args = parser.parse_args()
+    if ActivityAnalyzer is None:
+        parser.error("无法导入 activity_analyzer")
+    analyzer = ActivityAnalyzer(data_dir=args.data_dir, output_dir=os.path.join(args.data_dir, "dataset"))
+    lines = analyzer._format_sequence(analyzer.preprocess_data())
+
+    if args.evaluate:
+        print(json.dumps(evaluate(lines, args.max_order), ensure_ascii=False, indent=2))
+
+    predictor = NGramPredictor(max_order=args.max_order)
+    learned = predictor.fit_lines(lines)
+    predictor.save(args.output)
+    print(f"已学习 {learned} 条活动，{len(predictor.states)} 个状态，模型保存到 {args.output} "
+          f"({os.path.getsize(args.output) / 1024:.1f} KB)")
+
+if __name__ == "__main__":
+    main()